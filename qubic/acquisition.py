@@ -1,11 +1,15 @@
 # coding: utf-8
 from __future__ import division, print_function
 
+import hashlib
 import healpy as hp
 import numpy as np
+import os
+import scipy.sparse
 from pyoperators import (
     BlockColumnOperator, BlockDiagonalOperator, BlockRowOperator,
-    CompositionOperator, DiagonalOperator, I, IdentityOperator,
+    CompositionOperator, DenseBlockDiagonalOperator, DiagonalOperator, I,
+    IdentityOperator,
     MPIDistributionIdentityOperator, MPI, proxy_group, ReshapeOperator,
     rule_manager, pcg)
 from pyoperators.utils.mpi import as_mpi
@@ -51,7 +55,8 @@ class QubicAcquisition(Acquisition):
                 If true, the photon noise contribution is included.
             max_nbytes : int or None, optional
                 Maximum number of bytes to be allocated for the acquisition's
-                operator.
+                operator. If the peak sampling matrix is larger, it is
+                computed on the fly by chunks at each operator application.
             nprocs_instrument : int, optional
                 For a given sampling slice, number of procs dedicated to
                 the instrument.
@@ -73,6 +78,10 @@ class QubicAcquisition(Acquisition):
                 frequencies) or two-sided (positive and negative frequencies).
             sigma : float
                 Standard deviation of the white noise component.
+            precomposed_operator : boolean, optional
+                If true, the scalar and diagonal factors of the acquisition
+                operator and the half-wave plate rotation are folded into the
+                values of the peak sampling matrix (see get_operator).
         """
         block = d['block']
         effective_duration = d['effective_duration']
@@ -91,6 +100,8 @@ class QubicAcquisition(Acquisition):
             max_nbytes=max_nbytes, nprocs_instrument=nprocs_instrument,
             nprocs_sampling=nprocs_sampling, comm=comm)
         self.photon_noise = bool(photon_noise)
+        self.max_nbytes = max_nbytes
+        self.precomposed_operator = bool(d['precomposed_operator'])
         self.effective_duration = effective_duration
         self.bandwidth = bandwidth
         self.psd = psd
@@ -336,7 +347,14 @@ class QubicAcquisition(Acquisition):
         Return the operator of the acquisition. Note that the operator is only
         linear if the scene temperature is differential (absolute=False).
 
+        If the acquisition has been initialised with precomposed_operator set
+        to true, the operator is instead made of the detector response, the
+        polarizer (for polarized scenes) and a single peak sampling operator
+        whose values include all the other factors.
+
         """
+        if self.precomposed_operator:
+            return self._get_precomposed_operator()
         distribution = self.get_distribution_operator()
         temp = self.get_unit_conversion_operator()
         aperture = self.get_aperture_integration_operator()
@@ -357,6 +375,128 @@ class QubicAcquisition(Acquisition):
             H = self.get_subtract_grid_operator()(H)
         return H
 
+    def _get_projection_factors(self):
+        """
+        Return the scalar and per-detector factors of the operators which
+        commute with the peak sampling: the unit conversion, the atmospheric
+        transmission, the aperture integration, the filter and the detector
+        integration.
+
+        """
+        scalar = _get_operator_scalar(self.get_unit_conversion_operator()) * \
+            _get_operator_scalar(self.scene.atmosphere.transmission) * \
+            _get_operator_scalar(self.get_aperture_integration_operator()) * \
+            _get_operator_scalar(self.get_filter_operator())
+        integ = self.get_detector_integration_operator()
+        detector = np.asarray(integ.data) * np.ones(len(self.instrument))
+        return scalar, detector
+
+    def _get_precomposed_operator(self):
+        """
+        Return the operator of the acquisition, in which the unit conversion,
+        the atmospheric and instrumental transmissions, the aperture, filter
+        and detector integrations, the half-wave plate rotation and, for
+        intensity scenes, the polarizer are folded into the peak sampling
+        matrix values.
+
+        """
+        nd = len(self.instrument)
+        scalar, detector = self._get_projection_factors()
+        trans_inst = self.instrument.get_transmission_operator()
+        factor = scalar * detector * np.asarray(trans_inst.data)
+        if self.scene.kind == 'I':
+            if self.instrument.optics.polarizer:
+                factor = factor * 0.5
+            else:
+                factor = factor * (1 - self.instrument.detector.quadrant // 4)
+        projections = self._get_projection_matrix_operators()
+        for b, projection in zip(self.block, projections):
+            _scale_projection_matrix(projection.matrix, factor * np.ones(nd))
+            if self.scene.kind == 'I':
+                continue
+            hwp = self.instrument.get_hwp_operator(self.sampling[b],
+                                                   self.scene)
+            e_q = np.zeros(hwp.shapein)
+            e_q[..., 1 if self.scene.kind == 'IQU' else 0] = 1
+            e_q = hwp(e_q)
+            _rotate_projection_matrix(projection.matrix, e_q[..., -2],
+                                      e_q[..., -1])
+        projection = BlockColumnOperator(projections, axisout=1)
+        distribution = self.get_distribution_operator()
+        response = self.get_detector_response_operator()
+        if self.scene.kind == 'I':
+            operands = [response, projection, distribution]
+        else:
+            polarizer = self.get_polarizer_operator()
+            operands = [response, polarizer, projection, distribution]
+        with rule_manager(inplace=True):
+            H = CompositionOperator(operands)
+        if self.scene == 'QU':
+            H = self.get_subtract_grids_operator()(H)
+        return H
+
+    def _get_projection_matrix_operators(self):
+        """
+        Return the peak sampling operators of the sampling blocks, with their
+        sparse matrix stored, which the operators that alter their values
+        require.
+
+        """
+        self._check_projection_matrices_stored()
+        return [self.instrument.get_projection_operator(
+                    self.sampling[b], self.scene, verbose=False)
+                for b in self.block]
+
+    def _check_projection_matrices_stored(self):
+        """
+        Raise an error if the peak sampling matrices of all the sampling
+        blocks are not meant to be held in memory at the same time.
+
+        """
+        if not self._can_store_projection_matrices():
+            raise ValueError(
+                'The sampling is split into {0} blocks and max_nbytes is set:'
+                ' the peak sampling matrices of all the blocks cannot be store'
+                'd to have their values modified. Unset max_nbytes, whether th'
+                'e blocks come from it or from the block keyword.'.format(
+                    len(self.block)))
+
+    def _can_store_projection_matrices(self):
+        """
+        Return true if the peak sampling matrices of all the sampling blocks
+        can be held in memory at the same time.
+
+        """
+        return len(self.block) == 1 or self.max_nbytes is None
+
+    def _get_projection_shapeout(self):
+        """
+        Return the output shape of the peak sampling operator.
+
+        """
+        shapeout = (len(self.instrument), len(self.sampling))
+        if self.scene.kind != 'I':
+            shapeout += (len(self.scene.kind),)
+        return shapeout
+
+    def _get_operator_after_projection(self):
+        """
+        Return the operators of the acquisition which are applied after the
+        peak sampling and whose factors are not included in the matrices of
+        _get_projection_matrices: the HWP, the polarizer, the instrument
+        transmission and the detector response.
+
+        """
+        response = self.get_detector_response_operator()
+        trans_inst = self.instrument.get_transmission_operator()
+        polarizer = self.get_polarizer_operator()
+        hwp = self.get_hwp_operator()
+        with rule_manager(inplace=True):
+            L = CompositionOperator([response, trans_inst, polarizer, hwp])
+        if self.scene == 'QU':
+            L = self.get_subtract_grids_operator()(L)
+        return L
+
     def get_polarizer_operator(self):
         """
         Return operator for the polarizer grid.
@@ -383,15 +523,21 @@ class QubicAcquisition(Acquisition):
                 [f(self.sampling[b], self.scene, verbose=verbose)
                  for b in self.block], axisout=1)
 
-        # XXX HACK
-        def callback(i):
-            p = f(self.sampling[self.block[i]], self.scene, verbose=False)
-            return p
+        if self.max_nbytes is None:
+            # user-specified blocks: the matrix of one block at a time
+            def callback(i):
+                p = f(self.sampling[self.block[i]], self.scene, verbose=False)
+                return p
 
-        shapeouts = [(len(self.instrument), s.stop - s.start) +
-                     self.scene.shape[1:] for s in self.block]
-        proxies = proxy_group(len(self.block), callback, shapeouts=shapeouts)
-        return BlockColumnOperator(proxies, axisout=1)
+            shapeouts = [(len(self.instrument), s.stop - s.start) +
+                         self.scene.shape[1:] for s in self.block]
+            proxies = proxy_group(len(self.block), callback,
+                                  shapeouts=shapeouts)
+            return BlockColumnOperator(proxies, axisout=1)
+
+        # the whole matrix does not fit in max_nbytes: matrix-free operator
+        return self.instrument.get_projection_onthefly_operator(
+            self.sampling, self.scene, max_nbytes=self.max_nbytes)
 
     def get_add_grids_operator(self):
         """ Return operator to add signal from detector pairs. """
@@ -447,9 +593,13 @@ class QubicAcquisition(Acquisition):
 
         return tod
 
-    def tod2map(self, tod, d, cov=None):
+    def tod2map(self, tod, d, cov=None, x0=None):
         """
         Reconstruct map from tod
+
+        The PCG starts from x0 if specified, and if d['pcg_checkpoint'] is
+        a filename, its state is stored every d['pcg_checkpoint_every']
+        iterations and a preempted reconstruction resumes from it.
         """
         tol = d['tol']
         maxiter = d['maxiter']
@@ -461,10 +611,49 @@ class QubicAcquisition(Acquisition):
         A = H.T * invntt * H
         b = H.T * invntt * tod
 
-        preconditioner = self.get_preconditioner(cov)
-        solution = pcg(A, b, M=preconditioner, disp=verbose, tol=tol, maxiter=maxiter)
+        if d['preconditioner'] == 'block_jacobi':
+            preconditioner = self.get_block_preconditioner()
+        else:
+            preconditioner = self.get_preconditioner(cov)
+        solution = _pcg(A, b, x0=x0, M=preconditioner, disp=verbose, tol=tol,
+                        maxiter=maxiter, checkpoint=d['pcg_checkpoint'],
+                        checkpoint_every=d['pcg_checkpoint_every'] or 10,
+                        comm=self.comm)
         return solution['x'], solution['nit'], solution['error']
 
+    def tod2map_many(self, tods, d, cov=None):
+        """
+        Reconstruct maps from a stack of tods of shape (k, ndetectors, ntimes),
+        such as Monte Carlo noise realizations, by solving the k systems
+        together with a block conjugate gradient. The operators and the
+        preconditioner are built once for all the realizations, and each
+        chunk of the peak sampling matrix is read once for all of them at
+        each iteration (see _StackedNormalOperator).
+
+        Returns the maps of shape (k,) + scene shape, the number of iterations
+        and the relative residual of each map.
+
+        """
+        tol = d['tol']
+        maxiter = d['maxiter']
+        verbose = d['verbose']
+
+        invntt = self.get_invntt_operator()
+        A = _StackedNormalOperator(
+            [_get_matrices_getter(self._get_projection_matrices,
+                                  self._can_store_projection_matrices())],
+            self._get_operator_after_projection(),
+            self.get_distribution_operator(), invntt, self.scene.shape,
+            self._get_projection_shapeout())
+        B = A.get_rhs(tods)
+
+        if d['preconditioner'] == 'block_jacobi':
+            preconditioner = self.get_block_preconditioner()
+        else:
+            preconditioner = self.get_preconditioner(cov)
+        return _block_pcg(A, B, M=preconditioner, disp=verbose, tol=tol,
+                          maxiter=maxiter)
+
     def get_preconditioner(self, cov):
         if cov is not None:
             cov_inv = 1 / cov
@@ -474,6 +663,121 @@ class QubicAcquisition(Acquisition):
             preconditioner = None
         return preconditioner
 
+    def get_block_preconditioner(self, mask=None):
+        """
+        Return the block-Jacobi preconditioner, i.e. the inverse of the
+        per-pixel Stokes blocks of H.T * H (see get_preconditioner_blocks).
+
+        Parameter
+        ---------
+        mask : boolean array, optional
+            If specified, the preconditioner is restricted to the pixels
+            of value True, as for the acquisition acq[..., mask].
+
+        """
+        blocks = self.get_preconditioner_blocks()
+        if mask is not None:
+            blocks = blocks[mask]
+        return _get_block_jacobi_operator(blocks)
+
+    def get_preconditioner_blocks(self):
+        """
+        Return the per-pixel blocks of H.T * H, of shape
+        (npixels, nstokes, nstokes), computed in one pass over the peak
+        sampling matrix. The time response of the detectors is neglected.
+
+        """
+        nstokes = 1 if self.scene.kind == 'I' else len(self.scene.kind)
+        blocks = np.zeros((self.scene.shape[0], nstokes, nstokes))
+        for b, matrix in self._get_projection_matrices():
+            blocks += _get_pixel_blocks(
+                matrix, self._get_stokes_coefficients(self.sampling[b]),
+                self.scene.shape[0])
+        self.comm.Allreduce(MPI.IN_PLACE, as_mpi(blocks), op=MPI.SUM)
+        return blocks
+
+    def tod2map_binned(self, tod, rcond=1e-6):
+        """
+        Return the binned map, i.e. the solution of the weighted least squares
+        H.T N^-1 H x = H.T N^-1 tod in which only the per-pixel Stokes blocks
+        of H.T N^-1 H are kept. They are accumulated with H.T N^-1 tod in one
+        pass over the peak sampling matrix, N being the white detector noise.
+        The time response of the detectors is neglected.
+
+        map, hits, cond = acq.tod2map_binned(tod)
+
+        Parameters
+        ----------
+        tod : array-like
+            The Time-Ordered-Data of shape (ndetectors, ntimes).
+        rcond : float, optional
+            The pixels whose block has a condition number greater than
+            1 / rcond are set to zero in the map.
+
+        Returns
+        -------
+        map : I, QU or IQU maps
+            The binned map, which can also be used as PCG starting point.
+        hits : array
+            The number of synthetic beam peaks which hit each pixel.
+        cond : array
+            The condition number of the pixel blocks (inf if unobserved).
+
+        """
+        weights = _get_detector_weights(self.instrument)
+        nstokes = 1 if self.scene.kind == 'I' else len(self.scene.kind)
+        npixel = self.scene.shape[0]
+        blocks = np.zeros((npixel, nstokes, nstokes))
+        rhs = np.zeros((npixel, nstokes))
+        hits = np.zeros(npixel, int)
+        for b, matrix in self._get_projection_matrices():
+            blocks_, rhs_, hits_ = _bin_pixels(
+                matrix, self._get_stokes_coefficients(self.sampling[b]),
+                npixel, tod=tod[:, b], weights=weights)
+            blocks += blocks_
+            rhs += rhs_
+            hits += hits_
+        for array in blocks, rhs, hits:
+            self.comm.Allreduce(MPI.IN_PLACE, as_mpi(array), op=MPI.SUM)
+        x, cond = _solve_pixel_blocks(blocks, rhs, rcond=rcond)
+        return x.reshape(self.scene.shape), hits, cond
+
+    def _get_projection_matrices(self):
+        """
+        Iterate over the blocks of the sampling, returning the block and the
+        sparse matrix of its peak sampling operator including the scalar and
+        per-detector factors of the acquisition (see _get_projection_factors).
+
+        """
+        scalar, detector = self._get_projection_factors()
+        for b in self.block:
+            projection = self.instrument.get_projection_operator(
+                self.sampling[b], self.scene, verbose=False)
+            _scale_projection_matrix(projection.matrix, scalar * detector)
+            yield b, projection.matrix
+
+    def _get_stokes_coefficients(self, sampling):
+        """
+        Return the coefficients of shape (ndetectors, ntimes, nstokes) by
+        which the instrumental transmission, the polarizer and the half-wave
+        plate combine the Stokes parameters of the peak sampling into the
+        detector signal.
+
+        """
+        K = self.instrument.get_transmission_operator() * \
+            self.instrument.get_polarizer_operator(sampling, self.scene) * \
+            self.instrument.get_hwp_operator(sampling, self.scene)
+        shape = (len(self.instrument), len(sampling))
+        if self.scene.kind == 'I':
+            return K(np.ones(shape))[..., None]
+        nstokes = len(self.scene.kind)
+        out = np.empty(shape + (nstokes,))
+        for i in range(nstokes):
+            e = np.zeros(shape + (nstokes,))
+            e[..., i] = 1
+            out[..., i] = K(e)
+        return out
+
 
 class PlanckAcquisition(object):
     def __init__(self, band, scene, true_sky=None, factor=1, fwhm=0, mask=None, convolution_operator=None):
@@ -646,3 +950,598 @@ class QubicPlanckAcquisition(object):
         if convolution:
             return obs, obs_qubic_[1]
         return obs
+
+
+def _get_operator_scalar(op):
+    """
+    Return the factor of an operator which is a multiplication by a scalar.
+
+    """
+    if np.isscalar(op):
+        return op
+    if isinstance(op, DiagonalOperator) and np.size(op.data) == 1:
+        return float(op.data)
+    raise ValueError(
+        'The operator {0} is not a multiplication by a scalar. Check that the'
+        ' scene is not absolute.'.format(type(op).__name__))
+
+
+def _scale_projection_matrix(matrix, factor):
+    """
+    Multiply in place the values of a peak sampling FSR matrix by a factor
+    broadcastable to (ndetectors, ntimes).
+
+    """
+    factor = np.asarray(factor)
+    factor = factor.reshape(factor.shape + (1,) * (3 - factor.ndim))
+    data = matrix.data.reshape((factor.shape[0], -1, matrix.data.shape[-1]))
+    for name in data.dtype.names:
+        if name != 'index':
+            data[name] *= factor
+
+
+def _rotate_projection_matrix(matrix, cos, sin):
+    """
+    Left-multiply in place the blocks of a peak sampling FSR rotation matrix
+    by rotations of the polarization plane, specified by their cosine and sine
+    of shape (ndetectors, ntimes).
+
+    """
+    cos = np.asarray(cos)[..., None]
+    sin = np.asarray(sin)[..., None]
+    data = matrix.data.reshape(cos.shape[:2] + (matrix.data.shape[-1],))
+    if 'r22' in data.dtype.names:
+        r, s = data['r22'], data['r32']
+    else:
+        r, s = data['r11'], data['r21']
+    r_ = cos * r - sin * s
+    s *= cos
+    s += sin * r
+    r[...] = r_
+
+
+class _PCGState(object):
+    """
+    State of the conjugate gradient iterations, which is passed to the
+    callback in place of the pyoperators algorithm.
+
+    """
+    def __init__(self, x, r, p, z, delta, niterations, error,
+                 fingerprint=None):
+        self.x = x
+        self.r = r
+        self.p = p
+        self.z = z
+        self.delta = delta
+        self.niterations = niterations
+        self.error = error
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def get_fingerprint(A, b, tol):
+        """
+        Return the hash of the right-hand side, of the operator shape and of
+        the tolerance, which identifies the system of a checkpoint.
+
+        """
+        b = np.ascontiguousarray(b, float)
+        h = hashlib.sha1()
+        h.update(str((b.shape, getattr(A, 'shape', None), float(tol))).encode())
+        h.update(b.view(np.uint8))
+        return h.hexdigest()
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            fingerprint = str(f['fingerprint']) if 'fingerprint' in f.files \
+                else None
+            return cls(f['x'], f['r'], f['p'], f['z'], float(f['delta']),
+                       int(f['niterations']), float(f['error']), fingerprint)
+
+    def save(self, filename):
+        """
+        Store the state through a temporary file, so that a preempted job
+        never leaves a partially written checkpoint.
+
+        """
+        tmpname = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tmpname, 'wb') as f:
+            np.savez(f, x=self.x, r=self.r, p=self.p, z=self.z,
+                     delta=self.delta, niterations=self.niterations,
+                     error=self.error, fingerprint=self.fingerprint)
+        os.rename(tmpname, filename)
+
+
+def _pcg(A, b, x0=None, tol=1e-5, maxiter=300, M=None, disp=False,
+         callback=None, checkpoint=None, checkpoint_every=10, comm=None):
+    """
+    Preconditioned conjugate gradient, which returns the same solution
+    dictionary as pyoperators' pcg.
+
+    If the filename checkpoint is specified, the vectors x, r, p, z and the
+    iteration number are stored in it every checkpoint_every iterations and
+    at the end, and the iterations resume from it if the file exists. The
+    checkpoint is identified by a hash of b, of the shape of A and of tol: a
+    checkpoint of another system is discarded and the iterations start again
+    from x0, which is otherwise superseded by the stored solution.
+
+    Parameters
+    ----------
+    x0 : array, optional
+        The starting point, such as the solution of a previous realization or
+        a binned map.
+    comm : mpi4py.MPI.Comm, optional
+        Only the process of rank 0 writes the checkpoint.
+
+    """
+    if checkpoint is None:
+        return pcg(A, b, x0=x0, tol=tol, maxiter=maxiter, M=M, disp=disp,
+                   callback=callback)
+    if M is None:
+        M = IdentityOperator()
+    b = np.asarray(b)
+    b_norm = np.sqrt(np.sum(b**2))
+    if b_norm == 0:
+        b_norm = 1
+    fingerprint = _PCGState.get_fingerprint(A, b, tol)
+    state = None
+    if os.path.exists(checkpoint):
+        state = _PCGState.load(checkpoint)
+        if state.fingerprint != fingerprint:
+            state = None
+    if state is None:
+        x = np.zeros_like(b) if x0 is None else np.array(x0, float)
+        r = b - A(x) if x0 is not None else b.copy()
+        z = np.asarray(M(r))
+        state = _PCGState(x, r, z.copy(), z, np.sum(r * z), 0,
+                          np.sqrt(np.sum(r**2)) / b_norm, fingerprint)
+    write = comm is None or comm.rank == 0
+    while state.error > tol and state.niterations < maxiter:
+        q = np.asarray(A(state.p))
+        alpha = state.delta / np.sum(state.p * q)
+        state.x += alpha * state.p
+        state.r -= alpha * q
+        state.z = np.asarray(M(state.r))
+        delta_old = state.delta
+        state.delta = np.sum(state.r * state.z)
+        state.p *= state.delta / delta_old
+        state.p += state.z
+        state.niterations += 1
+        state.error = np.sqrt(np.sum(state.r**2)) / b_norm
+        if disp:
+            print('{:4}: {}'.format(state.niterations, state.error))
+        if callback is not None:
+            callback(state)
+        if write and state.niterations % checkpoint_every == 0:
+            state.save(checkpoint)
+    if write:
+        state.save(checkpoint)
+    return {'x': state.x, 'nit': state.niterations, 'error': state.error,
+            'algorithm': state}
+
+
+def _block_pcg(A, B, M=None, disp=False, tol=1e-5, maxiter=300):
+    """
+    Solve A X = B for k right-hand sides stacked along the first axis of B
+    with the breakdown-free block preconditioned conjugate gradient, in which
+    the search directions are shared by all the systems. A is applied once
+    per iteration to the search directions stacked along the first axis (see
+    _StackedNormalOperator) and M to each of them.
+
+    Returns the solutions, the number of iterations and the relative residual
+    of each system.
+
+    """
+    shape = B.shape
+    k = shape[0]
+    B = B.reshape((k, -1))
+    if M is None:
+        M = IdentityOperator()
+
+    def apply(op, V):
+        return np.array([np.asarray(op(v.reshape(shape[1:]))).ravel()
+                         for v in V])
+
+    X = np.zeros_like(B)
+    R = B.copy()
+    bnorm = np.sqrt(np.sum(B**2, axis=1))
+    bnorm[bnorm == 0] = 1
+    error = np.sqrt(np.sum(R**2, axis=1)) / bnorm
+    P = _orthonormalize(apply(M, R))
+    niterations = 0
+    while np.max(error) > tol and niterations < maxiter and len(P) > 0:
+        Q = np.asarray(A(P.reshape((-1,) + shape[1:]))).reshape((len(P), -1))
+        PQ_inv = np.linalg.pinv(np.dot(P, Q.T))
+        alpha = np.dot(PQ_inv, np.dot(P, R.T))
+        X += np.dot(alpha.T, P)
+        R -= np.dot(alpha.T, Q)
+        niterations += 1
+        error = np.sqrt(np.sum(R**2, axis=1)) / bnorm
+        if disp:
+            print('{:4}: {}'.format(niterations, np.max(error)))
+        Z = apply(M, R)
+        beta = -np.dot(PQ_inv, np.dot(Q, Z.T))
+        P = _orthonormalize(Z + np.dot(beta.T, P))
+    return X.reshape(shape), niterations, error
+
+
+def _orthonormalize(V, rcond=1e-10):
+    """
+    Return an orthonormal basis, stacked along the first axis, of the space
+    spanned by the vectors stacked along the first axis of V. The directions
+    whose norm is negligible are dropped.
+
+    """
+    U, s, _ = np.linalg.svd(V.T, full_matrices=False)
+    if len(s) == 0 or s[0] == 0:
+        return V[:0]
+    return U[:, s > rcond * s[0]].T
+
+
+def _get_matrices_getter(func, store):
+    """
+    Return a function returning the (block, matrix) pairs iterated over by
+    func. If store is true, the matrices are computed once and kept,
+    otherwise they are computed again by each call.
+
+    """
+    if not store:
+        return func
+    matrices = list(func())
+    return lambda: matrices
+
+
+class _StackedNormalOperator(object):
+    """
+    Normal matrix H.T N^-1 H applied to maps stacked along the first axis,
+    H being L P D with D the distribution operator, P the peak sampling (or
+    the sum over the reconstructed subbands of their peak samplings) and L
+    the operators applied after it. The peak samplings are the only operators
+    reading a sparse matrix: each chunk of their rows is read once for all the
+    stacked maps, which are passed along a trailing axis, while D, L and N^-1
+    are applied map by map.
+
+    """
+    def __init__(self, getters, left, distribution, invntt, shape, shapeout,
+                 subbands=False):
+        """
+        Parameters
+        ----------
+        getters : list of functions
+            For each subband, the function returning the (block, matrix)
+            pairs of the FSR matrices of the peak sampling, one per sampling
+            block, including the factors which commute with it.
+        left : Operator
+            The operator L applied after the peak samplings.
+        distribution : Operator
+            The distribution operator D applied to each map.
+        invntt : Operator
+            The inverse noise covariance N^-1.
+        shape : tuple
+            The scene shape.
+        shapeout : tuple
+            The output shape of the peak samplings.
+        subbands : boolean, optional
+            If true, the maps have a leading subband axis, of the same length
+            as getters.
+
+        """
+        self.getters = getters
+        self.left = left
+        self.distribution = distribution
+        self.invntt = invntt
+        self.shape = tuple(shape)
+        self.shapeout = tuple(shapeout)
+        self.subbands = subbands
+
+    def __call__(self, X):
+        Y = self.project(X)
+        N = self.left.T * self.invntt * self.left
+        return self.project_transpose(np.array([N(y) for y in Y]))
+
+    def get_rhs(self, tods):
+        """
+        Return H.T N^-1 tod for the tods stacked along the first axis.
+
+        """
+        N = self.left.T * self.invntt
+        return self.project_transpose(np.array([N(tod) for tod in tods]))
+
+    def project(self, X):
+        npixel = self.shape[0]
+        nd, nt = self.shapeout[:2]
+        nstokes = int(np.prod(self.shapeout[2:]))
+        X = np.asarray(X).reshape((-1, len(self.getters)) + self.shape)
+        k = X.shape[0]
+        out = np.zeros((nd, nt, nstokes, k))
+        for iband, getter in enumerate(self.getters):
+            x = np.array([self.distribution(x_) for x_ in X[:, iband]])
+            x = np.ascontiguousarray(
+                np.moveaxis(x.reshape((k, npixel, nstokes)), 0, -1))
+            for b, matrix in getter():
+                out[:, b] += _stacked_matvec(matrix, x).reshape(
+                    (nd, -1, nstokes, k))
+        return np.moveaxis(out, -1, 0).reshape((k,) + self.shapeout)
+
+    def project_transpose(self, Y):
+        npixel = self.shape[0]
+        nd, nt = self.shapeout[:2]
+        nstokes = int(np.prod(self.shapeout[2:]))
+        Y = np.asarray(Y).reshape((-1, nd, nt, nstokes))
+        k = Y.shape[0]
+        y = np.moveaxis(Y, 0, -1)
+        out = np.empty((k, len(self.getters)) + self.shape)
+        for iband, getter in enumerate(self.getters):
+            x = np.zeros((npixel, nstokes, k))
+            for b, matrix in getter():
+                x += _stacked_rmatvec(
+                    matrix, y[:, b].reshape((-1, nstokes, k)), npixel)
+            x = np.moveaxis(x, -1, 0).reshape((k,) + self.shape)
+            for i in range(k):
+                out[i, iband] = self.distribution.T(x[i])
+        if not self.subbands:
+            out = out[:, 0]
+        return out
+
+
+def _stacked_matvec(matrix, x, nrows_chunk=65536):
+    """
+    Multiply a peak sampling FSR matrix by maps of shape (npixel, nstokes, k)
+    stacked along the last axis, reading each chunk of rows of the matrix
+    once for all the maps. Returns an array of shape (nrows, nstokes, k).
+
+    """
+    nstokes = x.shape[1]
+    out = np.empty((matrix.data.size // matrix.data.shape[-1],) + x.shape[1:])
+    if nstokes > 1:
+        qu = x[:, -2] + 1j * x[:, -1]
+    for rows, intensity, polarization in _iter_csr_chunks(
+            matrix, x.shape[0], nrows_chunk):
+        o = out[rows]
+        if intensity is not None:
+            o[:, 0] = intensity.dot(x[:, 0])
+        if polarization is not None:
+            y = polarization.dot(qu)
+            o[:, -2] = y.real
+            o[:, -1] = y.imag
+    return out
+
+
+def _stacked_rmatvec(matrix, y, npixel, nrows_chunk=65536):
+    """
+    Multiply the transpose of a peak sampling FSR matrix by vectors of shape
+    (nrows, nstokes, k) stacked along the last axis, reading each chunk of
+    rows of the matrix once for all the vectors. Returns an array of shape
+    (npixel, nstokes, k).
+
+    """
+    nstokes, k = y.shape[1:]
+    out = np.zeros((npixel, nstokes, k))
+    if nstokes > 1:
+        qu = y[:, -2] + 1j * y[:, -1]
+        out_qu = np.zeros((npixel, k), complex)
+    for rows, intensity, polarization in _iter_csr_chunks(
+            matrix, npixel, nrows_chunk):
+        if intensity is not None:
+            out[:, 0] += intensity.T.dot(y[rows, 0])
+        if polarization is not None:
+            out_qu += polarization.T.conj().dot(qu[rows])
+    if nstokes > 1:
+        out[:, -2] = out_qu.real
+        out[:, -1] = out_qu.imag
+    return out
+
+
+def _iter_csr_chunks(matrix, npixel, nrows_chunk=65536):
+    """
+    Iterate over the chunks of rows of a peak sampling FSR matrix, returning
+    the slice of the rows of the chunk and its scipy CSR matrices acting on the
+    intensity and on the polarization Q + iU of the pixels, None if the
+    matrix has no such component. The rotation of the polarization by each
+    peak is a multiplication by a complex value, so that both matrices have
+    scalar entries and are applied to all the stacked vectors by scipy.
+
+    """
+    data = matrix.data.reshape((-1, matrix.data.shape[-1]))
+    names = data.dtype.names
+    ncolmax = data.shape[-1]
+    for start in range(0, data.shape[0], nrows_chunk):
+        d = data[start:start+nrows_chunk]
+        valid = d['index'] >= 0
+        index = np.where(valid, d['index'], 0).ravel()
+        indptr = np.arange(0, d.size + 1, ncolmax)
+
+        def csr(value):
+            return scipy.sparse.csr_matrix(
+                (np.where(valid, value, 0).ravel(), index, indptr),
+                shape=(d.shape[0], npixel))
+        rows = slice(start, start + d.shape[0])
+        if 'r22' in names:
+            yield rows, csr(d['r11']), csr(d['r22'] + 1j * d['r32'])
+        elif 'r21' in names:
+            yield rows, None, csr(d['r11'] + 1j * d['r21'])
+        else:
+            yield rows, csr(d['value']), None
+
+
+def _get_pixel_blocks(matrix, coefs, npixel, nrows_chunk=65536):
+    """
+    Return the per-pixel blocks (npixel, nstokes, nstokes) of the normal
+    matrix of a peak sampling FSR matrix combined with the Stokes coefficients
+    of shape (ndetectors, ntimes, nstokes). The contribution of each (detector,
+    time) row and peak is the outer product of its Stokes row vector, the
+    peaks of a row being assumed to fall into distinct pixels.
+
+    """
+    return _bin_pixels(matrix, coefs, npixel, nrows_chunk=nrows_chunk)[0]
+
+
+def _bin_pixels(matrix, coefs, npixel, tod=None, weights=1,
+                nrows_chunk=65536):
+    """
+    Accumulate by chunks of rows of a peak sampling FSR matrix combined with
+    the Stokes coefficients of shape (ndetectors, ntimes, nstokes):
+        - the per-pixel blocks (npixel, nstokes, nstokes) of the weighted
+          normal matrix,
+        - if the tod is specified, the per-pixel weighted projection of the
+          tod (npixel, nstokes),
+        - the number of peaks which hit each pixel.
+    The weights are broadcastable to (ndetectors, ntimes).
+
+    """
+    nstokes = coefs.shape[-1]
+    names = matrix.data.dtype.names
+    data = matrix.data.reshape((-1, matrix.data.shape[-1]))
+    weights = (weights * np.ones(coefs.shape[:2])).reshape((-1, 1))
+    coefs = coefs.reshape((-1, nstokes))
+    if tod is not None:
+        tod = np.asarray(tod).reshape((-1, 1))
+    blocks = np.zeros((npixel, nstokes, nstokes))
+    rhs = np.zeros((npixel, nstokes))
+    hits = np.zeros(npixel, int)
+    for start in range(0, data.shape[0], nrows_chunk):
+        d = data[start:start+nrows_chunk]
+        g = [coefs[start:start+nrows_chunk, i, None] for i in range(nstokes)]
+        if 'r22' in names:
+            rows = [g[0] * d['r11'],
+                    g[1] * d['r22'] + g[2] * d['r32'],
+                    g[2] * d['r22'] - g[1] * d['r32']]
+        elif 'r21' in names:
+            rows = [g[0] * d['r11'] + g[1] * d['r21'],
+                    g[1] * d['r11'] - g[0] * d['r21']]
+        else:
+            rows = [g[0] * d['value']]
+        valid = d['index'] >= 0
+        index = d['index'][valid]
+        w = (weights[start:start+nrows_chunk] * np.ones(d.shape))[valid]
+        rows = [r[valid] for r in rows]
+        for i in range(nstokes):
+            for j in range(i, nstokes):
+                blocks[:, i, j] += np.bincount(
+                    index, weights=rows[i] * rows[j] * w, minlength=npixel)
+        if tod is not None:
+            t = (tod[start:start+nrows_chunk] * np.ones(d.shape))[valid] * w
+            for i in range(nstokes):
+                rhs[:, i] += np.bincount(index, weights=rows[i] * t,
+                                         minlength=npixel)
+        hits += np.bincount(index, minlength=npixel)
+    for i in range(nstokes):
+        for j in range(i):
+            blocks[:, i, j] = blocks[:, j, i]
+    return blocks, rhs, hits
+
+
+def _get_detector_weights(instrument):
+    """
+    Return the inverse variance weights of the detector white noise, of shape
+    (ndetectors, 1), or uniform weights if the noise is not specified.
+
+    """
+    nep = np.ones(len(instrument)) * instrument.detector.nep
+    if not np.all(nep > 0):
+        return np.ones((len(instrument), 1))
+    return 1 / nep[:, None]**2
+
+
+def _solve_pixel_blocks(blocks, rhs, rcond=1e-6):
+    """
+    Solve the per-pixel systems blocks * x = rhs, of shapes
+    (npixel, nstokes, nstokes) and (npixel, nstokes). Return the solutions,
+    set to zero if the block condition number is greater than 1 / rcond,
+    and the condition numbers.
+
+    """
+    eig = np.linalg.eigvalsh(blocks)
+    cond = np.empty(len(blocks))
+    cond.fill(np.inf)
+    observed = eig[:, 0] > 0
+    cond[observed] = eig[observed, -1] / eig[observed, 0]
+    well = cond < 1 / rcond
+    x = np.zeros_like(rhs)
+    x[well] = np.linalg.solve(blocks[well], rhs[well][..., None])[..., 0]
+    return x, cond
+
+
+def _get_block_jacobi_operator(blocks, rcond=1e-6):
+    """
+    Return the operator which multiplies each pixel by the inverse of its
+    Stokes block. The unobserved pixels are set to zero and the pixels whose
+    block is ill-conditioned are preconditioned by the inverse of its diagonal.
+
+    """
+    nstokes = blocks.shape[-1]
+    diag = blocks[..., range(nstokes), range(nstokes)]
+    with np.errstate(divide='ignore'):
+        diag_inv = np.where(diag > 0, 1 / diag, 0)
+    if nstokes == 1:
+        return DiagonalOperator(diag_inv[..., 0], broadcast='rightward')
+    eig = np.linalg.eigvalsh(blocks)
+    well = eig[..., 0] > rcond * eig[..., -1]
+    inv = np.zeros_like(blocks)
+    inv[..., range(nstokes), range(nstokes)] = diag_inv
+    inv[well] = np.linalg.inv(blocks[well])
+    return DenseBlockDiagonalOperator(inv, shapein=blocks.shape[:-1])
+
+
+def _add_projection_matrix(merged, matrix):
+    """
+    Return the running sum of FSR matrices updated with a new matrix. Folding
+    the sub-frequency matrices one by one into the running sum, instead of
+    merging them all at once, only keeps one of them in memory at a time.
+
+    """
+    if merged is None:
+        return matrix
+    return _merge_projection_matrices([merged, matrix])
+
+
+def _merge_projection_matrices(matrices, nrows_chunk=65536):
+    """
+    Return the FSR matrix of the sum of FSR matrices of same shape and type.
+
+    In each row, the entries pointing to the same pixel are merged into one,
+    and the empty entries (negative index or null values) are discarded, so
+    that the number of columns of the output is at most the sum of those of
+    the inputs.
+
+    """
+    nrows = matrices[0].data.shape[0]
+    dtype = matrices[0].data.dtype
+    names = [name for name in dtype.names if name != 'index']
+    sentinel = np.iinfo(dtype['index']).max
+    chunks = []
+    for start in range(0, nrows, nrows_chunk):
+        data = np.concatenate(
+            [m.data[start:start+nrows_chunk] for m in matrices], axis=1)
+        index = np.where(data['index'] < 0, sentinel, data['index'])
+        null = np.ones(data.shape, bool)
+        for name in names:
+            null &= data[name] == 0
+        index[null] = sentinel
+        rows = np.arange(data.shape[0])[:, None]
+        isort = np.argsort(index, axis=1, kind='mergesort')
+        index = index[rows, isort]
+        data = data[rows, isort]
+        new = np.ones(index.shape, bool)
+        new[:, 1:] = index[:, 1:] != index[:, :-1]
+        column = np.cumsum(new, axis=1) - 1
+        valid = index != sentinel
+        ncolmax = column[valid].max() + 1 if np.any(valid) else 0
+        out = np.zeros((data.shape[0], ncolmax), dtype)
+        out['index'] = -1
+        iflat = np.nonzero(valid)[0] * ncolmax + column[valid]
+        out['index'].flat[iflat] = index[valid]
+        for name in names:
+            out[name] = np.bincount(
+                iflat, weights=data[name][valid],
+                minlength=out.size).reshape(out.shape)
+        chunks.append(out)
+    ncolmax = max(max(c.shape[1] for c in chunks), 1)
+    data = np.zeros((nrows, ncolmax), dtype)
+    data['index'] = -1
+    start = 0
+    for c in chunks:
+        data[start:start+c.shape[0], :c.shape[1]] = c
+        start += c.shape[0]
+    return type(matrices[0])(matrices[0].shape, ncolmax=ncolmax, data=data)
+
@@ -17,6 +17,8 @@ import scipy.signal as scsig
 from scipy import interpolate
 import datetime as dt
 import sys
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import healpy as hp
 
 
@@ -38,23 +40,42 @@ def read_cal_src_data(file_list, time_offset=7200):
     return t_src, data_src
 
 
-def bin_per_period(period, time, invec):
-    # Bins the vecors in in_list (assumed to be sampled with vector time) per period
-    # we label each data sample with a period
+def period_segments(period, time):
+    # Labels each sample with its modulation period and returns the order of the samples sorted by period,
+    # the index of the first sorted sample of each period and the number of samples in each period
     period_index = ((time - time[0]) / period).astype(int)
-    # We loop on periods to measure their respective amplitude and azimuth
-    allperiods = np.unique(period_index)
-    tper = np.zeros(len(allperiods))
-    nvec = np.shape(invec)[0]
-    nsamples = len(time)
-    newvecs = np.zeros((nvec, len(allperiods)))
-    for i in range(len(allperiods)):
-        ok = (period_index == allperiods[i])
-        tper[i] = np.mean(time[ok])
-        newvecs[:, i] = np.mean(invec[:, ok], axis=1)
+    isort = np.argsort(period_index, kind='mergesort')
+    starts = np.concatenate([[0], np.nonzero(np.diff(period_index[isort]))[0] + 1])
+    counts = np.diff(np.append(starts, len(time)))
+    return isort, starts, counts
+
+
+def bin_per_period(period, time, invec, verbose=False):
+    # Bins the vecors in in_list (assumed to be sampled with vector time) per period
+    # All the periods are averaged at once by summing the samples sorted by period
+    isort, starts, counts = period_segments(period, time)
+    tper = np.add.reduceat(time[isort], starts) / counts
+    newvecs = np.add.reduceat(np.asarray(invec)[:, isort], starts, axis=1) / counts
     return tper, newvecs
 
 
+def meancut_per_period(data, starts, counts, nsig):
+    # Sigma-clipped mean and dispersion, as in ft.meancut, of each period of the rows of data, whose samples
+    # are sorted by period (see period_segments). The clipping is iterated for all the periods at once
+    # until no sample is rejected.
+    segment = np.repeat(np.arange(len(starts)), counts)
+    keep = np.ones(data.shape, bool)
+    while True:
+        n = np.add.reduceat(keep.astype(float), starts, axis=1)
+        mean = np.add.reduceat(np.where(keep, data, 0), starts, axis=1) / n
+        dev = data - mean[:, segment]
+        std = np.sqrt(np.add.reduceat(np.where(keep, dev ** 2, 0), starts, axis=1) / n)
+        newkeep = keep & (np.abs(dev) <= nsig * std[:, segment])
+        if np.array_equal(newkeep, keep):
+            return mean, std
+        keep = newkeep
+
+
 def hf_noise_estimate(tt, dd):
     sh = np.shape(dd)
     if len(sh) == 1:
@@ -91,35 +112,20 @@ def return_rms_period(period, indata, others=None, verbose=False, remove_noise=F
     else:
         sh = np.shape(data)
         nTES = sh[0]
-    ### we label each data sample with a period
-    period_index = ((time - time[0]) / period).astype(int)
-    ### We loop on periods to measure their respective amplitude and azimuth
-    allperiods = np.unique(period_index)
-    tper = np.zeros(len(allperiods))
-    ampdata = np.zeros((nTES, len(allperiods)))
-    err_ampdata = np.zeros((nTES, len(allperiods)))
+    ### we label each data sample with a period and sort the samples by period
+    isort, starts, counts = period_segments(period, time)
+    tper = np.add.reduceat(time[isort], starts) / counts
     if others is not None:
         newothers = bin_per_period(period, time, others, verbose=verbose)
     if verbose:
-        printnow('Calculating RMS per period for {} periods and {} TES'.format(len(allperiods), nTES))
-    for i in range(len(allperiods)):
-        ok = (period_index == allperiods[i])
-        tper[i] = np.mean(time[ok])
-        if nTES == 1:
-            mm, ss = ft.meancut(data[ok], 3)
-            ampdata[0, i] = ss
-            err_ampdata[0, i] = 1
-        else:
-            for j in range(nTES):
-                mm, ss = ft.meancut(data[j, ok], 3)
-                ampdata[j, i] = ss
-                err_ampdata[j, i] = 1
+        printnow('Calculating RMS per period for {} periods and {} TES'.format(len(tper), nTES))
+    ### Sigma-clipped RMS for all TES and all periods at once
+    mm, ampdata = meancut_per_period(np.reshape(data, (nTES, -1))[:, isort], starts, counts, 3)
+    err_ampdata = np.ones((nTES, len(tper)))
 
     if remove_noise:
         hf_noise = hf_noise_estimate(time, data)
-        var_diff = np.zeros((nTES, len(tper)))
-        for k in range(nTES):
-            var_diff[k, :] = ampdata[k, :] ** 2 - hf_noise[k] ** 2
+        var_diff = ampdata ** 2 - hf_noise[:, None] ** 2
         ampdata = np.sqrt(np.abs(var_diff)) * np.sign(var_diff)
 
     if others is None:
@@ -371,12 +377,27 @@ def return_fit_period(period, indata, others=None, verbose=False, template=None)
 #         demodulated = demodulated[0,:]
 #     return timereturn, demodulated, demodulated*0+1
 
+def running_mean(data, size):
+    ### Moving average over size samples along the last axis, centered as
+    ### scsig.fftconvolve(data, np.ones(size) / size, mode='same'), from the cumulative sum of the data.
+    ### The samples outside the timeline count as zeros.
+    nsamples = data.shape[-1]
+    csum = np.zeros(data.shape[:-1] + (nsamples + 1,))
+    np.cumsum(data, axis=-1, dtype=float, out=csum[..., 1:])
+    last = np.arange(nsamples) + (size - 1) // 2 + 1
+    stop = np.minimum(last, nsamples)
+    start = np.maximum(last - size, 0)
+    return (csum[..., stop] - csum[..., start]) / size
+
+
 def demodulate_JC(period, indata, indata_src, others=None, verbose=False, template=None, quadrature=False,
-                  remove_noise=False, doplot=False):
+                  remove_noise=False, doplot=False, dtype=None, nthreads=None):
     ### Proper demodulation with quadrature method as an option: http://web.mit.edu/6.02/www/s2012/handouts/14.pdf
     ### In the case of quadrature demodulation, the HF noise RMS/sqrt(2) adds to the demodulated. 
     ### The option remove_noise=True
     ### estimates the HF noise in the TODs and removes it from the estimate in order to attempt to debias.
+    ### All the TES are demodulated at once, by blocks of TES shared by nthreads threads, and the products can
+    ### be computed in a lower precision dtype such as np.float32 to reduce the memory footprint.
     time = indata[0]
     data = indata[1]
     sh = data.shape
@@ -390,22 +411,31 @@ def demodulate_JC(period, indata, indata_src, others=None, verbose=False, templa
         data_src_shift = np.interp(time_src - period / 2, time_src, data_src, period=period)
 
     ### Now smooth over a period
-    import scipy.signal as scsig
     FREQ_SAMPLING = 1. / (time[1] - time[0])
     size_period = int(FREQ_SAMPLING * period) + 1
-    filter_period = np.ones((size_period,)) / size_period
-    demodulated = np.zeros_like(data)
+    if dtype is None:
+        dtype = data.dtype
+    if quadrature:
+        ### sqrt((d * src)**2 + (d * src_shift)**2) / sqrt(2) = |d| * sqrt((src**2 + src_shift**2) / 2)
+        src = np.sqrt((data_src ** 2 + data_src_shift ** 2) / 2).astype(dtype)
+    else:
+        src = np.asarray(data_src, dtype)
     sh = np.shape(data)
-    # bar=progress_bar(sh[0], 'Filtering Detectors: ')
-    for i in range(sh[0]):
-        # bar.update()
-        if quadrature:
-            demodulated[i, :] = scsig.fftconvolve(
-                (np.sqrt((data[i, :] * data_src) ** 2 + (data[i, :] * data_src_shift) ** 2)) / np.sqrt(2),
-                filter_period, mode='same')
-        else:
-            demodulated[i, :] = scsig.fftconvolve(data[i, :] * data_src,
-                                                  filter_period, mode='same')
+    demodulated = np.empty(sh, dtype)
+
+    def demodulate_block(sl):
+        block = np.abs(data[sl], dtype=dtype) if quadrature else data[sl].astype(dtype)
+        block *= src
+        demodulated[sl] = running_mean(block, size_period)
+
+    if nthreads is None:
+        nthreads = min(sh[0], cpu_count())
+    nblock = max(1, min(64, int(np.ceil(sh[0] / nthreads))))
+    pool = ThreadPool(nthreads)
+    try:
+        pool.map(demodulate_block, [slice(i, i + nblock) for i in range(0, sh[0], nblock)])
+    finally:
+        pool.close()
 
     # Remove First and last periods
     nper = 4.
@@ -415,9 +445,7 @@ def demodulate_JC(period, indata, indata_src, others=None, verbose=False, templa
 
     if remove_noise:
         hf_noise = hf_noise_estimate(time, data) / np.sqrt(2)
-        var_diff = np.zeros((sh[0], len(timereturn)))
-        for k in range(sh[0]):
-            var_diff[k, :] = demodulated[k, :] ** 2 - hf_noise[k] ** 2
+        var_diff = demodulated ** 2 - hf_noise[:, None] ** 2
         demodulated = np.sqrt(np.abs(var_diff)) * np.sign(var_diff)
 
     if doplot:
@@ -450,7 +478,7 @@ def demodulate_JC(period, indata, indata_src, others=None, verbose=False, templa
 
 
 def demodulate_methods(data_in, fmod, fourier_cuts=None, verbose=False, src_data_in=None, method='demod',
-                       others=None, template=None, remove_noise=False):
+                       others=None, template=None, remove_noise=False, dtype=None, nthreads=None):
     # Various demodulation methods
     # Others is a list of other vectors (with similar time sampling as the data to demodulate)
     # that we need to sample the same way as the data
@@ -485,14 +513,140 @@ def demodulate_methods(data_in, fmod, fourier_cuts=None, verbose=False, src_data
     elif method == 'fit':
         return return_fit_period(period, data, others=others, verbose=verbose, template=template)
     elif method == 'demod':
-        return demodulate_JC(period, data, src_data, others=others, verbose=verbose, template=None)
+        return demodulate_JC(period, data, src_data, others=others, verbose=verbose, template=None,
+                             dtype=dtype, nthreads=nthreads)
     elif method == 'demod_quad':
         return demodulate_JC(period, data, src_data, others=others, verbose=verbose, template=None,
-                             quadrature=True, remove_noise=remove_noise)
+                             quadrature=True, remove_noise=remove_noise, dtype=dtype, nthreads=nthreads)
     elif method == 'absolute_value':
         return np.abs(data)
 
 
+class StreamingDemodulator:
+    """
+    Incremental demodulation of time-ordered chunks (t, data, src), for instance to monitor a calibration
+    scan while it is acquired. The data and the source are filtered as in ft.filter_data without rebinning
+    (the sampling is assumed regular), the state of the filters being kept from one chunk to the next.
+    The demodulated signal is averaged over each modulation period, the periods being counted from the
+    first sample as in bin_per_period, and returned as soon as they are complete. Only the samples of the
+    last incomplete period are kept between two calls, so the memory does not grow with the acquisition.
+
+    demod = StreamingDemodulator(1. / fmod, lowcut=0.3, highcut=10., fsampling=fs)
+    for t, data, src in chunks:
+        tper, amplitude = demod.update(t, data, src)
+    tper, amplitude = demod.flush()
+    """
+
+    def __init__(self, period, lowcut=None, highcut=None, fsampling=None, notch=None, order=5,
+                 quadrature=False):
+        ### If fsampling is None, it is estimated from the first chunk as in ft.filter_data.
+        ### notch has the format of ft.filter_data: a list of (frequency, bandwidth, number of harmonics).
+        self.period = period
+        self.lowcut = lowcut
+        self.highcut = highcut
+        self.fsampling = fsampling
+        self.notch = notch
+        self.order = order
+        self.quadrature = quadrature
+        self.reset()
+
+    def reset(self):
+        ### Forget the filter states and the buffered samples to start a new stream
+        self.sos = None
+        self._t0 = None
+        self._zi_data = None
+        self._zi_src = None
+        self._t = None
+        self._demod = None
+        self._t_src = None
+        self._src = None
+
+    def _get_sos(self, fsampling):
+        ### Bandpass and notch filters as second-order sections, so that they are applied as one cascade
+        sos = []
+        if self.lowcut is not None and self.highcut is not None:
+            sos.append(scsig.butter(self.order, [2 * self.lowcut / fsampling, 2 * self.highcut / fsampling],
+                                    btype='bandpass', output='sos'))
+        if self.notch is not None:
+            for ftocut, bw, nharmonics in self.notch:
+                for j in range(int(nharmonics)):
+                    b, a = scsig.iirnotch(ftocut * (j + 1) / fsampling * 2, ftocut * (j + 1) / bw)
+                    sos.append(scsig.tf2sos(b, a))
+        if len(sos) == 0:
+            return None
+        return np.concatenate(sos)
+
+    def _start(self, t, ntes):
+        if self.fsampling is None:
+            self.fsampling = 1. / ((np.max(t) - np.min(t)) / len(t))
+        self.sos = self._get_sos(self.fsampling)
+        if self.sos is not None:
+            self._zi_data = np.zeros((len(self.sos), ntes, 2))
+            self._zi_src = np.zeros((len(self.sos), 2))
+        self._t0 = t[0]
+        self._t = np.zeros(0)
+        self._demod = np.zeros((ntes, 0))
+        self._t_src = np.zeros(0)
+        self._src = np.zeros(0)
+
+    def update(self, t, data, src):
+        ### Adds a chunk of nsamples times t, data (nsamples) or (nTES, nsamples) and source signal src
+        ### (nsamples) sampled at the same times as the data. Returns the mean time and the demodulated
+        ### amplitude of the periods completed by this chunk (possibly none).
+        t = np.asarray(t, dtype=float)
+        self._ndim = np.ndim(data)
+        data = np.reshape(data, (-1, len(t)))
+        src = np.asarray(src, dtype=float)
+        if self._t0 is None:
+            self._start(t, data.shape[0])
+        if self.sos is not None:
+            data, self._zi_data = scsig.sosfilt(self.sos, data, axis=-1, zi=self._zi_data)
+            src, self._zi_src = scsig.sosfilt(self.sos, src, zi=self._zi_src)
+        if self.quadrature:
+            ### The source shifted by half a period is interpolated on the previous samples of the source
+            t_src = np.concatenate((self._t_src, t))
+            all_src = np.concatenate((self._src, src))
+            src_shift = np.interp(t - self.period / 2, t_src, all_src)
+            keep = t_src > t[-1] - self.period
+            self._t_src = t_src[keep]
+            self._src = all_src[keep]
+            demod = np.abs(data) * np.sqrt((src ** 2 + src_shift ** 2) / 2)
+        else:
+            demod = data * src
+        self._t = np.concatenate((self._t, t))
+        self._demod = np.concatenate((self._demod, demod), axis=1)
+        ### The last period may still receive samples from the next chunk
+        period_index = ((self._t - self._t0) / self.period).astype(int)
+        return self._emit(np.searchsorted(period_index, period_index[-1]))
+
+    def flush(self):
+        ### Returns the last incomplete period and resets the demodulator
+        if self._t0 is None:
+            return np.zeros(0), np.zeros(0)
+        result = self._emit(len(self._t))
+        self.reset()
+        return result
+
+    def _emit(self, nsamples):
+        ### Averages the first nsamples buffered samples per period and removes them from the buffer
+        t = self._t[:nsamples]
+        demod = self._demod[:, :nsamples]
+        self._t = self._t[nsamples:]
+        self._demod = self._demod[:, nsamples:]
+        if nsamples == 0:
+            tper = np.zeros(0)
+            amplitude = np.zeros((demod.shape[0], 0))
+        else:
+            period_index = ((t - self._t0) / self.period).astype(int)
+            starts = np.concatenate([[0], np.nonzero(np.diff(period_index))[0] + 1])
+            counts = np.diff(np.append(starts, nsamples))
+            tper = np.add.reduceat(t, starts) / counts
+            amplitude = np.add.reduceat(demod, starts, axis=1) / counts
+        if self._ndim == 1:
+            amplitude = amplitude[0]
+        return tper, amplitude
+
+
 def demodulate_old(indata, fmod, lowcut=None, highcut=None, verbose=False):
     printnow('Starting Demodulation')
     if indata['data'].ndim == 1:
@@ -734,23 +888,11 @@ def general_demodulate(period, indata, lowcut, highcut, nbins=150, median=True,
     if rebin:
         ### Now rebin the data
         if verbose: printnow('Now rebin the data')
-        if indata['data'].ndim == 1:
-            sh = [1, len(indata['data'])]
-        else:
-            sh = np.shape(indata['data'])
-        ang = np.zeros(nbins)
-        sb = np.zeros((sh[0], nbins))
-        dsb = np.zeros((sh[0], nbins))
-        others = np.zeros((nbins, 2))
-        for i in range(sh[0]):
-            if verbose:
-                if (16 * (i / 16)) == i:
-                    printnow('Rebinning TES {} over {}'.format(i, sh[0]))
-            ang, sb[i, :], dang, dsb[i, :], others = ft.profile(unbinned['az_ang'],
-                                                                unbinned['sb'][i, :], nbins=nbins, plot=False,
-                                                                dispersion=True, log=False, median=median,
-                                                                cutbad=False, rebin_as_well=[unbinned['az'],
-                                                                                             unbinned['el']])
+        ### All the TES are rebinned at once
+        allsb = np.reshape(unbinned['sb'], (-1, len(unbinned['az_ang'])))
+        ang, sb, dang, dsb, others = ft.profile(unbinned['az_ang'], allsb,
+                                                nbins=nbins, plot=False, dispersion=True, log=False, median=median,
+                                                cutbad=False, rebin_as_well=[unbinned['az'], unbinned['el']])
         binned = {}
         binned['az'] = others[:, 0]
         binned['el'] = others[:, 1]
@@ -848,21 +990,75 @@ def renorm(ar):
     return (ar - np.mean(ar)) / np.std(ar)
 
 
-def bin_image_elscans(x, y, data, xr, nx, TESIndex):
+class PixelCoadder:
+    """
+    Coaddition of the samples of nTES detectors into npix pixels, for all the detectors at once with
+    np.bincount on the flat (TES, pixel) index. The samples can be added in several chunks; the weighted
+    sums are accumulated so that the maps, the hit counts and the variance in each pixel are obtained in
+    a single pass over the data.
+
+    coadder = PixelCoadder(npix, nTES)
+    for pixels, data in chunks:
+        coadder.add(pixels, data)
+    maps, hits, variance = coadder.get_maps()
+    """
+
+    def __init__(self, npix, nTES=1):
+        self.npix = npix
+        self.nTES = nTES
+        self.hits = np.zeros(npix)
+        self.sumw = np.zeros((nTES, npix))
+        self.sumwd = np.zeros((nTES, npix))
+        self.sumwd2 = np.zeros((nTES, npix))
+
+    def add(self, pixels, data, weights=None):
+        ### pixels: (nsamples) pixel index of the samples, those outside [0, npix[ are ignored
+        ### data: (nsamples) or (nTES, nsamples)
+        ### weights: None, (nsamples) or (nTES, nsamples)
+        ### The ignored samples are sent to an extra pixel rather than removed, which would copy the data.
+        data = np.reshape(data, (self.nTES, -1))
+        pixels = np.where((pixels >= 0) & (pixels < self.npix), pixels, self.npix)
+        index = (pixels + (self.npix + 1) * np.arange(self.nTES)[:, None]).ravel()
+
+        def accumulate(values):
+            sums = np.bincount(index, weights=values.ravel(), minlength=self.nTES * (self.npix + 1))
+            return np.reshape(sums, (self.nTES, self.npix + 1))[:, :self.npix]
+
+        hits = np.bincount(pixels, minlength=self.npix + 1)[:self.npix]
+        self.hits += hits
+        if weights is None:
+            self.sumw += hits
+            wd = data
+        else:
+            weights = np.broadcast_to(np.reshape(weights, (-1, data.shape[1])), data.shape)
+            self.sumw += accumulate(weights)
+            wd = weights * data
+        self.sumwd += accumulate(wd)
+        self.sumwd2 += accumulate(wd * data)
+
+    def get_maps(self):
+        ### Returns the weighted mean and variance of the samples in each pixel (nTES, npix), zero in the
+        ### empty pixels, and the number of samples in each pixel (npix)
+        ok = self.sumw != 0
+        maps = np.zeros((self.nTES, self.npix))
+        variance = np.zeros((self.nTES, self.npix))
+        maps[ok] = self.sumwd[ok] / self.sumw[ok]
+        variance[ok] = np.maximum(self.sumwd2[ok] / self.sumw[ok] - maps[ok] ** 2, 0)
+        return maps, self.hits, variance
+
+
+def bin_image_elscans(x, y, data, xr, nx, TESIndex, weights=None):
     ny = len(y)
-    mapsum = np.zeros((nx, ny))
-    mapcount = np.zeros((nx, ny))
+    coadder = PixelCoadder(nx * ny)
     for i in range(ny):
-        thex = x[i]
         dd = data[i] - np.mean(data[i], axis=0)
-        idx = ((thex - xr[0]) / (xr[1] - xr[0]) * nx).astype(int)
-        for j in range(len(thex)):
-            if ((idx[j] >= 0) & (idx[j] < nx)):
-                mapsum[idx[j], i] += dd[TESIndex, j]
-                mapcount[idx[j], i] += 1.
-    mapout = np.zeros((nx, ny))
-    ok = mapcount > 0
-    mapout[ok] = mapsum[ok] / mapcount[ok]
+        idx = ((x[i] - xr[0]) / (xr[1] - xr[0]) * nx).astype(int)
+        ### Pixels outside [0, nx[ are flagged as -1 so that they are not wrapped to the next scan
+        pixels = np.where((idx >= 0) & (idx < nx), idx * ny + i, -1)
+        coadder.add(pixels, dd[TESIndex], weights=None if weights is None else weights[i])
+    mapout, mapcount, _ = coadder.get_maps()
+    mapout = np.reshape(mapout, (nx, ny))
+    ok = np.reshape(mapcount, (nx, ny)) > 0
     xx = np.linspace(xr[0], xr[1], nx + 1)
     xx = 0.5 * (xx[1:] + xx[:-1])
     mm, ss = ft.meancut(mapout[ok], 3)
@@ -870,19 +1066,19 @@ def bin_image_elscans(x, y, data, xr, nx, TESIndex):
     return np.flip(mapout.T, axis=(0, 1)), xx, y
 
 
-def scan2hpmap(ns, azdeg, eldeg, data):
-    coadd = np.zeros(12 * ns ** 2)
-    count = np.zeros(12 * ns ** 2)
+def scan2hpmap(ns, azdeg, eldeg, data, weights=None):
+    ### data can be (nsamples) or (nTES, nsamples)
     ip = hp.ang2pix(ns, np.pi / 2 - np.radians(eldeg), np.radians(azdeg))
-    for i in range(len(azdeg)):
-        coadd[ip[i]] += data[i]
-        count[ip[i]] += 1
+    nTES = 1 if np.ndim(data) == 1 else len(data)
+    coadder = PixelCoadder(12 * ns ** 2, nTES)
+    coadder.add(ip, data, weights=weights)
+    sbmap, count, _ = coadder.get_maps()
     ok = count != 0
-    sbmap = np.zeros(12 * ns ** 2)
-    sbmap[ok] = coadd[ok] / count[ok]
-    mm, ss = ft.meancut(sbmap[ok], 3)
-    sbmap[ok] -= mm
-    sbmap[~ok] = 0
+    for k in range(nTES):
+        mm, ss = ft.meancut(sbmap[k, ok], 3)
+        sbmap[k, ok] -= mm
+    if np.ndim(data) == 1:
+        return sbmap[0]
     return sbmap
 
 
@@ -1441,7 +1637,7 @@ def hwp_fitpol(thvals, ampvals, ampvals_err, doplot=False, str_title=None, satur
 
 def coadd_flatmap(datain, az, el,
                   azmin=None, azmax=None, elmin=None, elmax=None, naz=50, nel=50,
-                  filtering=None, silent=False, remove_eltrend=True):
+                  filtering=None, silent=False, remove_eltrend=True, weights=None):
     if azmin is None:
         azmin = np.min(az)
     if azmax is None:
@@ -1478,28 +1674,16 @@ def coadd_flatmap(datain, az, el,
 
     ### Keeping only the inner part
     inside = (azindex >= 0) & (azindex < naz) & (elindex >= 0) & (elindex < nel)
-    data = data[:, inside]
-    azindex = azindex[inside]
-    elindex = elindex[inside]
-    nsamples = inside.sum()
+    pixels = np.where(inside, elindex * naz + azindex, -1)
 
     if not silent:
         print('Making maps')
-    mapdata = np.zeros((nTES, nel, naz))
-    mapcount = np.zeros((nTES, nel, naz))
-
-    for i in range(nsamples):
-        mapdata[:, elindex[i], azindex[i]] += data[:, i]
-        mapcount[:, elindex[i], azindex[i]] += 1
-
-    themap = np.zeros((nTES, nel, naz))
-    ok = mapcount != 0
-    themap[ok] = mapdata[ok] / mapcount[ok]
+    coadder = PixelCoadder(nel * naz, nTES)
+    coadder.add(pixels, data, weights=weights)
+    themap = np.reshape(coadder.get_maps()[0], (nTES, nel, naz))
 
     if remove_eltrend:
-        for k in range(nTES):
-            for iel in range(nel):
-                themap[k, iel, :] -= np.median(themap[k, iel, :])
+        themap -= np.median(themap, axis=2)[:, :, None]
 
     if nTES == 1:
         return themap[0, :, :], map_az, map_el
@@ -9,6 +9,7 @@ import sys
 
 import scipy.signal as scsig
 import scipy.stats
+import scipy.linalg
 from scipy.ndimage.filters import correlate1d, gaussian_filter1d
 import glob
 from astropy.io import fits
@@ -116,20 +117,50 @@ def thepolynomial(x, pars):
 class MyChi2:
     """
     Class defining the minimizer and the data
+    covarin is either the (N, N) covariance matrix of the data, whose Cholesky factor is computed once, or
+    the (N) error bars of uncorrelated data, which are kept as a vector.
     """
 
     def __init__(self, xin, yin, covarin, functname, extra_args=None):
         self.x = xin
         self.y = yin
         self.covar = covarin
-        self.invcov = np.linalg.inv(covarin)
         self.functname = functname
         self.extra_args = extra_args
+        if np.ndim(covarin) == 1:
+            self.invsigma = 1. / np.asarray(covarin)
+            self.cholesky = None
+        else:
+            self.invsigma = None
+            self.cholesky = np.linalg.cholesky(covarin)
+        self.residuals = np.empty(np.shape(yin))
+
+    def _get_keywords(self):
+        ### extra_args is only passed to the model (and its gradient) if it is specified
+        if self.extra_args is None:
+            return {}
+        return {'extra_args': self.extra_args}
 
     def __call__(self, *pars):
-        val = self.functname(self.x, pars, extra_args=self.extra_args)
-        chi2 = np.dot(np.dot(self.y - val, self.invcov), self.y - val)
-        return chi2
+        val = self.functname(self.x, pars, **self._get_keywords())
+        res = np.subtract(self.y, val, out=self.residuals)
+        if self.cholesky is None:
+            res *= self.invsigma
+        else:
+            res = scipy.linalg.solve_triangular(self.cholesky, res, lower=True, overwrite_b=True)
+        return np.dot(res, res)
+
+    def grad(self, *pars):
+        ### Analytic gradient of the chi2, for a functname with a gradient method returning the (npars, N)
+        ### derivatives of the model with respect to the parameters
+        val = self.functname(self.x, pars, **self._get_keywords())
+        jac = self.functname.gradient(self.x, pars, **self._get_keywords())
+        res = self.y - val
+        if self.cholesky is None:
+            res *= self.invsigma ** 2
+        else:
+            res = scipy.linalg.cho_solve((self.cholesky, True), res, overwrite_b=True)
+        return -2 * np.dot(jac, res)
 
 
 class MyChi2_nocov:
@@ -141,18 +172,25 @@ class MyChi2_nocov:
         self.x = xin
         self.y = yin
         self.functname = functname
+        self.residuals = np.empty(np.shape(yin))
 
     def __call__(self, *pars):
         val = self.functname(self.x, pars)
-        chi2 = np.sum((self.y - val) ** 2)
-        # chi2 = np.dot(self.y - val, self.y - val)
+        res = np.subtract(self.y, val, out=self.residuals)
+        chi2 = np.dot(res, res)
         return chi2
 
+    def grad(self, *pars):
+        ### Analytic gradient of the chi2, for a functname with a gradient method (see MyChi2.grad)
+        val = self.functname(self.x, pars)
+        jac = self.functname.gradient(self.x, pars)
+        return -2 * np.dot(jac, self.y - val)
+
 
 ### Call Minuit
 def do_minuit(x, y, covarin, guess, functname=thepolynomial, fixpars=None, chi2=None, rangepars=None, nohesse=False,
               force_chi2_ndf=False, verbose=True, minos=False, extra_args=None, print_level=0, force_diag=False,
-              nsplit=1, ncallmax=10000, precision=None):
+              nsplit=1, ncallmax=10000, precision=None, use_gradient=True):
     """
 
     Parameters
@@ -168,20 +206,18 @@ def do_minuit(x, y, covarin, guess, functname=thepolynomial, fixpars=None, chi2=
     nohesse
     force_chi2_ndf
     verbose
+    use_gradient : bool
+        If True and functname has a gradient method, Minuit is given the analytic gradient of the chi2.
 
     Returns
     -------
 
     """
-    # check if covariance or error bars were given
+    # check if covariance or error bars were given: error bars are kept as a vector, and force_diag
+    # only keeps the error bars of a covariance matrix
     covar = covarin.copy()
-    if np.size(np.shape(covarin)) == 1:
-        if force_diag:
-            covar = covarin.copy()
-        else:
-            err = covarin
-            covar = np.zeros((np.size(err), np.size(err)))
-            covar[np.arange(np.size(err)), np.arange(np.size(err))] = err ** 2
+    if force_diag and np.ndim(covarin) == 2:
+        covar = np.sqrt(np.diag(covarin))
     # instantiate minimizer
     if chi2 is None:
         chi2 = MyChi2(x, y, covar, functname, extra_args=extra_args)
@@ -228,7 +264,12 @@ def do_minuit(x, y, covarin, guess, functname=thepolynomial, fixpars=None, chi2=
         if rangepars is not None:
             for k in drng.keys(): theguess[k] = drng[k]
         theargs.update(theguess)
-    m = iminuit.Minuit(chi2, forced_parameters=parnames, errordef=1., print_level=print_level, **theargs)
+    if use_gradient and hasattr(functname, 'gradient') and hasattr(chi2, 'grad'):
+        grad = chi2.grad
+    else:
+        grad = None
+    m = iminuit.Minuit(chi2, forced_parameters=parnames, errordef=1., print_level=print_level, grad=grad,
+                       **theargs)
     m.migrad(ncall=ncallmax * nsplit, nsplit=nsplit, precision=precision)
     # print('Migrad Done')
     if minos:
@@ -279,14 +320,155 @@ def do_minuit(x, y, covarin, guess, functname=thepolynomial, fixpars=None, chi2=
 # ##############################################################################
 
 
+def _get_bin_index(x, bins):
+    """
+    Index of the bin of each sample of x, such that bins[index] < x < bins[index + 1].
+    The samples outside the bins, on the edges or non-finite are given the index -1.
+
+    """
+    index = np.searchsorted(bins, x, side='right') - 1
+    inside = (index >= 0) & (index < len(bins) - 1)
+    inside[inside] = x[inside] != bins[index[inside]]
+    index[~inside] = -1
+    return index
+
+
+def binned_statistics(x, y, bins, clip=None, median=False, mode=False, others=None):
+    """
+    Statistics of the samples of all the rows of y in bins of x, computed at once with np.bincount on the
+    flat (row, bin) index, and from the samples sorted by row, bin and value for the median.
+    The non-finite samples of y are ignored.
+
+    Parameters
+    ----------
+    x : array (N)
+    y : array (N) or (nrows, N)
+    bins : array (nbins + 1)
+        Increasing bin edges. A sample is in bin i if bins[i] < x < bins[i + 1].
+    clip : float, optional
+        If set, the statistics of the samples are also computed after the iterated sigma-clipping of
+        scipy.stats.sigmaclip(low=clip, high=clip) in each bin.
+    median : bool, optional
+        If True, the median of the samples in each bin is also computed.
+    mode : bool, optional
+        If True, the mode of the samples in each bin is also computed: the center of the most populated bin
+        of their histogram in min(n / 30, 100) bins (at least one) over 5 sigma around their 3-sigma clipped
+        mean, sigma being their 3-sigma clipped standard deviation (see meancut).
+    others : list of arrays (N), optional
+        Vectors averaged in each bin over the samples of x (and of y if y is 1-D) that are used.
+
+    Returns
+    -------
+    stats : dict
+        'n', 'mean', 'std', 'xmean', 'xstd': number of samples, mean and standard deviation of y and x in
+        each bin, as (nrows, nbins) arrays or (nbins) if y is 1-D. The empty bins are set to NaN.
+        'median' if median is True.
+        'mode' if mode is True.
+        'n_clip', 'mean_clip', 'std_clip' if clip is not None.
+        'others' (nbins, nothers) if others is not None.
+
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    nbins = len(bins) - 1
+    y2 = np.reshape(y, (-1, len(x)))
+    nrows = len(y2)
+    index = _get_bin_index(x, bins)
+    use = (index >= 0) & np.isfinite(y2)
+    flat = (index + nbins * np.arange(nrows)[:, None])[use]
+    yu = y2[use]
+    xu = np.broadcast_to(x, y2.shape)[use]
+    size = nrows * nbins
+
+    def binsum(values):
+        return np.bincount(flat, weights=values, minlength=size)
+
+    def moments(values, weights):
+        n = binsum(weights)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = binsum(weights * values) / n
+            std = np.sqrt(binsum(weights * (values - mean[flat]) ** 2) / n)
+        return n, mean, std
+
+    shape = y.shape[:-1] + (nbins,)
+    ones = np.ones(len(yu))
+    stats = {}
+    n, stats['mean'], stats['std'] = moments(yu, ones)
+    stats['n'] = n
+    _, stats['xmean'], stats['xstd'] = moments(xu, ones)
+
+    def sigma_clip(nsig):
+        ### Iterated until no sample is rejected, as scipy.stats.sigmaclip
+        keep = ones
+        while True:
+            nclip, mean, std = moments(yu, keep)
+            newkeep = keep * ((yu >= mean[flat] - nsig * std[flat]) & (yu <= mean[flat] + nsig * std[flat]))
+            if np.array_equal(newkeep, keep):
+                return nclip, mean, std
+            keep = newkeep
+
+    if clip is not None:
+        stats['n_clip'], stats['mean_clip'], stats['std_clip'] = sigma_clip(clip)
+
+    if median:
+        order = np.lexsort((yu, flat))
+        ysorted = yu[order]
+        starts = np.searchsorted(flat[order], np.arange(size))
+        nn = n.astype(int)
+        full = nn > 0
+        med = np.full(size, np.nan)
+        med[full] = 0.5 * (ysorted[starts[full] + (nn[full] - 1) // 2] + ysorted[starts[full] + nn[full] // 2])
+        stats['median'] = med
+
+    if mode:
+        ### np.histogram(y, bins=nh, range=[lo, hi]) of all the (row, bin) at once
+        _, mean, std = sigma_clip(3)
+        nh = np.maximum(np.minimum(n / 30, 100).astype(int), 1)
+        lo = mean - 5 * std
+        hi = mean + 5 * std
+        degenerate = lo == hi
+        lo[degenerate] -= 0.5
+        hi[degenerate] += 0.5
+        full = n > 0
+        step = np.where(full, (hi - lo) / nh, 1)
+        h = ((yu - lo[flat]) * (nh[flat] / np.where(full, hi - lo, 1)[flat])).astype(int)
+        h = np.clip(h, 0, nh[flat] - 1)
+        ### Same rounding corrections as np.histogram on the edges of np.linspace(lo, hi, nh + 1)
+        h[yu < h * step[flat] + lo[flat]] -= 1
+        upper = np.where(h + 1 == nh[flat], hi[flat], (h + 1) * step[flat] + lo[flat])
+        h[(yu >= upper) & (h != nh[flat] - 1)] += 1
+        inside = (yu >= lo[flat]) & (yu <= hi[flat])
+        counts = np.bincount(flat[inside] * 100 + h[inside], minlength=size * 100).reshape((size, 100))
+        counts[np.arange(100) >= nh[:, None]] = -1
+        idmax = np.argmax(counts, axis=1)
+        left = idmax * step + lo
+        right = np.where(idmax + 1 == nh, hi, (idmax + 1) * step + lo)
+        stats['mode'] = np.where(full, 0.5 * (right + left), np.nan)
+
+    for key in stats:
+        stats[key] = np.reshape(stats[key], shape)
+
+    if others is not None:
+        ok = index >= 0
+        if y.ndim == 1:
+            ok &= np.isfinite(y)
+        nother = np.bincount(index[ok], minlength=nbins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stats['others'] = np.array([np.bincount(index[ok], weights=np.asarray(o)[ok], minlength=nbins) /
+                                        nother for o in others]).T
+    return stats
+
+
 def profile(xin, yin, range=None, nbins=10, fmt=None, plot=True, dispersion=True, log=False,
             median=False, cutbad=True, rebin_as_well=None, clip=None, mode=False):
     """
 
     Parameters
     ----------
-    xin
-    yin
+    xin : array (N)
+    yin : array (N) or (nrows, N)
+        All the rows are profiled at once, the outputs relative to y being then (nrows, nbins) arrays.
+        With cutbad, only the bins that are empty for all the rows are removed.
     range
     nbins
     fmt
@@ -298,12 +480,12 @@ def profile(xin, yin, range=None, nbins=10, fmt=None, plot=True, dispersion=True
     -------
 
     """
-    ok = np.isfinite(xin) * np.isfinite(yin)
-    x = xin[ok]
-    y = yin[ok]
+    xin = np.asarray(xin)
+    yin = np.asarray(yin)
     if range is None:
-        mini = np.min(x)
-        maxi = np.max(x)
+        ok = np.isfinite(xin) & np.all(np.isfinite(np.reshape(yin, (-1, len(xin)))), axis=0)
+        mini = np.min(xin[ok])
+        maxi = np.max(xin[ok])
     else:
         mini = range[0]
         maxi = range[1]
@@ -311,56 +493,41 @@ def profile(xin, yin, range=None, nbins=10, fmt=None, plot=True, dispersion=True
         xx = np.linspace(mini, maxi, nbins + 1)
     else:
         xx = np.logspace(np.log10(mini), np.log10(maxi), nbins + 1)
-    xmin = xx[0:nbins]
-    xmax = xx[1:]
-    yval = np.zeros(nbins)
-    xc = np.zeros(nbins)
-    dy = np.zeros(nbins)
-    dx = np.zeros(nbins)
-    nn = np.zeros(nbins)
-    if rebin_as_well is not None:
-        nother = len(rebin_as_well)
-        others = np.zeros((nbins, nother))
+    stats = binned_statistics(xin, yin, xx, clip=clip, median=median, mode=mode and not median,
+                              others=rebin_as_well)
+    others = stats.get('others')
+    if clip is not None:
+        nn = stats['n_clip']
     else:
-        others = None
-    for i in np.arange(nbins):
-        ok = (x > xmin[i]) & (x < xmax[i])
-        newy = y[ok]
-        if clip is not None:
-            for k in np.arange(3):
-                newy, mini, maxi = scipy.stats.sigmaclip(newy, low=clip, high=clip)
-        nn[i] = len(newy)
-        if median:
-            yval[i] = np.median(y[ok])
-        elif mode:
-            mm, ss = meancut(y[ok], 3)
-            hh = np.histogram(y[ok], bins=int(np.min([len(y[ok]) / 30, 100])), range=[mm - 5 * ss, mm + 5 * ss])
-            idmax = np.argmax(hh[0])
-            yval[i] = 0.5 * (hh[1][idmax + 1] + hh[1][idmax])
-        else:
-            yval[i] = np.mean(y[ok])
-        xc[i] = (xmax[i] + xmin[i]) / 2
-        if rebin_as_well is not None:
-            for o in range(nother):
-                others[i, o] = np.mean(rebin_as_well[o][ok])
-        if dispersion:
-            fact = 1
-        else:
-            fact = np.sqrt(len(y[ok]))
-        dy[i] = np.std(y[ok]) / fact
-        dx[i] = np.std(x[ok]) / fact
+        nn = stats['n']
+    if median:
+        yval = stats['median']
+    elif mode:
+        yval = stats['mode']
+    else:
+        yval = stats['mean']
+    xc = (xx[1:] + xx[:-1]) / 2
+    if dispersion:
+        fact = 1
+    else:
+        fact = np.sqrt(stats['n'])
+    dy = stats['std'] / fact
+    dx = stats['xstd'] / fact
     if plot:
         if fmt is None: fmt = 'ro'
-        errorbar(xc, yval, xerr=dx, yerr=dy, fmt=fmt)
+        for k in np.arange(len(np.reshape(yval, (-1, nbins)))):
+            errorbar(xc, np.reshape(yval, (-1, nbins))[k], xerr=np.reshape(dx, (-1, nbins))[k],
+                     yerr=np.reshape(dy, (-1, nbins))[k], fmt=fmt)
     ok = nn != 0
+    yval[~ok] = 0
+    dy[~ok] = 0
     if cutbad:
+        ok = np.reshape(ok, (-1, nbins)).any(axis=0)
         if others is None:
-            return xc[ok], yval[ok], dx[ok], dy[ok], others
+            return xc[ok], yval[..., ok], dx[..., ok], dy[..., ok], others
         else:
-            return xc[ok], yval[ok], dx[ok], dy[ok], others[ok, :]
+            return xc[ok], yval[..., ok], dx[..., ok], dy[..., ok], others[ok, :]
     else:
-        yval[~ok] = 0
-        dy[~ok] = 0
         return xc, yval, dx, dy, others
 
 
@@ -775,11 +942,16 @@ def fold_data(time, dd, period, lowcut, highcut, nbins,
     nbins
     notch
     return_error
+
+    Returns
+    -------
+    folded, t, folded_nonorm[, dfolded, dfolded_nonorm], newdata[, fnoise, noise]
+        newdata is the (ndet, nsamples) filtered data of all the detectors (it used to be the
+        (nsamples,) filtered data of the last detector only).
     """
     tfold = time % period
-    FREQ_SAMPLING = 1. / (time[1] - time[0])
-    sh = np.shape(dd)
-    ndet = sh[0]
+    dd = np.reshape(dd, (-1, len(time)))
+    ndet = len(dd)
 
     if return_noise_harmonics is not None:
         #### We estimate the noise in between the harmonics of the signal between harm=1 and 
@@ -796,29 +968,22 @@ def fold_data(time, dd, period, lowcut, highcut, nbins,
             fmax[i] = 1. / period * (i + 2) * (1 - margin / (i + 1))
             fnoise[i] = 0.5 * (fmin[i] + fmax[i])
 
-    folded = np.zeros((ndet, nbins))
-    folded_nonorm = np.zeros((ndet, nbins))
-    dfolded = np.zeros((ndet, nbins))
-    dfolded_nonorm = np.zeros((ndet, nbins))
-    if not silent:
-        bar = progress_bar(ndet, 'Detectors ')
-    for THEPIX in range(ndet):
-        if not silent:
-            bar.update()
-        data = dd[THEPIX, :]
-        newdata = filter_data(time, data, lowcut, highcut, notch=notch, rebin=rebin, verbose=verbose)
-        t, yy, dx, dy, others = profile(tfold, newdata, range=[0, period],
-                                        nbins=nbins, dispersion=False, plot=False,
-                                        cutbad=False, median=median)
-        folded[THEPIX, :] = (yy - np.mean(yy)) / np.std(yy)
-        folded_nonorm[THEPIX, :] = (yy - np.mean(yy))
-        dfolded[THEPIX, :] = dy / np.std(yy)
-        dfolded_nonorm[THEPIX, :] = dy
-        if return_noise_harmonics is not None:
-            spectrum, freq = power_spectrum(time, newdata, rebin=True)
-            for i in range(nharm):
-                ok = (freq >= fmin[i]) & (freq < fmax[i])
-                noise[THEPIX, i] = np.sqrt(np.mean(spectrum[ok]))
+    ### All the detectors are filtered, folded and normalized at once
+    newdata = filter_data(time, dd, lowcut, highcut, notch=notch, rebin=rebin, verbose=verbose)
+    t, yy, dx, dy, others = profile(tfold, newdata, range=[0, period],
+                                    nbins=nbins, dispersion=False, plot=False,
+                                    cutbad=False, median=median)
+    mean = np.mean(yy, axis=1)[:, None]
+    std = np.std(yy, axis=1)[:, None]
+    folded = (yy - mean) / std
+    folded_nonorm = yy - mean
+    dfolded = dy / std
+    dfolded_nonorm = dy
+    if return_noise_harmonics is not None:
+        spectrum, freq = power_spectrum(time, newdata, rebin=True)
+        for i in range(nharm):
+            ok = (freq >= fmin[i]) & (freq < fmax[i])
+            noise[:, i] = np.sqrt(np.mean(spectrum[:, ok], axis=1))
 
     if return_error:
         if return_noise_harmonics:
@@ -836,12 +1001,20 @@ def power_spectrum(time_in, data_in, rebin=True):
     if rebin:
         ### Resample the data on a regular grid
         time = np.linspace(time_in[0], time_in[-1], len(time_in))
-        data = np.interp(time, time_in, data_in)
+        if np.ndim(data_in) == 1:
+            data = np.interp(time, time_in, data_in)
+        else:
+            data = vec_interp(time, time_in, data_in)
     else:
         time = time_in
         data = data_in
 
-    spectrum_f, freq_f = mlab.psd(data, Fs=1. / (time[1] - time[0]), NFFT=len(data), window=mlab.window_hanning)
+    if np.ndim(data) == 1:
+        spectrum_f, freq_f = mlab.psd(data, Fs=1. / (time[1] - time[0]), NFFT=len(data), window=mlab.window_hanning)
+    else:
+        ### Same normalization as mlab.psd, for all the rows at once
+        freq_f, spectrum_f = scsig.periodogram(data, fs=1. / (time[1] - time[0]), window=np.hanning(len(time)),
+                                               detrend=False, axis=-1)
     return spectrum_f, freq_f
 
 
@@ -881,11 +1054,12 @@ def filter_data(time_in, data_in, lowcut, highcut, rebin=True, verbose=False, no
 
 
 def vec_interp(x, xin, yin):
-    sh = np.shape(yin)
-    nvec = sh[0]
-    yout = np.zeros_like(yin)
-    for i in range(nvec):
-        yout[i, :] = np.interp(x, xin, yin[i, :])
+    ### np.interp(x, xin, yin[i, :]) for all the rows of yin, the interpolation weights being computed once
+    index = np.clip(np.searchsorted(xin, x, side='right') - 1, 0, len(xin) - 2)
+    dx = xin[index + 1] - xin[index]
+    w = np.clip(np.where(dx != 0, (x - xin[index]) / np.where(dx != 0, dx, 1), 0), 0, 1)
+    yout = yin[:, index] * (1 - w)
+    yout += yin[:, index + 1] * w
     return yout
 
 
@@ -1091,7 +1265,7 @@ def run_asic(idnum, Vtes, fff, dc, theasicfile, asic, reselect_ok=False, lowcut=
 
     ### Fold the data at the modulation period of the fibers
     ### Signal is also badpass filtered before folding
-    folded, tt, folded_nonorm = fold_data(time, dd, 1. / fff, lowcut, highcut, nbins, notch=notch)
+    folded, tt, folded_nonorm, newdata = fold_data(time, dd, 1. / fff, lowcut, highcut, nbins, notch=notch)
 
     if nointeractive:
         reselect_ok = False
@@ -5,12 +5,15 @@ import healpy as hp
 import numexpr as ne
 import numpy as np
 import copy
+import hashlib
+import os
+from collections import OrderedDict
 from pyoperators import (
     Cartesian2SphericalOperator, DenseBlockDiagonalOperator, DiagonalOperator,
-    IdentityOperator, HomothetyOperator, ReshapeOperator, Rotation2dOperator,
-    Rotation3dOperator, Spherical2CartesianOperator)
+    IdentityOperator, HomothetyOperator, Operator, ReshapeOperator,
+    Rotation2dOperator, Rotation3dOperator, Spherical2CartesianOperator, flags)
 from pyoperators.utils import (
-    operation_assignment, pool_threading, product, split)
+    operation_assignment, operation_augmented, pool_threading, product, split)
 from pyoperators.utils.ufuncs import abs2
 from pysimulators import (
     ConvolutionTruncatedExponentialOperator, Instrument, Layout,
@@ -29,7 +32,8 @@ from qubic.ripples import ConvolutionRippledGaussianOperator, BeamGaussianRipple
 from qubic.beams import (BeamGaussian, BeamFitted, MultiFreqBeam)
 from qubic.polyacquisition import compute_freq
 
-__all__ = ['QubicInstrument',
+__all__ = ['ProjectionOnTheFlyOperator',
+           'QubicInstrument',
            'QubicMultibandInstrument']
 
 
@@ -102,6 +106,10 @@ class QubicInstrument(Instrument):
         synthbeam_fraction: float, optional
             The fraction of significant peaks retained for the computation
             of the synthetic beam.
+        projection_cache : str, optional
+            Directory in which the peak sampling matrices are stored, so that
+            they are memory-mapped instead of recomputed when the same
+            projection operator is requested again (default: None, no cache).
         beam_shape: dictionary entry, string
             the shape of the primary and secondary beams:
             'gaussian', 'fitted_beam' or 'multi_freq'
@@ -180,6 +188,7 @@ class QubicInstrument(Instrument):
         Instrument.__init__(self, layout)
         self.ripples = ripples
         self.nripples = nripples
+        self.projection_cache = d['projection_cache']
         self._init_beams(primary_shape, secondary_shape, filter_nu)
         self._init_filter(filter_nu, filter_relative_bandwidth)
         self._init_horns(filter_nu)
@@ -667,6 +676,20 @@ class QubicInstrument(Instrument):
             del keywords['ripples']
         return HealpixConvolutionGaussianOperator(fwhm=fwhm, **keywords)
 
+    def get_convolution_peak_window(self, lmax):
+        """
+        Return the window function, up to lmax, of the convolution by the
+        operator returned by get_convolution_peak_operator.
+
+        """
+        if self.ripples:
+            fl = ConvolutionRippledGaussianOperator(self.filter.nu).fl
+            out = np.zeros(lmax + 1)
+            out[:min(len(fl), lmax + 1)] = fl[:lmax + 1]
+            return out
+        fwhm = self.synthbeam.peak150.fwhm * (150e9 / self.filter.nu)
+        return hp.gauss_beam(fwhm, lmax=lmax)
+
     def get_detector_integration_operator(self):
         """
         Integrate flux density in detector solid angles and take into account
@@ -784,6 +807,7 @@ class QubicInstrument(Instrument):
         """
         horn = getattr(self, 'horn', None)
         primary_beam = getattr(self, 'primary_beam', None)
+        cache_dir = getattr(self, 'projection_cache', None)
 
         if sampling.fix_az:
             rotation = sampling.cartesian_horizontal2instrument
@@ -792,26 +816,65 @@ class QubicInstrument(Instrument):
 
         return QubicInstrument._get_projection_operator(
             rotation, scene, self.filter.nu, self.detector.center,
-            self.synthbeam, horn, primary_beam, verbose=verbose)
+            self.synthbeam, horn, primary_beam, verbose=verbose,
+            cache_dir=cache_dir)
+
+    def get_projection_onthefly_operator(self, sampling, scene,
+                                         max_nbytes=None):
+        """
+        Return the peak sampling operator, computed on the fly.
+        Convert units from W to W/sr.
+
+        Unlike get_projection_operator, the sparse matrix is never stored: the
+        peak pixels and the rotation weights are recomputed for chunks of
+        detectors and time samples inside each operator application.
+
+        Parameters
+        ----------
+        sampling : QubicSampling
+            The pointing information.
+        scene : QubicScene
+            The observed scene.
+        max_nbytes : int, optional
+            Maximum number of bytes of the sparse matrix chunks. By default,
+            the whole matrix is computed at once.
+
+        """
+        thetas, phis, vals = QubicInstrument._peak_angles(
+            scene, self.filter.nu, self.detector.center, self.synthbeam,
+            self.horn, self.primary_beam)
+        return ProjectionOnTheFlyOperator(
+            sampling, scene, thetas, phis, vals, self.synthbeam.dtype,
+            max_nbytes=max_nbytes)
 
     @staticmethod
     def _get_projection_operator(
             rotation, scene, nu, position, synthbeam, horn, primary_beam,
-            verbose=True):
-        ndetectors = position.shape[0]
+            verbose=True, cache_dir=None):
+        thetas, phis, vals = QubicInstrument._peak_angles(
+            scene, nu, position, synthbeam, horn, primary_beam)
+        return QubicInstrument._get_peak_sampling_operator(
+            rotation, scene, thetas, phis, vals, synthbeam.dtype,
+            verbose=verbose, cache_dir=cache_dir)
+
+    @staticmethod
+    def _get_peak_sampling_operator(rotation, scene, thetas, phis, vals,
+                                    dtype, verbose=True, cache_dir=None):
+        """
+        Return the projection operator sampling the scene at the specified
+        peak angles (ndetectors, ncolmax) for each rotation of the sampling.
+
+        """
+        ndetectors = thetas.shape[0]
         ntimes = rotation.data.shape[0]
         nside = scene.nside
+        dtype = np.dtype(dtype)
 
-        thetas, phis, vals = QubicInstrument._peak_angles(
-            scene, nu, position, synthbeam, horn, primary_beam)
         ncolmax = thetas.shape[-1]
         thetaphi = _pack_vector(thetas, phis)  # (ndetectors, ncolmax, 2)
         direction = Spherical2CartesianOperator('zenith,azimuth')(thetaphi)
         e_nf = direction[:, None, :, :]
-        if nside > 8192:
-            dtype_index = np.dtype(np.int64)
-        else:
-            dtype_index = np.dtype(np.int32)
+        dtype_index = _get_projection_dtype_index(nside)
 
         cls = {'I': FSRMatrix,
                'QU': FSRRotation2dMatrix,
@@ -819,8 +882,27 @@ class QubicInstrument(Instrument):
         ndims = len(scene.kind)
         nscene = len(scene)
         nscenetot = product(scene.shape[:scene.ndim])
-        s = cls((ndetectors * ntimes * ndims, nscene * ndims), ncolmax=ncolmax,
-                dtype=synthbeam.dtype, dtype_index=dtype_index,
+        if scene.kind == 'I':
+            shapeout = (ndetectors, ntimes)
+        else:
+            shapeout = (ndetectors, ntimes, ndims)
+        shape = (ndetectors * ntimes * ndims, nscene * ndims)
+
+        if cache_dir is not None:
+            key = _get_projection_cache_key(
+                rotation, scene, thetas, phis, vals, dtype, dtype_index)
+            filename = os.path.join(cache_dir, 'projection_' + key + '.npy')
+            if os.path.exists(filename):
+                if verbose:
+                    print('Info: Memory-mapping the peak sampling matrix from '
+                          '{0}.'.format(filename))
+                # copy-on-write, so that in-place restrictions do not alter
+                # the cached matrix
+                data = np.load(filename, mmap_mode='c')
+                s = cls(shape, ncolmax=ncolmax, data=data)
+                return ProjectionOperator(s, shapeout=shapeout)
+
+        s = cls(shape, ncolmax=ncolmax, dtype=dtype, dtype_index=dtype_index,
                 verbose=verbose)
 
         index = s.data.index.reshape((ndetectors, ntimes, ncolmax))
@@ -844,23 +926,20 @@ class QubicInstrument(Instrument):
         if scene.kind == 'I':
             value = s.data.value.reshape(ndetectors, ntimes, ncolmax)
             value[...] = vals[:, None, :]
-            shapeout = (ndetectors, ntimes)
         else:
             if str(dtype_index) not in ('int32', 'int64') or \
-                    str(synthbeam.dtype) not in ('float32', 'float64'):
+                    str(dtype) not in ('float32', 'float64'):
                 raise TypeError(
                     'The projection matrix cannot be created with types: {0} a'
-                    'nd {1}.'.format(dtype_index, synthbeam.dtype))
+                    'nd {1}.'.format(dtype_index, dtype))
             func = 'matrix_rot{0}d_i{1}_r{2}'.format(
-                ndims, dtype_index.itemsize, synthbeam.dtype.itemsize)
+                ndims, dtype_index.itemsize, dtype.itemsize)
             getattr(flib.polarization, func)(
                 rotation.data.T, direction.T, s.data.ravel().view(np.int8),
                 vals.T)
 
-            if scene.kind == 'QU':
-                shapeout = (ndetectors, ntimes, 2)
-            else:
-                shapeout = (ndetectors, ntimes, 3)
+        if cache_dir is not None:
+            _save_projection_cache(filename, s.data)
         return ProjectionOperator(s, shapeout=shapeout)
 
     def get_transmission_operator(self):
@@ -878,9 +957,51 @@ class QubicInstrument(Instrument):
         Compute the angles and intensity of the syntheam beam peaks which
         accounts for a specified energy fraction.
 
+        The peak search does not depend on the scene, it is memoized in
+        a table shared by all the instruments (see _peak_angles_fraction).
+
+        """
+        theta, phi, val = QubicInstrument._peak_angles_fraction(
+            synthbeam.kmax, synthbeam.fraction, horn.spacing, horn.angle, nu,
+            position, primary_beam)
+        solid_angle = synthbeam.peak150.solid_angle * (150e9 / nu) ** 2
+        val = val * (solid_angle / scene.solid_angle * len(horn))
+        return theta, phi, val
+
+    @staticmethod
+    def _peak_angles_fraction(kmax, fraction, horn_spacing, angle, nu,
+                              position, primary_beam):
         """
+        Return the angles and the primary beam transmission of the synthetic
+        beam peaks, sorted by decreasing transmission and truncated to the
+        peaks accounting for the specified energy fraction.
+
+        The results are stored in a least-recently-used table, so that the
+        subinstruments of a multiband instrument or the acquisitions used for
+        the TOD creation and the map reconstruction share the same search.
+        The returned arrays are read-only.
+
+        """
+        key = (kmax, fraction, horn_spacing, angle, nu,
+               _get_array_key(position), _get_beam_key(primary_beam))
+        try:
+            out = _PEAK_ANGLES_CACHE.pop(key)
+        except KeyError:
+            out = QubicInstrument._peak_angles_search(
+                kmax, fraction, horn_spacing, angle, nu, position,
+                primary_beam)
+            for array in out:
+                array.flags.writeable = False
+            while len(_PEAK_ANGLES_CACHE) >= _PEAK_ANGLES_CACHE_SIZE:
+                _PEAK_ANGLES_CACHE.popitem(last=False)
+        _PEAK_ANGLES_CACHE[key] = out
+        return out
+
+    @staticmethod
+    def _peak_angles_search(kmax, fraction, horn_spacing, angle, nu, position,
+                            primary_beam):
         theta, phi = QubicInstrument._peak_angles_kmax(
-            synthbeam.kmax, horn.spacing, horn.angle, nu, position)
+            kmax, horn_spacing, angle, nu, position)
         val = np.array(primary_beam(theta, phi), dtype=float, copy=False)
         val[~np.isfinite(val)] = 0
         index = _argsort_reverse(val)
@@ -888,7 +1009,7 @@ class QubicInstrument(Instrument):
         phi = phi[tuple(index)]
         val = val[tuple(index)]
         cumval = np.cumsum(val, axis=-1)
-        imaxs = np.argmax(cumval >= synthbeam.fraction * cumval[:, -1, None],
+        imaxs = np.argmax(cumval >= fraction * cumval[:, -1, None],
                           axis=-1) + 1
         imax = max(imaxs)
 
@@ -903,8 +1024,6 @@ class QubicInstrument(Instrument):
             val[idet, imax_:] = 0
             theta[idet, imax_:] = np.pi / 2  # XXX 0 fails in polarization.f90.src (en2ephi and en2etheta_ephi)
             phi[idet, imax_:] = 0
-        solid_angle = synthbeam.peak150.solid_angle * (150e9 / nu) ** 2
-        val *= solid_angle / scene.solid_angle * len(horn)
         return theta, phi, val
 
     @staticmethod
@@ -1246,12 +1365,92 @@ class QubicInstrument(Instrument):
         return subset_inst
 
 
+# peak angles memoized by QubicInstrument._peak_angles_fraction
+_PEAK_ANGLES_CACHE = OrderedDict()
+_PEAK_ANGLES_CACHE_SIZE = 64
+
+
+def _get_array_key(a):
+    a = np.ascontiguousarray(a)
+    return a.shape, a.dtype.str, hashlib.sha1(a.view(np.uint8)).hexdigest()
+
+
+def _get_beam_key(beam):
+    """
+    Return a hashable description of a beam model, made of its class and of
+    its scalar and array parameters.
+
+    """
+    if not hasattr(beam, 'solid_angle'):
+        # not a Beam instance (e.g. a function): rely on its identity
+        return (beam,)
+    key = [type(beam).__name__]
+    for name, value in sorted(vars(beam).items()):
+        if isinstance(value, (list, tuple)):
+            try:
+                value = tuple(_get_array_key(np.asarray(v, dtype=float))
+                              for v in value)
+            except (TypeError, ValueError):
+                continue
+        elif isinstance(value, np.ndarray):
+            value = _get_array_key(value)
+        elif not np.isscalar(value) and value is not None:
+            continue
+        key.append((name, value))
+    return tuple(key)
+
+
 def _argsort_reverse(a, axis=-1):
     i = list(np.ogrid[[slice(x) for x in a.shape]])
     i[axis] = a.argsort(axis)[:, ::-1]
     return i
 
 
+def _get_projection_dtype_index(nside):
+    if nside > 8192:
+        return np.dtype(np.int64)
+    return np.dtype(np.int32)
+
+
+def _get_projection_cache_key(rotation, scene, thetas, phis, vals, dtype,
+                              dtype_index):
+    """
+    Return the hash identifying a peak sampling matrix. The peak angles and
+    values account for the frequency, the synthetic beam parameters (kmax,
+    fraction), the primary beam and the detector selection.
+
+    """
+    sha = hashlib.sha1()
+    sha.update('{0} {1} {2} {3}'.format(
+        scene.nside, scene.kind, np.dtype(dtype).str,
+        np.dtype(dtype_index).str).encode())
+    arrays = [rotation.data, thetas, phis, vals]
+    if len(scene) != product(scene.shape[:scene.ndim]):
+        arrays.append(np.asarray(scene.index))
+    for array in arrays:
+        sha.update(np.ascontiguousarray(array).view(np.uint8))
+    return sha.hexdigest()
+
+
+def _save_projection_cache(filename, data):
+    """
+    Store the structured array of a sparse matrix, through a temporary file
+    so that concurrent processes never read a partially written matrix.
+
+    """
+    path = os.path.dirname(filename)
+    if path and not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    tmpname = '{0}.{1}.tmp'.format(filename[:-4], os.getpid())
+    with open(tmpname, 'wb') as f:
+        np.save(f, data)
+    os.rename(tmpname, filename)
+
+
 def _pack_vector(*args):
     shape = np.broadcast(*args).shape
     out = np.empty(shape + (len(args),))
@@ -1260,6 +1459,95 @@ def _pack_vector(*args):
     return out
 
 
+@flags.real
+@flags.linear
+class ProjectionOnTheFlyOperator(Operator):
+    """
+    Matrix-free peak sampling operator.
+
+    The sparse matrix of the peak sampling is never stored. At each
+    application, the peak pixel indices and the rotation weights are computed
+    for chunks of detectors and time samples, the chunk is applied and then
+    discarded. The memory footprint is therefore set by the chunk size and
+    not by the number of detectors times the number of samples. Within a
+    chunk, the computation is parallelized over the detectors.
+
+    """
+    def __init__(self, sampling, scene, thetas, phis, vals, dtype,
+                 max_nbytes=None, **keywords):
+        """
+        Parameters
+        ----------
+        sampling : QubicSampling
+            The pointing information.
+        scene : QubicScene
+            The observed scene.
+        thetas, phis, vals : arrays of shape (ndetectors, ncolmax)
+            The angles and intensities of the synthetic beam peaks, as
+            returned by QubicInstrument._peak_angles.
+        dtype : dtype
+            The data type of the sparse matrix values.
+        max_nbytes : int, optional
+            Maximum number of bytes of the sparse matrix chunks. By default,
+            the whole matrix is computed at once.
+
+        """
+        ndetectors, ncolmax = thetas.shape
+        ntimes = len(sampling)
+        ndims = len(scene.kind)
+        dtype = np.dtype(dtype)
+        if scene.kind == 'I':
+            shapeout = (ndetectors, ntimes)
+        else:
+            shapeout = (ndetectors, ntimes, ndims)
+        nbytes_row = ncolmax * (
+            _get_projection_dtype_index(scene.nside).itemsize +
+            ndims * dtype.itemsize)
+        if max_nbytes is None:
+            nrows = ndetectors * ntimes
+        else:
+            nrows = max(int(max_nbytes // nbytes_row), 1)
+        if nrows >= ndetectors:
+            # all the detectors in each chunk, for the threads to share
+            dets = [slice(0, ndetectors)]
+            ntimes_chunk = nrows // ndetectors
+        else:
+            dets = [slice(i, min(i + nrows, ndetectors))
+                    for i in range(0, ndetectors, nrows)]
+            ntimes_chunk = 1
+        times = [slice(i, min(i + ntimes_chunk, ntimes))
+                 for i in range(0, ntimes, ntimes_chunk)]
+        Operator.__init__(self, shapein=scene.shape, shapeout=shapeout,
+                          dtype=dtype, **keywords)
+        self.sampling = sampling
+        self.scene = scene
+        self.thetas = thetas
+        self.phis = phis
+        self.vals = vals
+        self.chunks = [(d, t) for d in dets for t in times]
+        self.max_nbytes = max_nbytes
+
+    def direct(self, input, output):
+        for d, t in self.chunks:
+            output[d, t] = self._get_chunk_operator(d, t)(input)
+
+    def transpose(self, input, output):
+        output[...] = 0
+        for d, t in self.chunks:
+            self._get_chunk_operator(d, t).T(
+                input[d, t], out=output, operation=operation_augmented)
+
+    def _get_chunk_operator(self, d, t):
+        sampling = self.sampling[t]
+        if sampling.fix_az:
+            rotation = sampling.cartesian_horizontal2instrument
+        else:
+            rotation = sampling.cartesian_galactic2instrument
+        return QubicInstrument._get_peak_sampling_operator(
+            rotation, self.scene, self.thetas[d], self.phis[d], self.vals[d],
+            self.dtype, verbose=False)
+
+
 class QubicMultibandInstrument:
     """
     The QubicMultibandInstrument class
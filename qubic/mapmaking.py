@@ -1,11 +1,13 @@
 from __future__ import absolute_import, division, print_function
 from collections import OrderedDict
 from pyoperators import (
-    asoperator, BlockColumnOperator, DiagonalOperator, PackOperator, pcg,
+    asoperator, BlockColumnOperator, DiagonalOperator, PackOperator,
     proxy_group)
 from pyoperators.memory import ones
 from pyoperators.utils import ndarraywrap
 from pysimulators.interfaces.healpy import HealpixLaplacianOperator
+from scipy.spatial import cKDTree
+from .acquisition import _pcg
 from .utils import progress_bar
 import healpy as hp
 import numpy as np
@@ -17,7 +19,7 @@ __all__ = ['angular_distance_from_mask',
            'tod2map_each']
 
 
-def angular_distance_from_mask(mask):
+def angular_distance_from_mask(mask, nchunk=2**20):
     """
     For each pixel of a Healpix map, return the smallest angular distance
     to a set of masked pixels (of value True), in degrees.
@@ -28,6 +30,8 @@ def angular_distance_from_mask(mask):
         The Healpix mask that defines the set of masked pixels (of value True)
         whose smallest angular distance to each pixel of a Healpix map of same
         nside is computed.
+    nchunk : int, optional
+        Number of pixels whose distance is computed at once.
 
     """
     nside = hp.npix2nside(len(mask))
@@ -36,18 +40,21 @@ def angular_distance_from_mask(mask):
     ip = np.arange(12*nside**2)[~mask]
     neigh = hp.get_all_neighbours(nside, ip)
     nn = np.unique(neigh.ravel())
-    if nn[0] == -1:
+    if len(nn) > 0 and nn[0] == -1:
         nn = nn[1:]
     nn = nn[mask[nn]]
 
-    # get unit vectors for border and inner pixels
-    vecpix_inner = np.array(hp.pix2vec(nside, ip))
-    vecpix_outer = np.array(hp.pix2vec(nside, nn))
-
-    # get angles between the border pixels and inner pixels
-    cosang = np.dot(vecpix_inner.T, vecpix_outer)
+    # the nearest border pixel of the inner pixels is queried by chunks
+    # in a tree of the border pixel unit vectors
     mapang = np.zeros(12*nside**2)
-    mapang[~mask] = np.degrees(np.arccos(np.max(cosang, axis=1)))
+    if len(nn) == 0:
+        mapang[~mask] = np.inf
+        return mapang
+    tree = cKDTree(np.array(hp.pix2vec(nside, nn)).T)
+    for start in range(0, len(ip), nchunk):
+        ip_ = ip[start:start+nchunk]
+        chord = tree.query(np.array(hp.pix2vec(nside, ip_)).T)[0]
+        mapang[ip_] = np.degrees(2 * np.arcsin(np.minimum(chord / 2, 1)))
     return mapang
 
 
@@ -147,7 +154,9 @@ def map2tod(acq, map, convolution=False, max_nbytes=None):
 
 
 def _tod2map(acq, tod, coverage_threshold, max_nbytes, callback,
-             disp_pcg, maxiter, tol, criterion, full_output, save_map, hyper):
+             disp_pcg, maxiter, tol, criterion, full_output, save_map, hyper,
+             block_preconditioner=False, x0=None, checkpoint=None,
+             checkpoint_every=10):
     # coverage normalization:
     # sum coverage = #detectors x #samplings for a uniform secondary beam
     H = acq.get_operator()
@@ -182,8 +191,11 @@ def _tod2map(acq, tod, coverage_threshold, max_nbytes, callback,
     acq_restricted = acq[..., mask]
     H = acq_restricted.get_operator()
     invNtt = acq_restricted.get_invntt_operator()
-    M = (H.T * H * np.ones(H.shapein))[..., 0]
-    preconditioner = DiagonalOperator(1/M, broadcast='rightward')
+    if block_preconditioner:
+        preconditioner = acq_restricted.get_block_preconditioner()
+    else:
+        M = (H.T * H * np.ones(H.shapein))[..., 0]
+        preconditioner = DiagonalOperator(1/M, broadcast='rightward')
 #    preconditioner = DiagonalOperator(1/coverage[mask], broadcast='rightward')
     nsamplings = acq.comm.allreduce(len(acq.sampling))
     npixels = np.sum(mask)
@@ -228,8 +240,12 @@ def _tod2map(acq, tod, coverage_threshold, max_nbytes, callback,
                     self.xs = {}
                 self.xs[self.niterations] = self.x.copy()
 
-    solution = pcg(A, H.T(invNtt(tod)) / nsamplings, M=preconditioner,
-                   callback=callback, disp=disp_pcg, maxiter=maxiter, tol=tol)
+    if x0 is not None:
+        x0 = x0[mask]
+    solution = _pcg(A, H.T(invNtt(tod)) / nsamplings, x0=x0, M=preconditioner,
+                    callback=callback, disp=disp_pcg, maxiter=maxiter, tol=tol,
+                    checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+                    comm=acq.comm)
     output = acq_restricted.scene.unpack(solution['x']), coverage
     if full_output:
         algo = solution['algorithm']
@@ -243,7 +259,9 @@ def _tod2map(acq, tod, coverage_threshold, max_nbytes, callback,
 
 def tod2map_all(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
                 callback=None, disp=True, maxiter=300, tol=1e-4,
-                criterion=False, full_output=False, save_map=None, hyper=0):
+                criterion=False, full_output=False, save_map=None, hyper=0,
+                block_preconditioner=False, x0=None, checkpoint=None,
+                checkpoint_every=10):
     """
     Compute map using all detectors.
 
@@ -279,6 +297,16 @@ def tod2map_all(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
     criterion : boolean, optional
         If True, also display the criterion at each iteration. It slows down
         the solving process.
+    block_preconditioner : boolean, optional
+        If True, the PCG is preconditioned by the inverse of the per-pixel
+        Stokes blocks of H.T * H instead of the inverse of its diagonal.
+    x0 : I, QU or IQU maps, optional
+        The starting point of the solver, such as the solution of a previous
+        realization or a binned map.
+    checkpoint : str, optional
+        If specified, the state of the solver is stored in this file every
+        checkpoint_every iterations, and the solver resumes from it if the
+        file exists.
 
     Returns
     -------
@@ -289,7 +317,8 @@ def tod2map_all(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
     """
     return _tod2map(acquisition, tod, coverage_threshold, max_nbytes,
                     callback, disp, maxiter, tol, criterion, full_output,
-                    save_map, hyper)
+                    save_map, hyper, block_preconditioner, x0, checkpoint,
+                    checkpoint_every)
 
 
 def tod2map_each(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
@@ -18,7 +18,8 @@ from .scene import QubicScene
 from .samplings import create_random_pointings
 from .acquisition import (QubicAcquisition,
                           PlanckAcquisition,
-                          QubicPlanckAcquisition)
+                          QubicPlanckAcquisition,
+                          _get_block_jacobi_operator)
 from .polyacquisition import (QubicPolyAcquisition,
                               QubicPolyPlanckAcquisition)
 
@@ -51,12 +52,38 @@ class QubicMultibandAcquisition(QubicPolyAcquisition):
         self.nus = np.array([q.filter.nu / 1e9 for q in multiinstrument])
 
     def get_operator(self):
+        if self.fused_projection:
+            op_sum = [self._get_fused_operator(indices)
+                      for indices in self._get_subband_indices()]
+            return BlockRowOperator(op_sum, new_axisin=0)
         op = np.array(self._get_array_of_operators())
         op_sum = []
-        for band in self.bands:
-            op_sum.append(op[(self.nus > band[0]) * (self.nus < band[1])].sum(axis=0))
+        for indices in self._get_subband_indices():
+            op_sum.append(op[indices].sum(axis=0))
         return BlockRowOperator(op_sum, new_axisin=0)
 
+    def _get_subband_indices(self):
+        """ Return the indices of the subacquisitions of each subband. """
+        return [np.where((self.nus > band[0]) * (self.nus < band[1]))[0]
+                for band in self.bands]
+
+    def get_block_preconditioner(self, mask=None):
+        """
+        Return the block-Jacobi preconditioner, i.e. the inverse of the
+        per-pixel Stokes blocks of H.T * H for each reconstructed subband.
+
+        Parameter
+        ---------
+        mask : boolean array, optional
+            If specified, the preconditioner is restricted to the pixels
+            of value True.
+
+        """
+        blocks = np.array([self.get_preconditioner_blocks(indices)
+                           for indices in self._get_subband_indices()])
+        if mask is not None:
+            blocks = blocks[:, mask]
+        return _get_block_jacobi_operator(blocks)
 
     def get_preconditioner(self, cov):
         print('This is the new preconditionner')
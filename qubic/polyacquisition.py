@@ -3,6 +3,9 @@ from __future__ import division
 
 import healpy as hp
 import numpy as np
+from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from pyoperators import (
     BlockColumnOperator, BlockDiagonalOperator, BlockRowOperator,
     CompositionOperator, DiagonalOperator, I, IdentityOperator,
@@ -16,6 +19,12 @@ from .data import PATH
 from .scene import QubicScene
 from .samplings import create_random_pointings, get_pointing
 from .acquisition import QubicPlanckAcquisition,QubicAcquisition, PlanckAcquisition
+from .acquisition import (_add_projection_matrix, _bin_pixels, _block_pcg,
+                          _get_block_jacobi_operator, _get_detector_weights,
+                          _get_matrices_getter, _get_pixel_blocks, _pcg,
+                          _scale_projection_matrix, _solve_pixel_blocks,
+                          _StackedNormalOperator)
+from pysimulators import ProjectionOperator
 
 __all__ = ['compute_freq',
            'QubicPolyAcquisition',
@@ -87,6 +96,7 @@ class QubicPolyAcquisition(object):
             a.comm = self[0].comm
         self.scene = scene
         self.d = d
+        self.fused_projection = bool(d['fused_projection'])
         if weights is None:
             self.weights = np.ones(len(self))  # / len(self)
         else:
@@ -185,9 +195,52 @@ class QubicPolyAcquisition(object):
         """
         if len(self) == 1:
             return self[0].get_operator()
+        if self.fused_projection:
+            return self._get_fused_operator(range(len(self)))
         op = np.array(self._get_array_of_operators())
         return np.sum(op, axis=0)
 
+    def _get_fused_operator(self, indices):
+        """
+        Return the weighted sum of the operators of the specified
+        subacquisitions, as a single operator.
+
+        The scalar and per-detector factors of each subacquisition (unit
+        conversion, filter bandwidth, aperture and detector integrations,
+        weights) are folded into the values of its peak sampling matrix,
+        and the matrices are merged by unioning the peak pixels of each
+        (detector, time) row. One sparse matrix-vector product then replaces
+        one per subacquisition. The other operators (detector response,
+        instrument transmission, polarizer, HWP) are common to all of them.
+
+        """
+        a = self[indices[0]]
+        a._check_projection_matrices_stored()
+        nd = len(a.instrument)
+        projections = []
+        for b, matrix in self._get_merged_matrices(indices):
+            nt = len(a.sampling[b])
+            if self.scene.kind == 'I':
+                shapeout = (nd, nt)
+            else:
+                shapeout = (nd, nt, len(self.scene.kind))
+            projections.append(ProjectionOperator(matrix, shapeout=shapeout))
+            del matrix
+        projection = BlockColumnOperator(projections, axisout=1)
+        del projections
+        distribution = a.get_distribution_operator()
+        hwp = a.get_hwp_operator()
+        polarizer = a.get_polarizer_operator()
+        trans_inst = a.instrument.get_transmission_operator()
+        response = a.get_detector_response_operator()
+        with rule_manager(inplace=True):
+            H = CompositionOperator([
+                response, trans_inst, polarizer, hwp * projection,
+                distribution])
+        if self.scene == 'QU':
+            H = a.get_subtract_grids_operator()(H)
+        return H
+
     def get_invntt_operator(self):
         """
         Return the inverse noise covariance matrix as operator
@@ -226,10 +279,11 @@ class QubicPolyAcquisition(object):
             shape = m.shape
 
         if convolution:
-            _maps_convolved = np.zeros(shape)  # array of sky maps, each convolved with its own gaussian
-            for i in range(len(self)):
-                C = self[i].get_convolution_peak_operator()
-                _maps_convolved[i] = C(m[i])
+            # array of sky maps, each convolved with its own gaussian
+            lmax = 3 * self.scene.nside - 1
+            windows = [a.instrument.get_convolution_peak_window(lmax)
+                       for a in self]
+            _maps_convolved = _convolve_maps(m, windows).reshape(shape)
             tod = self.get_operator_to_make_TOD() * _maps_convolved
         else:
             tod = self.get_operator() * m
@@ -254,9 +308,108 @@ class QubicPolyAcquisition(object):
             preconditioner = None
         return preconditioner
 
-    def tod2map(self, tod, d, cov=None):
+    def get_block_preconditioner(self, mask=None):
         """
-        Reconstruct map from tod
+        Return the block-Jacobi preconditioner, i.e. the inverse of the
+        per-pixel Stokes blocks of H.T * H (see get_preconditioner_blocks).
+
+        Parameter
+        ---------
+        mask : boolean array, optional
+            If specified, the preconditioner is restricted to the pixels
+            of value True.
+
+        """
+        blocks = self.get_preconditioner_blocks(range(len(self)))
+        if mask is not None:
+            blocks = blocks[mask]
+        return _get_block_jacobi_operator(blocks)
+
+    def get_preconditioner_blocks(self, indices):
+        """
+        Return the per-pixel blocks of H.T * H, of shape
+        (npixels, nstokes, nstokes), H being the weighted sum of the operators
+        of the specified subacquisitions. The peak sampling matrices of the
+        subacquisitions are merged, so that the cross-frequency terms are
+        accounted for. The time response of the detectors is neglected.
+
+        """
+        a = self[indices[0]]
+        nstokes = 1 if self.scene.kind == 'I' else len(self.scene.kind)
+        npixel = self.scene.shape[0]
+        blocks = np.zeros((npixel, nstokes, nstokes))
+        for b, matrix in self._get_merged_matrices(indices):
+            blocks += _get_pixel_blocks(
+                matrix, a._get_stokes_coefficients(a.sampling[b]), npixel)
+        a.comm.Allreduce(MPI.IN_PLACE, as_mpi(blocks), op=MPI.SUM)
+        return blocks
+
+    def tod2map_binned(self, tod, rcond=1e-6):
+        """
+        Return the binned map, the number of peaks which hit each pixel and
+        the condition number of the pixel blocks, the peak sampling matrices
+        of the subacquisitions being merged (see
+        QubicAcquisition.tod2map_binned).
+
+        The subbands of a QubicMultibandAcquisition cannot be separated pixel
+        by pixel, since the peaks of all the subfrequencies fall into the
+        same pixels with nearly the same coefficients. The binned map is then
+        the map of the whole band, of the scene shape, and the subband maps
+        are reconstructed by tod2map.
+
+        """
+        a = self[0]
+        weights = _get_detector_weights(a.instrument)
+        nstokes = 1 if self.scene.kind == 'I' else len(self.scene.kind)
+        npixel = self.scene.shape[0]
+        blocks = np.zeros((npixel, nstokes, nstokes))
+        rhs = np.zeros((npixel, nstokes))
+        hits = np.zeros(npixel, int)
+        for b, matrix in self._get_merged_matrices(range(len(self))):
+            blocks_, rhs_, hits_ = _bin_pixels(
+                matrix, a._get_stokes_coefficients(a.sampling[b]), npixel,
+                tod=tod[:, b], weights=weights)
+            blocks += blocks_
+            rhs += rhs_
+            hits += hits_
+        for array in blocks, rhs, hits:
+            a.comm.Allreduce(MPI.IN_PLACE, as_mpi(array), op=MPI.SUM)
+        x, cond = _solve_pixel_blocks(blocks, rhs, rcond=rcond)
+        return x.reshape(self.scene.shape), hits, cond
+
+    def _get_subband_indices(self):
+        """
+        Return the indices of the subacquisitions of each reconstructed
+        subband, or None if a single map is reconstructed.
+
+        """
+        return None
+
+    def _get_merged_matrices(self, indices):
+        """
+        Iterate over the blocks of the sampling, returning the block and the
+        merged sparse matrix of the peak sampling operators of the specified
+        subacquisitions, including their weights, scalar and per-detector
+        factors.
+
+        """
+        for b in self[indices[0]].block:
+            matrix = None
+            for i in indices:
+                scalar, detector = self[i]._get_projection_factors()
+                p = self[i].instrument.get_projection_operator(
+                    self[i].sampling[b], self.scene, verbose=False)
+                _scale_projection_matrix(p.matrix, self.weights[i] * scalar *
+                                         detector)
+                matrix = _add_projection_matrix(matrix, p.matrix)
+                del p
+            yield b, matrix
+            del matrix
+
+    def tod2map(self, tod, d, cov=None, x0=None):
+        """
+        Reconstruct map from tod, optionally starting from x0 and with
+        checkpoints (see QubicAcquisition.tod2map)
         """
         tol = d['tol']
         maxiter = d['maxiter']
@@ -267,11 +420,92 @@ class QubicPolyAcquisition(object):
         A = H.T * invntt * H
         b = H.T * invntt * tod
 
-        preconditioner = self.get_preconditioner(cov)
-        solution = pcg(A, b, M=preconditioner,
-                       disp=verbose, tol=tol, maxiter=maxiter)
+        if d['preconditioner'] == 'block_jacobi':
+            preconditioner = self.get_block_preconditioner()
+        else:
+            preconditioner = self.get_preconditioner(cov)
+        solution = _pcg(A, b, x0=x0, M=preconditioner, disp=verbose, tol=tol,
+                        maxiter=maxiter, checkpoint=d['pcg_checkpoint'],
+                        checkpoint_every=d['pcg_checkpoint_every'] or 10,
+                        comm=self[0].comm)
         return solution['x'], solution['nit'], solution['error']
 
+    def tod2map_many(self, tods, d, cov=None):
+        """
+        Reconstruct maps from a stack of tods of shape (k, ndetectors, ntimes)
+        with a block conjugate gradient (see QubicAcquisition.tod2map_many).
+        The peak sampling matrices of the subacquisitions are merged, as
+        in the fused operator, and applied to all the stacked maps at once.
+
+        """
+        tol = d['tol']
+        maxiter = d['maxiter']
+        verbose = d['verbose']
+        a = self[0]
+        invntt = self.get_invntt_operator()
+        subbands = self._get_subband_indices()
+        store = a._can_store_projection_matrices()
+        getters = [_get_matrices_getter(
+                       partial(self._get_merged_matrices, indices), store)
+                   for indices in subbands or [range(len(self))]]
+        A = _StackedNormalOperator(
+            getters, a._get_operator_after_projection(),
+            a.get_distribution_operator(), invntt, self.scene.shape,
+            a._get_projection_shapeout(), subbands=subbands is not None)
+        B = A.get_rhs(tods)
+
+        if d['preconditioner'] == 'block_jacobi':
+            preconditioner = self.get_block_preconditioner()
+        else:
+            preconditioner = self.get_preconditioner(cov)
+        return _block_pcg(A, B, M=preconditioner, disp=verbose, tol=tol,
+                          maxiter=maxiter)
+
+
+def _convolve_maps(maps, windows, nthreads=None):
+    """
+    Convolve each Healpix map of a stack, of shape (N, npix) or (N, npix, 3),
+    by its window function, the I, Q, U maps being convolved independently.
+
+    The spherical harmonic transform is computed once for the maps which are
+    proportional to each other, such as a same sky in several subbands or
+    a sky which only differs by its SED, and the inverse transforms run in a
+    pool of threads.
+
+    """
+    maps = np.asarray(maps, float)
+    nside = hp.npix2nside(maps.shape[1])
+    references = []
+    alms = []
+    scales = []
+    for m in maps:
+        for ref, r in enumerate(references):
+            norm = np.sum(r**2)
+            scale = np.sum(m * r) / norm if norm > 0 else 0
+            if np.allclose(m, scale * r, rtol=1e-10, atol=0):
+                break
+        else:
+            ref = len(references)
+            scale = 1
+            references.append(m)
+            alms.append(hp.map2alm(m.T, pol=False))
+        scales.append((ref, scale))
+
+    def func(i):
+        ref, scale = scales[i]
+        alm = alms[ref]
+        if maps.ndim == 2:
+            return scale * hp.alm2map(hp.almxfl(alm, windows[i]), nside)
+        return scale * np.array(
+            hp.alm2map([hp.almxfl(_, windows[i]) for _ in alm], nside,
+                       pol=False)).T
+
+    pool = ThreadPool(nthreads or min(len(maps), cpu_count()))
+    try:
+        return np.array(pool.map(func, range(len(maps))))
+    finally:
+        pool.close()
+
 
 class QubicPolyPlanckAcquisition(QubicPlanckAcquisition):
     """
@@ -25,46 +25,87 @@ class ConvolutionRippledGaussianOperator(HealpixConvolutionGaussianOperator):
     Convolve a Healpix map by a gaussian kernel, modulated by ripples.
 
     """
+    pol = False
+
     def __init__(self, freq,
                  nripples=2,
+                 pol=False,
                  **keywords):
+        """
+        Parameters
+        ----------
+        freq : float
+            The frequency, in Hz.
+        nripples : int, optional
+            The number of ripples.
+        pol : boolean, optional
+            If true, the Q and U maps of an IQU input are convolved as spin-2
+            fields. Otherwise, the I, Q and U maps are convolved as spin-0
+            fields.
+
+        """
         nripples_max = 2
         if nripples not in range(nripples_max + 1):
             raise ValueError(
                 'Input nripples is not a non-negative integer less than {}'.
                 format(nripples_max + 1))
         self.nripples = nripples
-        with open(PATH + 'sb_peak_plus_two_ripples_150HGz.pkl', 'r') as f:
-            fl = load(f)
-        fl /= fl.max()
-        if freq == 150e9:
-            fl_ = fl
-        else:
-            corr1 = [  1.65327594e-02, -2.24216210e-04, 9.70939946e-07, -1.40191824e-09]
-            corr2 = [ -3.80559542e-01, 4.76370274e-03, -1.84237511e-05, 2.37962542e-08]
-            def f(x, p):
-                return p[0] + p[1] * x + p[2] * x**2 + p[3] * x**3
-            ell = np.arange(len(fl)) + 1
-            spl = splrep(ell * freq / 150e9, fl)
-            if freq > 150e9:
-                fl_ = splev(ell, spl) * (1 + f(freq / 1e9, corr2) + ell * f(freq / 1e9, corr1))
-            else:
-                fl_ = np.zeros(len(ell))
-                fl_ = splev(ell[ell < ell.max() * freq / 150e9], spl) * \
-                       (1 + f(freq / 1e9, corr2) + ell[ell < ell.max() * freq / 150e9] * f(freq / 1e9, corr1))
-        self.fl = np.sqrt(fl_)
-        self.fl[np.isnan(self.fl)] = 0.
+        self.pol = pol
+        self.fl = _get_ripples_window(freq)
 
     def direct(self, input, output):
+        nside = hp.npix2nside(len(input))
         if input.ndim == 1:
-            input = input[:, None]
-            output = output[:, None]
-        for i, o in zip(input.T, output.T):
-            ialm = hp.map2alm(i)
-            alm_smoothed = hp.almxfl(ialm, self.fl)
-            o[...] = hp.alm2map(alm_smoothed, hp.npix2nside(len(i)))# * \
-#                     2.2196409083134503 ## A map convolved with ripples is
-#                                        ## this factor lower than the map conv. with gaussian
+            alm = hp.almxfl(hp.map2alm(input), self.fl)
+            output[...] = hp.alm2map(alm, nside)
+            return
+        pol = self.pol and input.shape[1] == 3
+        alms = hp.map2alm(input.T, pol=pol)
+        alms = [hp.almxfl(alm, self.fl) for alm in alms]
+        output[...] = np.array(hp.alm2map(alms, nside, pol=pol)).T
+        # * 2.2196409083134503 ## A map convolved with ripples is
+        #                        ## this factor lower than the map conv. with gaussian
+
+
+_RIPPLES_WINDOW_CACHE = {}
+
+
+def _get_ripples_window(freq):
+    """
+    Return the window function of the gaussian kernel modulated by ripples,
+    corrected for the frequency. The window functions are computed once and
+    shared by all the operators, as read-only arrays. They do not depend on
+    the number of ripples, which is only validated by the operator.
+
+    """
+    if freq in _RIPPLES_WINDOW_CACHE:
+        return _RIPPLES_WINDOW_CACHE[freq]
+    with open(PATH + 'sb_peak_plus_two_ripples_150HGz.pkl', 'rb') as f:
+        if sys.version_info.major == 2:
+            fl = load(f)
+        else:
+            fl = load(f, encoding='latin1')
+    fl /= fl.max()
+    if freq == 150e9:
+        fl_ = fl
+    else:
+        corr1 = [  1.65327594e-02, -2.24216210e-04, 9.70939946e-07, -1.40191824e-09]
+        corr2 = [ -3.80559542e-01, 4.76370274e-03, -1.84237511e-05, 2.37962542e-08]
+        def f(x, p):
+            return p[0] + p[1] * x + p[2] * x**2 + p[3] * x**3
+        ell = np.arange(len(fl)) + 1
+        spl = splrep(ell * freq / 150e9, fl)
+        if freq > 150e9:
+            fl_ = splev(ell, spl) * (1 + f(freq / 1e9, corr2) + ell * f(freq / 1e9, corr1))
+        else:
+            fl_ = np.zeros(len(ell))
+            fl_ = splev(ell[ell < ell.max() * freq / 150e9], spl) * \
+                   (1 + f(freq / 1e9, corr2) + ell[ell < ell.max() * freq / 150e9] * f(freq / 1e9, corr1))
+    fl = np.sqrt(fl_)
+    fl[np.isnan(fl)] = 0.
+    fl.setflags(write=False)
+    _RIPPLES_WINDOW_CACHE[freq] = fl
+    return fl
 
 class ConvolutionRingOperator(ConvolutionRippledGaussianOperator):
     def __init__(self, freq,
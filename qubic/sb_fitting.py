@@ -20,8 +20,10 @@ import datetime as dt
 import sys
 import healpy as hp
 import time
-import numexpr as ne
 import pickle
+import copy
+import os
+from multiprocessing import Pool, cpu_count
 
 
 def get_hpmap(TESNum, directory):
@@ -51,11 +53,11 @@ def show_lines(maps, nums, min=None, max=None):
     tight_layout()
 
 
-def get_flatmap(TESNum, directory, azmin=None, azmax=None, elmin=None, elmax=None, remove=None,
-                fitted_directory=None):
-    themap = np.array(FitsArray(directory + '/Flat/imgflat_TESNum_{}.fits'.format(TESNum)))
-    az = np.array(FitsArray(directory + '/Flat/azimuth.fits'.format(TESNum)))
-    el = np.array(FitsArray(directory + '/Flat/elevation.fits'.format(TESNum)))
+def get_flat_grids(directory, azmin=None, azmax=None, elmin=None, elmax=None):
+    ### Azimuth and elevation of the flat maps, common to all the TES, and the selection of the pixels
+    ### within the requested range
+    az = np.array(FitsArray(directory + '/Flat/azimuth.fits'))
+    el = np.array(FitsArray(directory + '/Flat/elevation.fits'))
     if azmin is None:
         azmin = np.min(az)
     if azmax is None:
@@ -65,9 +67,17 @@ def get_flatmap(TESNum, directory, azmin=None, azmax=None, elmin=None, elmax=Non
     if elmax is None:
         elmax = np.max(el)
     okaz = (az >= azmin) & (az <= azmax)
-    az = az[okaz]
     okel = (el >= elmin) & (el <= elmax)
-    el = el[okel]
+    return az[okaz], el[okel], okaz, okel
+
+
+def get_flatmap(TESNum, directory, azmin=None, azmax=None, elmin=None, elmax=None, remove=None,
+                fitted_directory=None, grids=None):
+    ### grids: output of get_flat_grids, to avoid reading the azimuth and elevation for each TES
+    themap = np.array(FitsArray(directory + '/Flat/imgflat_TESNum_{}.fits'.format(TESNum)))
+    if grids is None:
+        grids = get_flat_grids(directory, azmin=azmin, azmax=azmax, elmin=elmin, elmax=elmax)
+    az, el, okaz, okel = grids
     themap = themap[:, okaz][okel, :]
     if remove is not None:
         mm = np.mean(remove)
@@ -177,6 +187,77 @@ def rotate_q2m(thin, phin, angs=np.radians(np.array([0., 90., 0.])), inverse=Fal
     return uv2thph(uvecout)
 
 
+def _get_peaks_positions(xxyy, pars, masked_distortion=True):
+    """
+    Positions (2, npeaks) of the peaks of the square grid xxyy for the geometrical parameters pars[0:8]
+    (center, interpeak distance, orientation angle and distortion) of the synthesized beam models, and
+    their derivatives (2, npeaks, 8) with respect to these parameters. If masked_distortion is True, the
+    distortion is not applied to the peaks on the central row (in X) or column (in Y) of the grid.
+
+    """
+    xc, yc, dist, angle, distx, distpowerX, disty, distpowerY = pars[0:8]
+    cosang = np.cos(np.radians(angle))
+    sinang = np.sin(np.radians(angle))
+    ### Rotated and scaled grid centered on (0, 0), and its derivative with respect to the angle
+    rxy = np.array([cosang * xxyy[0] - sinang * xxyy[1], sinang * xxyy[0] + cosang * xxyy[1]])
+    uxy = dist * rxy
+    duxy_dangle = np.radians(dist) * np.array([-rxy[1], rxy[0]])
+    newxy = uxy.copy()
+    newxy[0] += xc
+    newxy[1] += yc
+    dnewxy = np.zeros((2, xxyy.shape[1], 8))
+    dnewxy[0, :, 0] = 1
+    dnewxy[1, :, 1] = 1
+    dnewxy[:, :, 2] = rxy
+    dnewxy[:, :, 3] = duxy_dangle
+    ### Distortion of X by Y and of Y by X: amp * |u|**power
+    for k, (amp, power) in enumerate([(distx, distpowerX), (disty, distpowerY)]):
+        u = uxy[1 - k]
+        absu = np.abs(u)
+        nonzero = absu != 0
+        if masked_distortion:
+            active = nonzero
+        else:
+            active = np.ones(len(u), bool)
+        upow = absu ** power
+        ### Derivative of |u|**power with respect to u, set to zero at u=0
+        dupow = np.zeros(len(u))
+        dupow[nonzero] = power * absu[nonzero] ** (power - 1) * np.sign(u[nonzero])
+        logu = np.zeros(len(u))
+        logu[nonzero] = np.log(absu[nonzero])
+        newxy[k, active] += amp * upow[active]
+        dnewxy[k, active, 2] += amp * dupow[active] * rxy[1 - k, active]
+        dnewxy[k, active, 3] += amp * dupow[active] * duxy_dangle[1 - k, active]
+        dnewxy[k, active, 4 + 2 * k] = upow[active]
+        dnewxy[k, active, 5 + 2 * k] = amp * upow[active] * logu[active]
+    return newxy, dnewxy
+
+
+def _gaussian_peaks(x2d, y2d, xpeaks, ypeaks, amps, sigmas, nsig=None, gradient=False):
+    """
+    Sum of the Gaussian peaks of amplitudes amps and widths sigmas centered on (xpeaks, ypeaks), computed for
+    all the peaks at once as a (npeaks, npix) array. If nsig is not None, each peak is truncated beyond nsig
+    sigmas of its center. With gradient=True, also returns the (npeaks, npix) derivatives of the map with
+    respect to the amplitude, the position and the width of each peak.
+
+    """
+    dx = np.ravel(x2d)[None, :] - np.asarray(xpeaks)[:, None]
+    dy = np.ravel(y2d)[None, :] - np.asarray(ypeaks)[:, None]
+    invsig2 = 1. / np.asarray(sigmas)[:, None] ** 2
+    r2 = dx ** 2 + dy ** 2
+    if nsig is None:
+        gauss = np.exp(-0.5 * r2 * invsig2)
+    else:
+        inside = r2 * invsig2 < nsig ** 2
+        gauss = np.zeros(r2.shape)
+        np.exp(-0.5 * r2 * invsig2, out=gauss, where=inside)
+    peaks = np.asarray(amps)[:, None] * gauss
+    themap = np.reshape(np.sum(peaks, axis=0), np.shape(x2d))
+    if not gradient:
+        return themap
+    return themap, gauss, peaks * dx * invsig2, peaks * dy * invsig2, peaks * r2 * invsig2 / np.asarray(sigmas)[:, None]
+
+
 #######################################################################################################################################
 # ######################################################################################################################################
 class SimpleSbModel:
@@ -204,7 +285,7 @@ class SimpleSbModel:
     [12]: FWHM of primary beam [deg]
     """
 
-    def __init__(self, startpars=None, ranges=None, fixpars=None, nrings=2, extra_args=None):
+    def __init__(self, startpars=None, ranges=None, fixpars=None, nrings=2, extra_args=None, nsig=None):
         ### Preparing the grid of peaks
         self.name = 'SimpleSbModel'
         self.nrings = nrings
@@ -240,62 +321,51 @@ class SimpleSbModel:
 
         ### Possible extra-arguments
         self.extra_args = extra_args
+        ### Truncation of the peaks beyond nsig sigmas (no truncation if None)
+        self.nsig = nsig
+
+    def _evaluate(self, x, pars, gradient=False):
+        pars = np.asarray(pars, dtype=float)
+        ### Peaks positions and amplitudes from the primary beam
+        newxy, dnewxy = _get_peaks_positions(self.xxyy, pars, masked_distortion=False)
+        sigprim = pars[12] / 2.35
+        dxprim = pars[10] - newxy[0]
+        dyprim = pars[11] - newxy[1]
+        prim = np.exp(-0.5 * (dxprim ** 2 + dyprim ** 2) / sigprim ** 2)
+        amps = pars[9] * prim
+        sigmas = np.zeros(self.npeaks) + pars[8] / 2.35
+        result = _gaussian_peaks(x[0], x[1], newxy[0], newxy[1], amps, sigmas, nsig=self.nsig, gradient=gradient)
+        if not gradient:
+            return result, newxy, amps
+        themap, gauss, dmap_dx, dmap_dy, dmap_dsig = result
+        ### The amplitudes also depend on the positions of the peaks through the primary beam
+        dmap_dx += gauss * (amps * dxprim / sigprim ** 2)[:, None]
+        dmap_dy += gauss * (amps * dyprim / sigprim ** 2)[:, None]
+        grad = np.zeros((self.npars, gauss.shape[1]))
+        grad[0:8] = np.dot(dnewxy[0].T, dmap_dx) + np.dot(dnewxy[1].T, dmap_dy)
+        grad[8] = np.sum(dmap_dsig, axis=0) / 2.35
+        grad[9] = np.dot(prim, gauss)
+        grad[10] = -np.dot(amps * dxprim / sigprim ** 2, gauss)
+        grad[11] = -np.dot(amps * dyprim / sigprim ** 2, gauss)
+        grad[12] = np.dot(amps * (dxprim ** 2 + dyprim ** 2) / sigprim ** 3, gauss) / 2.35
+        return grad
 
     def __call__(self, x, pars, return_peaks=False):
-        x2d = x[0]  # The Azimuth values of the pixels
-        y2d = x[1]  # The elevation values of the pixels
-        # The parameters ##########################################
-        xc = pars[0]
-        yc = pars[1]
-        dist = pars[2]
-        angle = pars[3]
-        distx = pars[4]
-        distpowerX = pars[5]
-        disty = pars[6]
-        distpowerY = pars[7]
-        fwhmpeaks = pars[8]
-        ampgauss = pars[9]
-        xcgauss = pars[10]
-        ycgauss = pars[11]
-        fwhmgauss = pars[12]
-
-        # Peaks positions #########################################
-        # Rotate initial Grid centered on (0,0)
-        cosang = np.cos(np.radians(angle))
-        sinang = np.sin(np.radians(angle))
-        rotmat = np.array([[cosang, -sinang], [sinang, cosang]])
+        themap, newxy, amps = self._evaluate(x, pars)
         newxxyy = np.zeros((4, self.npeaks))
-        for i in range(self.npeaks):
-            newxxyy[0:2, i] = np.dot(rotmat, self.xxyy[:, i])
-        # Scale it wit interpeak distance
-        newxxyy *= dist
-        # Apply Distorsions
-        undistxxyy = newxxyy.copy()
-        newxxyy[0, :] += distx * np.abs(undistxxyy[1, :]) ** distpowerX
-        newxxyy[1, :] += disty * np.abs(undistxxyy[0, :]) ** distpowerY
-        # Move to actual center
-        newxxyy[0, :] += xc
-        newxxyy[1, :] += yc
-
-        ### Peak amplitudes and resulting map #######################
-        themap = np.zeros(x2d.shape)
-        amps = np.zeros(self.npeaks)
-        for i in range(self.npeaks):
-            amp = ampgauss * np.exp(
-                -0.5 * ((xcgauss - newxxyy[0, i]) ** 2 + (ycgauss - newxxyy[1, i]) ** 2) / (fwhmgauss / 2.35) ** 2)
-            x0 = newxxyy[0, i]
-            y0 = newxxyy[1, i]
-            sig = fwhmpeaks / 2.35
-            themap += ne.evaluate("amp * exp(-0.5*((x2d-x0)**2 + (y2d-y0)**2)/sig**2)")
-
+        newxxyy[0:2, :] = newxy
         newxxyy[2, :] = amps
-        newxxyy[3, :] = fwhmpeaks
+        newxxyy[3, :] = pars[8]
 
         if return_peaks:
             return themap, newxxyy
         else:
             return np.ravel(themap)
 
+    def gradient(self, x, pars):
+        ### Derivatives (npars, npix) of the flattened map with respect to the parameters
+        return self._evaluate(x, pars, gradient=True)
+
     def print_start(self):
         print('|---------------------------------------------------------------------|')
         print('|-------------------- Initial Parameters -----------------------------|')
@@ -343,7 +413,7 @@ class SbModelIndepPeaksAmpFWHM:
     """
 
     def __init__(self, startpars=None, ranges=None, fixpars=None, nrings=2, extra_args=None, verbose=False,
-                 common_fwhm=False):
+                 common_fwhm=False, nsig=None):
         ### Preparing the grid of peaks
         self.name = 'SbModelIndepPeaksAmpFWHM'
         self.common_fwhm = common_fwhm
@@ -405,65 +475,34 @@ class SbModelIndepPeaksAmpFWHM:
 
         ### Possible extra-arguments
         self.extra_args = extra_args
+        ### Truncation of the peaks beyond nsig sigmas (no truncation if None)
+        self.nsig = nsig
 
         if verbose: self.print_start()
 
-    def __call__(self, x, pars, return_peaks=False):
-        x2d = x[0]  # The Azimuth values of the pixels
-        xmin = np.min(x2d)
-        xmax = np.max(x2d)
-        y2d = x[1]  # The elevation values of the pixels
-        ymin = np.min(y2d)
-        ymax = np.max(y2d)
-        # The parameters ##########################################
-        xc = pars[0]
-        yc = pars[1]
-        dist = pars[2]
-        angle = pars[3]
-        distx = pars[4]
-        distpowerX = pars[5]
-        disty = pars[6]
-        distpowerY = pars[7]
-        fwhmpeaks_av = pars[8]
-        amps = np.zeros(self.npeaks)
-        fwhmpeaks = np.zeros(self.npeaks)
-        for i in range(self.npeaks):
-            amps[i] = pars[9 + 2 * i]
-            fwhmpeaks[i] = fwhmpeaks_av + pars[9 + 2 * i + 1]
-
-        ### Peaks positions #########################################
-        # Rotate initial Grid centered on (0,0)
-        cosang = np.cos(np.radians(angle))
-        sinang = np.sin(np.radians(angle))
-        rotmat = np.array([[cosang, -sinang], [sinang, cosang]])
-        newxxyy = np.zeros((4, self.npeaks))
-        for i in range(self.npeaks): newxxyy[0:2, i] = np.dot(rotmat, self.xxyy[:, i])
-        # Scale it wit interpeak distance
-        newxxyy *= dist
-        # Apply Distorsions
-        undistxxyy = newxxyy.copy()
-        yok = undistxxyy[1, :] != 0
-        newxxyy[0, yok] += distx * np.abs(undistxxyy[1, yok]) ** distpowerX
-        xok = undistxxyy[0, :] != 0
-        newxxyy[1, xok] += disty * np.abs(undistxxyy[0, xok]) ** distpowerY
-        # Move to actual center
-        newxxyy[0, :] += xc
-        newxxyy[1, :] += yc
-        if ~(np.product(np.isfinite(newxxyy)).astype(bool)):
+    def _evaluate(self, x, pars, gradient=False):
+        pars = np.asarray(pars, dtype=float)
+        amps = pars[9::2]
+        fwhmpeaks = pars[8] + pars[10::2]
+        newxy, dnewxy = _get_peaks_positions(self.xxyy, pars, masked_distortion=True)
+        if not np.all(np.isfinite(newxy)):
             stop
+        result = _gaussian_peaks(x[0], x[1], newxy[0], newxy[1], amps, fwhmpeaks / 2.35, nsig=self.nsig,
+                                 gradient=gradient)
+        if not gradient:
+            return result, newxy, amps, fwhmpeaks
+        themap, gauss, dmap_dx, dmap_dy, dmap_dsig = result
+        grad = np.zeros((self.npars, gauss.shape[1]))
+        grad[0:8] = np.dot(dnewxy[0].T, dmap_dx) + np.dot(dnewxy[1].T, dmap_dy)
+        grad[8] = np.sum(dmap_dsig, axis=0) / 2.35
+        grad[9::2] = gauss
+        grad[10::2] = dmap_dsig / 2.35
+        return grad
 
-        ### Peak amplitudes and resulting map #######################
-        # themap = np.zeros(x2d.shape)
-        # for i in range(self.npeaks):
-        # 	themap += amps[i]*np.exp(-((x2d-newxxyy[0,i])**2 +(y2d-newxxyy[1,i])**2)/(2*(fwhmpeaks[i]/2.35)**2) )
-        themap = np.zeros(x2d.shape)
-        for i in range(self.npeaks):
-            amp = amps[i]
-            x0 = newxxyy[0, i]
-            y0 = newxxyy[1, i]
-            sig = fwhmpeaks[i] / 2.35
-            themap += ne.evaluate("amp * exp(-0.5*((x2d-x0)**2 + (y2d-y0)**2)/sig**2)")
-
+    def __call__(self, x, pars, return_peaks=False):
+        themap, newxy, amps, fwhmpeaks = self._evaluate(x, pars)
+        newxxyy = np.zeros((4, self.npeaks))
+        newxxyy[0:2, :] = newxy
         newxxyy[2, :] = amps
         newxxyy[3, :] = fwhmpeaks
 
@@ -472,6 +511,10 @@ class SbModelIndepPeaksAmpFWHM:
         else:
             return np.ravel(themap)
 
+    def gradient(self, x, pars):
+        ### Derivatives (npars, npix) of the flattened map with respect to the parameters
+        return self._evaluate(x, pars, gradient=True)
+
     def print_start(self):
         print('|---------------------------------------------------------------------|')
         print('|-------------------- Initial Parameters -----------------------------|')
@@ -526,7 +569,7 @@ class SbModelIndepPeaks:
     """
 
     def __init__(self, startpars=None, ranges=None, fixpars=None, nrings=2, extra_args=None, verbose=False,
-                 common_fwhm=False, no_xy_shift=False, distortion=True):
+                 common_fwhm=False, no_xy_shift=False, distortion=True, nsig=None):
         ### Preparing the grid of peaks
         self.name = 'SbModelIndepPeaks'
         self.common_fwhm = common_fwhm
@@ -608,75 +651,46 @@ class SbModelIndepPeaks:
 
         ### Possible extra-arguments
         self.extra_args = extra_args
+        ### Truncation of the peaks beyond nsig sigmas (no truncation if None)
+        self.nsig = nsig
         self.time = time.time()
         self.ncalls = 1
 
         if verbose:
             self.print_start()
 
+    def _evaluate(self, x, pars, gradient=False):
+        pars = np.asarray(pars, dtype=float)
+        amps = pars[9::4]
+        fwhmpeaks = pars[8] + pars[10::4]
+        newxy, dnewxy = _get_peaks_positions(self.xxyy, pars, masked_distortion=True)
+        ### Individual shifts of the peaks
+        newxy[0] += pars[11::4]
+        newxy[1] += pars[12::4]
+        if not np.all(np.isfinite(newxy)):
+            stop
+        result = _gaussian_peaks(x[0], x[1], newxy[0], newxy[1], amps, fwhmpeaks / 2.35, nsig=self.nsig,
+                                 gradient=gradient)
+        if not gradient:
+            return result, newxy, amps, fwhmpeaks
+        themap, gauss, dmap_dx, dmap_dy, dmap_dsig = result
+        grad = np.zeros((self.npars, gauss.shape[1]))
+        grad[0:8] = np.dot(dnewxy[0].T, dmap_dx) + np.dot(dnewxy[1].T, dmap_dy)
+        grad[8] = np.sum(dmap_dsig, axis=0) / 2.35
+        grad[9::4] = gauss
+        grad[10::4] = dmap_dsig / 2.35
+        grad[11::4] = dmap_dx
+        grad[12::4] = dmap_dy
+        return grad
+
     def __call__(self, x, pars, return_peaks=False):
         # t0 = time.time()
         # self.ncalls += 1
         # print('Call #{0} - {1:5.2f} ms '.format(self.ncalls, 1000*(t0-self.time)))
         # self.time = t0
-        x2d, y2d = x  # The Azimuth and elevation values of the pixels
-
-        # The parameters ##########################################
-        xc = pars[0]
-        yc = pars[1]
-        dist = pars[2]
-        angle = pars[3]
-        distx = pars[4]
-        distpowerX = pars[5]
-        disty = pars[6]
-        distpowerY = pars[7]
-        fwhmpeaks_av = pars[8]
-        amps = np.zeros(self.npeaks)
-        fwhmpeaks = np.zeros(self.npeaks)
-        dx = np.zeros(self.npeaks)
-        dy = np.zeros(self.npeaks)
-        for i in range(self.npeaks):
-            amps[i] = pars[9 + 4 * i]
-            fwhmpeaks[i] = fwhmpeaks_av + pars[9 + 4 * i + 1]
-            dx[i] = pars[9 + 4 * i + 2]
-            dy[i] = pars[9 + 4 * i + 3]
-
-        ### Peaks positions #########################################
-        # Rotate initial Grid centered on (0,0)
-        cosang = np.cos(np.radians(angle))
-        sinang = np.sin(np.radians(angle))
-        rotmat = np.array([[cosang, -sinang], [sinang, cosang]])
+        themap, newxy, amps, fwhmpeaks = self._evaluate(x, pars)
         newxxyy = np.zeros((4, self.npeaks))
-        for i in range(self.npeaks): newxxyy[0:2, i] = np.dot(rotmat, self.xxyy[:, i])
-        # Scale it wit interpeak distance
-        newxxyy *= dist
-        # Apply Distorsions
-        undistxxyy = newxxyy.copy()
-        yok = undistxxyy[1, :] != 0
-        newxxyy[0, yok] += distx * np.abs(undistxxyy[1, yok]) ** distpowerX
-        xok = undistxxyy[0, :] != 0
-        newxxyy[1, xok] += disty * np.abs(undistxxyy[0, xok]) ** distpowerY
-        # Move to actual center
-        newxxyy[0, :] += xc + dx
-        newxxyy[1, :] += yc + dy
-        if ~(np.product(np.isfinite(newxxyy)).astype(bool)):
-            stop
-
-        ### Peak amplitudes and resulting map #######################
-        # themap = np.zeros(np.shape(x2d))
-        # for i in range(self.npeaks):
-        # 	themap += amps[i]*np.exp(-((x2d-newxxyy[0,i])**2 +(y2d-newxxyy[1,i])**2)/(2*(fwhmpeaks[i]/2.35)**2) )
-
-        ### Peak amplitudes and resulting map #######################
-        ### Much faster version (gain ~3.5)
-        themap = np.zeros(x2d.shape)
-        for i in range(self.npeaks):
-            amp = amps[i]
-            x0 = newxxyy[0, i]
-            y0 = newxxyy[1, i]
-            sig = fwhmpeaks[i] / 2.35
-            themap += ne.evaluate("amp * exp(-0.5*((x2d-x0)**2 + (y2d-y0)**2)/sig**2)")
-
+        newxxyy[0:2, :] = newxy
         newxxyy[2, :] = amps
         newxxyy[3, :] = fwhmpeaks
 
@@ -685,6 +699,10 @@ class SbModelIndepPeaks:
         else:
             return np.ravel(themap)
 
+    def gradient(self, x, pars):
+        ### Derivatives (npars, npix) of the flattened map with respect to the parameters
+        return self._evaluate(x, pars, gradient=True)
+
     def print_start(self):
         print('|---------------------------------------------------------------------|')
         print('|-------------------- Initial Parameters -----------------------------|')
@@ -879,3 +897,116 @@ def fit_sb(flatmap_init, az_init, el_init, model, newsize=70, dmax=5., az_center
         return fit, newxxyy, themap
     else:
         return fit, newxxyy
+
+
+def load_fit_sb_all(filename):
+    """
+    Reads the results written by fit_sb_all as a dictionary indexed by TES number. A record truncated by
+    an interruption is ignored and removed from the file, so that new records can be appended.
+
+    """
+    results = {}
+    if not os.path.exists(filename):
+        return results
+    with open(filename, 'r+b') as thefile:
+        end = 0
+        while True:
+            try:
+                record = pickle.load(thefile)
+            except Exception:
+                break
+            results[record['TESNum']] = record
+            end = thefile.tell()
+        thefile.truncate(end)
+    return results
+
+
+_FIT_SB_ALL = {}
+
+
+def _init_fit_sb_all(shared):
+    _FIT_SB_ALL.update(shared)
+
+
+def _fit_sb_tes(TESNum):
+    ### Fit of one TES in a worker of fit_sb_all, the grids and the model being shared through _FIT_SB_ALL.
+    ### fit_sb modifies the starting parameters of the model, so each TES starts from a copy.
+    shared = _FIT_SB_ALL
+    try:
+        flatmap, az, el = get_flatmap(TESNum, shared['directory'], remove=shared['remove'], grids=shared['grids'])
+        model = copy.deepcopy(shared['model'])
+        fit, newxxyy, fitmap = fit_sb(flatmap, az, el, model, doplot=False, return_fitted=True,
+                                      **shared['kwargs'])
+    except Exception as error:
+        return TESNum, None, '{}: {}'.format(type(error).__name__, error)
+    record = {'TESNum': TESNum,
+              'fitpars': fit[1],
+              'fiterrs': fit[2],
+              'covariance': fit[3],
+              'chi2': fit[4],
+              'ndf': fit[5],
+              'newxxyy': newxxyy,
+              'residuals': np.sum((flatmap - fitmap) ** 2) / np.size(flatmap)}
+    return TESNum, record, None
+
+
+def fit_sb_all(directory, tes_list, model, nprocs=None, filename=None, azmin=None, azmax=None, elmin=None,
+               elmax=None, remove=None, verbose=True, **kwargs):
+    """
+    Fits the synthesized beam of each TES of tes_list in the flat maps of directory with fit_sb, the fits
+    being distributed over nprocs processes (all the CPUs by default). The azimuth and elevation grids are
+    read once and shared by all the fits, and the keywords kwargs are passed to fit_sb.
+
+    The results are appended to filename (directory/fit_sb_all.pk by default) as soon as each fit is done,
+    so that a run that is interrupted can be resumed without fitting again the TES already in the file.
+    Returns the dictionary indexed by TES number of all the results in the file (see load_fit_sb_all).
+    Each result contains the fitted parameters, their errors and covariance, the chi2 and number of
+    degrees of freedom, the positions and amplitudes of the peaks and the mean squared residuals per pixel.
+
+    """
+    if filename is None:
+        filename = directory + '/fit_sb_all.pk'
+    results = load_fit_sb_all(filename)
+    todo = [TESNum for TESNum in tes_list if TESNum not in results]
+    if verbose:
+        print('fit_sb_all: {} TES already fitted in {}, {} to fit'.format(len(tes_list) - len(todo), filename,
+                                                                            len(todo)))
+    if len(todo) == 0:
+        return results
+
+    shared = {'directory': directory,
+              'grids': get_flat_grids(directory, azmin=azmin, azmax=azmax, elmin=elmin, elmax=elmax),
+              'model': model,
+              'remove': remove,
+              'kwargs': kwargs}
+    if nprocs is None:
+        nprocs = cpu_count()
+    nprocs = min(nprocs, len(todo))
+    if nprocs == 1:
+        _init_fit_sb_all(shared)
+        pool = None
+        fits = (_fit_sb_tes(TESNum) for TESNum in todo)
+    else:
+        pool = Pool(nprocs, initializer=_init_fit_sb_all, initargs=(shared,))
+        fits = pool.imap_unordered(_fit_sb_tes, todo)
+
+    try:
+        with open(filename, 'ab') as thefile:
+            for TESNum, record, error in fits:
+                if record is None:
+                    print('fit_sb_all: fit of TES {} failed - {}'.format(TESNum, error))
+                    continue
+                pickle.dump(record, thefile, protocol=2)
+                thefile.flush()
+                os.fsync(thefile.fileno())
+                results[TESNum] = record
+                if verbose:
+                    print('fit_sb_all: TES {} done'.format(TESNum))
+    finally:
+        if pool is None:
+            ### The grids and the model are not kept alive after the serial fits
+            _FIT_SB_ALL.clear()
+        else:
+            pool.terminate()
+            pool.join()
+    return results
@@ -888,16 +888,18 @@ def get_mean_cov(vals, invcov):
 
 
 # ============ Functions to get auto and cross spectra from maps ===========#
-def get_xpol(seenmap, ns, lmin=20, delta_ell=20, apodization_degrees=5.):
+def get_xpol(seenmap, ns, lmin=20, delta_ell=20, apodization_degrees=5.,
+             cache_dir=None):
     """
     Returns a Xpoll object to get spectra, the bin used and the pixel window function.
+    The mode-coupling matrices are stored in cache_dir if specified.
     """
     # Create a mask
     mymask = apodize_mask(seenmap, apodization_degrees)
 
     # Create XPol object
     lmax = 2 * ns
-    xpol = Xpol(mymask, lmin, lmax, delta_ell)
+    xpol = Xpol(mymask, lmin, lmax, delta_ell, cache_dir=cache_dir)
     ell_binned = xpol.ell_binned
     # Pixel window function
     pw = hp.pixwin(ns)
@@ -906,38 +908,18 @@ def get_xpol(seenmap, ns, lmin=20, delta_ell=20, apodization_degrees=5.):
     return xpol, ell_binned, pwb
 
 
-def allcross_par(xpol, allmaps, silent=False, verbose=1):
-    num_cores = multiprocessing.cpu_count()
+def allcross_par(xpol, allmaps, silent=False):
     nmaps = len(allmaps)
-    nbl = len(xpol.ell_binned)
-    autos = np.zeros((nmaps, 6, nbl))
-    ncross = nmaps * (nmaps - 1) / 2
-    cross = np.zeros((ncross, 6, nbl))
-    jcross = 0
+    ncross = nmaps * (nmaps - 1) // 2
     if not silent:
         print('Computing spectra:')
+        print('  Doing All Autos ({}) and All Cross ({}):'.format(nmaps, ncross))
 
-    # Auto spectra ran in //
-    if not silent:
-        print('  Doing All Autos ({}):'.format(nmaps))
-    results_auto = Parallel(n_jobs=num_cores, verbose=verbose)(
-        delayed(xpol.get_spectra)(allmaps[i]) for i in range(nmaps))
-    for i in range(nmaps):
-        autos[i, :, :] = results_auto[i][1]
-
-    # Cross Spectra ran in // - need to prepare indices in a global variable
-    if not silent:
-        print('  Doing All Cross ({}):'.format(ncross))
-    global cross_indices
-    cross_indices = np.zeros((2, ncross), dtype=int)
-    for i in range(nmaps):
-        for j in range(i + 1, nmaps):
-            cross_indices[:, jcross] = np.array([i, j])
-            jcross += 1
-    results_cross = Parallel(n_jobs=num_cores, verbose=verbose)(
-        delayed(xpol.get_spectra)(allmaps[cross_indices[0, i]], allmaps[cross_indices[1, i]]) for i in range(ncross))
-    for i in range(ncross):
-        cross[i, :, :] = results_cross[i][1]
+    # The alms of each map are computed once for the autos and the crosses
+    i, j = np.triu_indices(nmaps)
+    unbiased = xpol.get_spectra_many(allmaps)[1]
+    autos = unbiased[i == j]
+    cross = unbiased[i < j]
 
     if not silent:
         sys.stdout.write(' Done \n')
@@ -953,7 +935,8 @@ def allcross_par(xpol, allmaps, silent=False, verbose=1):
     return m_autos, s_autos, m_cross, s_cross
 
 
-def get_maps_cl(frec, fconv=None, lmin=20, delta_ell=40, apodization_degrees=5.):
+def get_maps_cl(frec, fconv=None, lmin=20, delta_ell=40, apodization_degrees=5.,
+                cache_dir=None):
     mrec, resid, seenmap = get_maps_residuals(frec, fconv=fconv)
     sh = np.shape(mrec)
     print(sh, np.shape(resid))
@@ -966,7 +949,7 @@ def get_maps_cl(frec, fconv=None, lmin=20, delta_ell=40, apodization_degrees=5.)
     # Create XPol object
     from qubic import Xpol
     lmax = 2 * ns
-    xpol = Xpol(mymask, lmin, lmax, delta_ell)
+    xpol = Xpol(mymask, lmin, lmax, delta_ell, cache_dir=cache_dir)
     ell_binned = xpol.ell_binned
     nbins = len(ell_binned)
     # Pixel window function
@@ -981,7 +964,7 @@ def get_maps_cl(frec, fconv=None, lmin=20, delta_ell=40, apodization_degrees=5.)
     fact = ell_binned * (ell_binned + 1) / 2. / np.pi
     for isub in range(nbsub):
         m_autos[isub, :, :], s_autos[isub, :, :], m_cross[isub, :, :], s_cross[isub, :, :] = \
-            allcross_par(xpol, mrec[:, isub, :, :], silent=False, verbose=0)
+            allcross_par(xpol, mrec[:, isub, :, :], silent=False)
 
     return mrec, resid, seenmap, ell_binned, m_autos * fact / pwb ** 2, \
            s_autos * fact / pwb ** 2, m_cross * fact / pwb ** 2, s_cross * fact / pwb ** 2
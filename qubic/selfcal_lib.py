@@ -1,6 +1,8 @@
 from __future__ import division, print_function
 
 import glob
+import os
+from collections import OrderedDict
 
 import numpy as np
 import healpy as hp
@@ -20,7 +22,12 @@ import qubic
 from qubicpack.utilities import Qubic_DataDir
 from qubicpack.pixel_translation import make_id_focalplane, tes2index
 
-__all__ = ['SelfCalibration']
+__all__ = ['SelfCalibration', 'HornFields']
+
+# labels memoized by make_labels, keyed by the vertices file, its modification time and the image
+# definition. The least recently used entries are evicted beyond _LABELS_CACHE_SIZE.
+_LABELS_CACHE = OrderedDict()
+_LABELS_CACHE_SIZE = 8
 
 
 class SelfCalibration:
@@ -96,6 +103,36 @@ class SelfCalibration:
         else:
             print('There is no dead detectors in this calfile')
 
+    def get_horn_configurations(self, nhorns=64):
+        """
+        Open horns of the configurations used for the self-calibration: all open, all open except i,
+        except j, except i and j, only i open, only j open, only i and j open.
+        The dead switches are closed in the first four configurations.
+
+        Parameters
+        ----------
+        nhorns : int
+            Number of horns in the horn array.
+
+        Returns
+        -------
+        configs : boolean array of shape (7, nhorns)
+            True for the open horns of each configuration.
+
+        """
+        i, j = self.baseline[0] - 1, self.baseline[1] - 1
+        configs = np.zeros((7, nhorns), dtype=bool)
+        configs[0:4] = True
+        if self.dead_switches is not None:
+            configs[0:4, np.array(self.dead_switches) - 1] = False
+        configs[1, i] = False
+        configs[2, j] = False
+        configs[3, [i, j]] = False
+        configs[4, i] = True
+        configs[5, j] = True
+        configs[6, [i, j]] = True
+        return configs
+
     def get_power_combinations(self, q, theta=np.array([0.]), phi=np.array([0.]), nu=150e9,
                                spectral_irradiance=1.,
                                reso=34, xmin=-0.06, xmax=0.06, doplot=True):
@@ -130,113 +167,26 @@ class SelfCalibration:
 
         """
 
-        # All open
-        q.horn.open = True
-        if self.dead_switches is not None:
-            for i in self.dead_switches:
-                q.horn.open[i - 1] = False
-        S = get_power_on_array(q, theta, phi, nu, spectral_irradiance, reso, xmin, xmax)
-        if doplot:
-            plt.figure()
-            plt.subplot(4, 4, 1)
-            q.horn.plot()
-            plt.axis('off')
-            plt.subplot(4, 4, 2)
-            plt.imshow(S[:, :, 0], origin='lower')
-            plt.colorbar()
-            plt.title('$S$')
-
-        # All open except i
-        q.horn.open = True
-        if self.dead_switches is not None:
-            for i in self.dead_switches:
-                q.horn.open[i - 1] = False
-        q.horn.open[self.baseline[0] - 1] = False
-        Cminus_i = get_power_on_array(q, theta, phi, nu, spectral_irradiance, reso, xmin, xmax)
-        if doplot:
-            plt.subplot(4, 4, 3)
-            q.horn.plot()
-            plt.axis('off')
-            plt.subplot(4, 4, 4)
-            plt.imshow(Cminus_i[:, :, 0], origin='lower')
-            plt.colorbar()
-            plt.title('$C_{-i}$')
-
-        # All open except j
-        q.horn.open = True
-        if self.dead_switches is not None:
-            for i in self.dead_switches:
-                q.horn.open[i - 1] = False
-        q.horn.open[self.baseline[1] - 1] = False
-        Cminus_j = get_power_on_array(q, theta, phi, nu, spectral_irradiance, reso, xmin, xmax)
-        if doplot:
-            plt.subplot(4, 4, 5)
-            q.horn.plot()
-            plt.axis('off')
-            plt.subplot(4, 4, 6)
-            plt.imshow(Cminus_j[:, :, 0], origin='lower')
-            plt.colorbar()
-            plt.title('$C_{-j}$')
-
-        # All open except baseline [i, j]
-        q.horn.open = True
-        if self.dead_switches is not None:
-            for i in self.dead_switches:
-                q.horn.open[i - 1] = False
-        q.horn.open[self.baseline[0] - 1] = False
-        q.horn.open[self.baseline[1] - 1] = False
-        Sminus_ij = get_power_on_array(q, theta, phi, nu, spectral_irradiance, reso, xmin, xmax)
-        if doplot:
-            plt.subplot(4, 4, 7)
-            q.horn.plot()
-            plt.axis('off')
-            plt.subplot(4, 4, 8)
-            plt.imshow(Sminus_ij[:, :, 0], origin='lower')
-            plt.colorbar()
-            plt.title('$S_{-ij}$')
-
-        # Only i open (not a realistic observable)
-        q.horn.open = False
-        if self.dead_switches is not None:
-            for i in self.dead_switches:
-                q.horn.open[i - 1] = False
-        q.horn.open[self.baseline[0] - 1] = True
-        Ci = get_power_on_array(q, theta, phi, nu, spectral_irradiance, reso, xmin, xmax)
-        if doplot:
-            plt.subplot(4, 4, 9)
-            q.horn.plot()
-            plt.axis('off')
-            plt.subplot(4, 4, 10)
-            plt.imshow(Ci[:, :, 0], origin='lower')
-            plt.colorbar()
-            plt.title('$C_i$')
-
-        # Only j open (not a realistic observable)
-        q.horn.open = False
-        q.horn.open[self.baseline[1] - 1] = True
-        Cj = get_power_on_array(q, theta, phi, nu, spectral_irradiance, reso, xmin, xmax)
-        if doplot:
-            plt.subplot(4, 4, 11)
-            q.horn.plot()
-            plt.axis('off')
-            plt.subplot(4, 4, 12)
-            plt.imshow(Cj[:, :, 0], origin='lower')
-            plt.colorbar()
-            plt.title('$C_j$')
-
-        # Only baseline [i, j] open (not a realistic observable)
-        q.horn.open = False
-        q.horn.open[self.baseline[0] - 1] = True
-        q.horn.open[self.baseline[1] - 1] = True
-        Sij = get_power_on_array(q, theta, phi, nu, spectral_irradiance, reso, xmin, xmax)
-        if doplot:
-            plt.subplot(4, 4, 13)
-            q.horn.plot()
-            plt.axis('off')
-            plt.subplot(4, 4, 14)
-            plt.imshow(Sij[:, :, 0], origin='lower')
-            plt.colorbar()
-            plt.title('$S_{ij}$')
+        # The field of each horn is computed once and the configurations are obtained by summing the fields
+        # of their open horns
+        fields = HornFields(q, theta, phi, nu, spectral_irradiance, reso, xmin, xmax)
+        configs = self.get_horn_configurations(len(q.horn))
+        titles = ['$S$', '$C_{-i}$', '$C_{-j}$', '$S_{-ij}$', '$C_i$', '$C_j$', '$S_{ij}$']
+        powers = []
+        for k in range(len(configs)):
+            q.horn.open = configs[k]
+            powers.append(fields.get_power(configs[k]))
+            if doplot:
+                if k == 0:
+                    plt.figure()
+                plt.subplot(4, 4, 2 * k + 1)
+                q.horn.plot()
+                plt.axis('off')
+                plt.subplot(4, 4, 2 * k + 2)
+                plt.imshow(powers[k][:, :, 0], origin='lower')
+                plt.colorbar()
+                plt.title(titles[k])
+        S, Cminus_i, Cminus_j, Sminus_ij, Ci, Cj, Sij = powers
 
         return S, Cminus_i, Cminus_j, Sminus_ij, Ci, Cj, Sij
 
@@ -401,6 +351,137 @@ class SelfCalibration:
         return fringes_aber
 
 
+class HornFields:
+    """
+    Complex field on the focal plane of each horn of the array, computed once for all the horns, from which
+    the power of any configuration of open horns is obtained by summing the fields of its open horns.
+    The field of the horn h for the pointing k at the position p is A[p, h] * B[h, k], where A is the
+    response from the horns to the focal plane and B the one from the source to the horns, so that the
+    field of a configuration is A . (open * B), as computed by get_power_on_array.
+
+    """
+
+    def __init__(self, q, theta=np.array([0.]), phi=np.array([0.]), nu=150e9, spectral_irradiance=1.,
+                 reso=34, xmin=-0.06, xmax=0.06):
+        """
+
+        Parameters
+        ----------
+        q : a qubic monochromatic instrument
+        theta : array-like
+            The source zenith angle [rad].
+        phi : array-like
+            The source azimuthal angle [rad].
+        nu : float
+            Source frequency in Hz.
+        spectral_irradiance : array-like
+            The source spectral_irradiance [W/m^2/Hz].
+        reso : int
+            Pixel number on one side on the focal plane image
+        xmin : float
+            Position of the border of the focal plane to the center [m]
+        xmax : float
+            Position of the opposite border of the focal plane to the center [m]
+        """
+        self.reso = reso
+        self.nptg = len(theta)
+        xx, yy = np.meshgrid(np.linspace(xmin, xmax, reso), np.linspace(xmin, xmax, reso))
+        x1d = np.ravel(xx)
+        y1d = np.ravel(yy)
+        z1d = x1d * 0 - q.optics.focal_length
+        position = np.array([x1d, y1d, z1d]).T
+
+        # Responses of all the horns, whatever the current configuration of q
+        open_horns = np.array(q.horn.open)
+        q.horn.open = True
+        try:
+            self.A = q._get_response_A(position, q.detector.area, nu, q.horn, q.secondary_beam)
+            B = q._get_response_B(theta, phi, spectral_irradiance, nu, q.horn, q.primary_beam)
+        finally:
+            q.horn.open = open_horns
+        self.B = B.reshape((B.shape[0], -1))
+        self.nhorns = self.B.shape[0]
+
+    def get_fields(self, horns):
+        """
+        Field on the focal plane in the GRF frame of each horn of the list horns (indices from 0).
+
+        Returns
+        -------
+        fields : complex array of shape (#horns, reso * reso, #pointings)
+
+        """
+        horns = np.asarray(horns)
+        return self.A.T[horns][:, :, None] * self.B[horns][:, None, :]
+
+    def _to_power(self, field):
+        # |E|^2 on the (reso, reso) image of the focal plane, in the ONAFP frame
+        power_GRF = np.reshape(np.abs(field) ** 2, field.shape[:-2] + (self.reso, self.reso, self.nptg))
+        return np.rot90(power_GRF, k=-1, axes=(-3, -2))
+
+    def get_power(self, open_horns):
+        """
+        Power on the focal plane for one or several configurations of the horn array.
+
+        Parameters
+        ----------
+        open_horns : boolean array of shape (#horns,) or (#configurations, #horns)
+            True for the open horns.
+
+        Returns
+        -------
+        power : array of shape (reso, reso, #pointings) or (#configurations, reso, reso, #pointings)
+            The power on the focal plane in the ONAFP frame, as given by get_power_on_array.
+
+        """
+        open_horns = np.asarray(open_horns, dtype=float)
+        field = np.dot(self.A, open_horns[..., :, None] * self.B)
+        if open_horns.ndim == 2:
+            field = np.moveaxis(field, 1, 0)
+        return self._to_power(field)
+
+    def get_baselines_power(self, baselines, dead_switches=None):
+        """
+        Power on the focal plane of the configurations of SelfCalibration.get_power_combinations for many
+        baselines at once. The field of all the open horns is computed once and the fields of the horns
+        of each baseline are removed from it.
+
+        Parameters
+        ----------
+        baselines : array-like of shape (#baselines, 2)
+            Horn indices between 1 and 64 as on the instrument.
+            For instance all the baselines: [(i, j) for i in range(1, 64) for j in range(i + 1, 65)]
+        dead_switches : list of int
+            Broken switches, always closed, between 1 and 64.
+
+        Returns
+        -------
+        S : array of shape (reso, reso, #pointings)
+            Power with all the horns open.
+        Cminus_i, Cminus_j, Sminus_ij, Ci, Cj, Sij : arrays of shape (#baselines, reso, reso, #pointings)
+            Power for each configuration and each baseline.
+
+        """
+        baselines = np.asarray(baselines) - 1
+        isopen = np.ones(self.nhorns, dtype=bool)
+        if dead_switches is not None:
+            isopen[np.array(dead_switches) - 1] = False
+        field_all = np.dot(self.A, isopen[:, None] * self.B)
+        # The horns of the baseline only contribute to the total field if their switch works
+        Ei = self.get_fields(baselines[:, 0])
+        Ej = self.get_fields(baselines[:, 1])
+        Ei_all = Ei * isopen[baselines[:, 0], None, None]
+        Ej_all = Ej * isopen[baselines[:, 1], None, None]
+        S = self._to_power(field_all)
+        Cminus_i = self._to_power(field_all - Ei_all)
+        Cminus_j = self._to_power(field_all - Ej_all)
+        Sminus_ij = self._to_power(field_all - Ei_all - Ej_all)
+        Ci = self._to_power(Ei)
+        Cj = self._to_power(Ej)
+        Sij = self._to_power(Ei + Ej)
+        return S, Cminus_i, Cminus_j, Sminus_ij, Ci, Cj, Sij
+
+
 def make_external_A(rep, open_horns):
     """
     Compute external_A from simulated files with aberrations.
@@ -618,24 +699,36 @@ def make_labels(rep, nn=241, ndet=992, img_size=0.12, doplot=True):
             Assign labels to the values of the img. Has to have the same shape as img.
     """
 
-    # Get TES positions of the 4 corners
-    vertices = pd.read_csv(rep + '/vertices.txt', sep='\ ', header=None, engine='python')
-    readv = np.zeros((ndet, 4, 2))
-    for i in range(4):
-        readv[:, i, :] = vertices.iloc[i::4, :]
-
-    labels = np.zeros((nn, nn))
-
-    xx = np.linspace(- img_size / 2., img_size / 2., nn)
-    yy = np.linspace(- img_size / 2., img_size / 2., nn)
-    XX, YY = np.meshgrid(xx, yy)
-
-    for i in range(nn):
-        for j in range(nn):
-            for d in range(0, ndet):
-                if readv[d, 2, 0] <= XX[i, j] <= readv[d, 3, 0] and \
-                        readv[d, 2, 1] <= YY[i, j] <= readv[d, 1, 1]:
-                    labels[i, j] = d+1
+    # The labels only depend on the vertices file and on the image, they are computed once
+    filename = os.path.abspath(rep + '/vertices.txt')
+    key = (filename, os.path.getmtime(filename), nn, ndet, img_size)
+    try:
+        readv, labels = _LABELS_CACHE.pop(key)
+    except KeyError:
+        # Get TES positions of the 4 corners
+        vertices = pd.read_csv(filename, sep='\ ', header=None, engine='python')
+        readv = np.zeros((ndet, 4, 2))
+        for i in range(4):
+            readv[:, i, :] = vertices.iloc[i::4, :]
+
+        labels = np.zeros((nn, nn))
+
+        xx = np.linspace(- img_size / 2., img_size / 2., nn)
+        yy = np.linspace(- img_size / 2., img_size / 2., nn)
+
+        # Range of the image columns (x) and rows (y) inside each TES, bounds included. The TES are
+        # painted in order so that the last one wins on shared edges.
+        jmin = np.searchsorted(xx, readv[:, 2, 0], side='left')
+        jmax = np.searchsorted(xx, readv[:, 3, 0], side='right')
+        imin = np.searchsorted(yy, readv[:, 2, 1], side='left')
+        imax = np.searchsorted(yy, readv[:, 1, 1], side='right')
+        for d in range(ndet):
+            labels[imin[d]:imax[d], jmin[d]:jmax[d]] = d + 1
+        while len(_LABELS_CACHE) >= _LABELS_CACHE_SIZE:
+            _LABELS_CACHE.popitem(last=False)
+    _LABELS_CACHE[key] = readv, labels
+
+    readv, labels = readv.copy(), labels.copy()
     if doplot:
         plt.imshow(labels)
         plt.colorbar()
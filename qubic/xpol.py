@@ -1,11 +1,15 @@
 from __future__ import division
 
+import hashlib
 import healpy as hp
 import numpy as np
+import os
 import pysimulators._flib as flib
 
 __all__ = ['Xpol']
 
+_MLL_BLOCK_NAMES = 'TT_TT', 'EE_EE', 'EE_BB', 'TE_TE', 'EB_EB'
+
 
 class Xpol(object):
     """
@@ -18,9 +22,10 @@ class Xpol(object):
     ell_binned = xpol.ell_binned
     biased, unbiased = xpol.get_spectra(map)
     biased, unbiased = xpol.get_spectra(map1, map2)
+    biased, unbiased = xpol.get_spectra_many([map1, map2, map3])
 
     """
-    def __init__(self, mask, lmin, lmax, delta_ell):
+    def __init__(self, mask, lmin, lmax, delta_ell, cache_dir=None):
         """
         Parameters
         ----------
@@ -33,6 +38,10 @@ class Xpol(object):
             the last l bin is lesser or equal to this value.
         delta_ell :
             The l bin width.
+        cache_dir : str, optional
+            Directory where the mode-coupling matrices are stored, keyed by
+            the mask, lmin, lmax and delta_ell, so that they are computed
+            only once. They are loaded when first required.
 
         """
         mask = np.asarray(mask)
@@ -49,9 +58,27 @@ class Xpol(object):
         self.lmax = lmax
         self.delta_ell = delta_ell
         self.wl = wl
+        self.cache_dir = cache_dir
         self.ell_binned, self._p, self._q = self._bin_ell()
-        mll_binned = self._get_Mll()
-        self.mll_binned_inv = np.linalg.inv(mll_binned)
+
+    @property
+    def mll_binned_inv(self):
+        """
+        The inverse of the binned mode-coupling matrix.
+
+        """
+        if getattr(self, '_mll_binned_inv', None) is None:
+            cache = self._load_cache()
+            if cache is not None and 'mll_binned_inv' in cache:
+                self._mll_binned_inv = cache['mll_binned_inv']
+            else:
+                self._mll_binned_inv = np.linalg.inv(self._get_Mll())
+                self._save_cache()
+        return self._mll_binned_inv
+
+    @mll_binned_inv.setter
+    def mll_binned_inv(self, value):
+        self._mll_binned_inv = value
 
     def bin_spectra(self, spectra):
         """
@@ -116,6 +143,52 @@ class Xpol(object):
         unbiased /= fact_binned
         return biased, unbiased
 
+    def get_spectra_many(self, maps):
+        """
+        Return biased and Xpol-debiased estimations of the power spectra and
+        of the cross-power spectra of the pairs (i, j), i <= j, of a set of
+        Healpix maps.
+
+        xpol = Xpol(mask, lmin, lmax, delta_ell)
+        biased, unbiased = xpol.get_spectra_many(maps)
+        i, j = np.triu_indices(len(maps))
+
+        The spherical harmonic transform of each masked map is computed once,
+        and the spectra of the pair (i[k], j[k]) are those of
+        xpol.get_spectra(maps[i[k]], maps[j[k]]).
+
+        Parameter
+        ---------
+        maps : sequence of Nx3 or 3xN arrays
+            The I, Q, U Healpix maps.
+
+        Returns
+        -------
+        biased : float array of shape (npairs, 6, lmax+1)
+            The pseudo (cross-) power spectra for TT, EE, BB, TE, EB, TB.
+
+        unbiased : float array of shape (npairs, 6, nbins)
+            The Xpol's (cross-) power spectra for TT, EE, BB, TE, EB, TB.
+
+        """
+        alms = []
+        for m in maps:
+            m = np.asarray(m)
+            if m.shape[-1] == 3:
+                m = m.T
+            alms.append(hp.map2alm(m * self.mask, pol=True))
+        pairs = zip(*np.triu_indices(len(alms)))
+        biased = np.array(
+            [[cl[:self.lmax+1] for cl in hp.alm2cl(alms[i], alms[j])]
+             for i, j in pairs])
+        binned = self.bin_spectra(biased)
+        fact_binned = self.ell_binned * (self.ell_binned + 1) / (2 * np.pi)
+        binned *= fact_binned
+        unbiased = np.dot(binned.reshape((len(binned), -1)),
+                          self.mll_binned_inv.T).reshape(binned.shape)
+        unbiased /= fact_binned
+        return biased, unbiased
+
     def _bin_ell(self):
         nbins = (self.lmax - self.lmin + 1) // self.delta_ell
         start = self.lmin + np.arange(nbins) * self.delta_ell
@@ -134,6 +207,12 @@ class Xpol(object):
         return ell_binned, p, q
 
     def _get_Mll_blocks(self):
+        if getattr(self, '_mll_blocks', None) is not None:
+            return self._mll_blocks
+        cache = self._load_cache()
+        if cache is not None:
+            self._mll_blocks = tuple(cache[_] for _ in _MLL_BLOCK_NAMES)
+            return self._mll_blocks
         TT_TT, EE_EE, EE_BB, TE_TE, EB_EB, ier = flib.xpol.mll_blocks_pol(
             self.lmax, self.wl)
         if ier > 0:
@@ -143,7 +222,54 @@ class Xpol(object):
                    'L1MAX less than L1MIN.',
                    'NDIM less than L1MAX-L1MIN+1.'][ier-1]
             raise RuntimeError(msg)
-        return TT_TT, EE_EE, EE_BB, TE_TE, EB_EB
+        self._mll_blocks = TT_TT, EE_EE, EE_BB, TE_TE, EB_EB
+        return self._mll_blocks
+
+    def _get_cache_filename(self):
+        if getattr(self, 'cache_dir', None) is None:
+            return None
+        mask = np.ascontiguousarray(self.mask)
+        h = hashlib.sha1()
+        h.update(str((mask.dtype.str, mask.shape, self.lmin, self.lmax,
+                      self.delta_ell)).encode())
+        h.update(mask.view(np.uint8))
+        return os.path.join(self.cache_dir,
+                            'xpol_mll_{0}.npz'.format(h.hexdigest()))
+
+    def _load_cache(self):
+        """
+        Return the cached mode-coupling matrices as a dictionary of arrays,
+        or None if they have not been stored.
+
+        """
+        filename = self._get_cache_filename()
+        if filename is None or not os.path.exists(filename):
+            return None
+        with np.load(filename) as f:
+            return dict((name, f[name]) for name in f.files)
+
+    def _save_cache(self):
+        """
+        Store the unbinned mode-coupling blocks and the inverse of the binned
+        mode-coupling matrix, through a temporary file so that concurrent
+        processes never read a partially written file.
+
+        """
+        filename = self._get_cache_filename()
+        if filename is None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        arrays = dict(zip(_MLL_BLOCK_NAMES, self._get_Mll_blocks()))
+        arrays['mll_binned_inv'] = self._mll_binned_inv
+        tmpname = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tmpname, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmpname, filename)
 
     def _get_Mll(self, binning=True):
         TT_TT, EE_EE, EE_BB, TE_TE, EB_EB = self._get_Mll_blocks()
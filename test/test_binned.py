@@ -0,0 +1,94 @@
+from __future__ import division
+from numpy.testing import assert_allclose, assert_equal
+from pyoperators import IdentityOperator
+from qubic import (
+    QubicAcquisition, QubicInstrument, QubicMultibandAcquisition,
+    QubicMultibandInstrument, QubicPolyAcquisition, QubicScene, get_pointing)
+from qubic.acquisition import _get_detector_weights
+from qubic.qubicdict import qubicDict
+import numpy as np
+import os
+import qubic
+
+
+def get_dict(**keywords):
+    d = qubicDict()
+    d.read_from_file(os.path.join(os.path.dirname(qubic.__file__), 'dicts',
+                                  'pipeline_demo.dict'))
+    d.update(nside=4, npointings=20, random_pointing=True,
+             repeat_pointing=False, MultiBand=False, nf_sub=1)
+    d.update(keywords)
+    return d
+
+
+def get_acquisition(cls, d):
+    scene = QubicScene(d)
+    sampling = get_pointing(d)
+    if cls is QubicAcquisition:
+        acq = cls(QubicInstrument(d)[:10], sampling, scene, d)
+        subacqs = [acq]
+    else:
+        q = QubicMultibandInstrument(d)
+        args = ()
+        if cls is QubicMultibandAcquisition:
+            nus = [q[i].filter.nu / 1e9 for i in range(len(q))]
+            args = ([nus[0] - 1, np.mean(nus), nus[-1] + 1],)
+        acq = cls(q, sampling, scene, d, *args)
+        subacqs = acq.subacqs
+    # the binned map-maker neglects the time response of the detectors
+    for a in subacqs:
+        a.get_detector_response_operator = lambda: IdentityOperator()
+    return acq, subacqs[0].instrument
+
+
+def get_binned_dense(H, tod, weights, nstokes):
+    """ Return the per-pixel Stokes blocks and the binned map from the dense
+    operator. """
+    h = H.todense()
+    w = (weights * np.ones(H.shapeout)).ravel()
+    a = np.dot(h.T * w, h)
+    npixel = h.shape[1] // nstokes
+    blocks = np.array([a[i*nstokes:(i+1)*nstokes, i*nstokes:(i+1)*nstokes]
+                       for i in range(npixel)])
+    rhs = np.dot(h.T, w * tod.ravel()).reshape((npixel, nstokes))
+    return blocks, rhs
+
+
+def test_binned():
+    def func(cls, kind):
+        d = get_dict(kind=kind)
+        if cls is not QubicAcquisition:
+            d.update(MultiBand=True, nf_sub=3)
+        acq, instrument = get_acquisition(cls, d)
+        if cls is QubicMultibandAcquisition:
+            # the subbands are binned together, as a single band
+            H = QubicPolyAcquisition.get_operator(acq)
+        else:
+            H = acq.get_operator()
+        nstokes = 1 if kind == 'I' else len(kind)
+        np.random.seed(0)
+        tod = H(np.random.randn(*H.shapein))
+        weights = _get_detector_weights(instrument)
+        blocks, rhs = get_binned_dense(H, tod, weights, nstokes)
+
+        actual, hits, cond = acq.tod2map_binned(tod)
+        assert_equal(actual.shape, acq.scene.shape)
+        assert_equal(hits.shape, (acq.scene.shape[0],))
+        observed = hits > 0
+        assert np.any(observed)
+        assert np.all(np.isinf(cond[~observed]))
+        assert np.all(actual[~observed] == 0)
+        assert_allclose(blocks[~observed], 0)
+        assert np.all(cond[observed] >= 1 - 1e-6)
+
+        well = cond < 1e6
+        expected = np.linalg.solve(blocks[well], rhs[well][..., None])[..., 0]
+        # the peak sampling factors are stored in single precision
+        actual = actual.reshape((-1, nstokes))
+        assert_allclose(actual[well], expected, rtol=1e-4,
+                        atol=1e-4 * np.max(np.abs(expected)))
+
+    for cls in (QubicAcquisition, QubicPolyAcquisition,
+                QubicMultibandAcquisition):
+        for kind in 'I', 'IQU':
+            yield func, cls, kind
@@ -0,0 +1,43 @@
+from __future__ import division
+from numpy.testing import assert_allclose, assert_equal
+from qubic.polyacquisition import _convolve_maps
+import healpy as hp
+import numpy as np
+
+nside = 16
+lmax = 3 * nside - 1
+
+
+def convolve_maps_loop(maps, windows):
+    """ Band by band smoothing of the maps, I, Q and U independently. """
+    out = []
+    for m, window in zip(maps, windows):
+        out.append(np.array(hp.smoothing(m.T, beam_window=window,
+                                         pol=False)).T)
+    return np.array(out)
+
+
+def test_convolve_maps():
+    np.random.seed(0)
+    npix = 12 * nside**2
+    windows = [hp.gauss_beam(np.radians(fwhm), lmax)
+               for fwhm in (3, 4, 5, 6)]
+    sky = np.random.randn(npix, 3)
+    sed = np.array([1, 0.5, 0, -2])
+
+    def func(maps, nthreads):
+        actual = _convolve_maps(maps, windows, nthreads=nthreads)
+        expected = convolve_maps_loop(maps, windows)
+        assert_equal(actual.shape, maps.shape)
+        assert_allclose(actual, expected, rtol=1e-10,
+                        atol=1e-10 * np.max(np.abs(expected)))
+
+    proportional = sed[:, None, None] * sky
+    other = np.random.randn(4, npix, 3)
+    # a sky which differs in some bands only
+    mixed = proportional.copy()
+    mixed[2] = other[2]
+    for maps in proportional, other, mixed:
+        for nthreads in None, 1:
+            yield func, maps, nthreads
+            yield func, maps[..., 0], nthreads
@@ -0,0 +1,352 @@
+from __future__ import division
+from numpy.testing import assert_allclose, assert_equal
+import healpy as hp
+import numpy as np
+import scipy.signal as scsig
+import qubic.demodulation_lib as dl
+import qubic.fibtools as ft
+
+
+def get_tod(ntes=4, nsamples=3000, fsampling=100., period=1 / 1.3):
+    np.random.seed(0)
+    time = 1000 + np.arange(nsamples) / fsampling
+    src = np.sin(2 * np.pi * time / period)
+    amplitude = 1 + np.random.rand(ntes, 1)
+    data = amplitude * src + 0.3 * np.random.randn(ntes, nsamples)
+    # a few glitches for the sigma clipping
+    data[:, ::97] += 20
+    return time, data, src, period
+
+
+def bin_per_period_loop(period, time, invec):
+    """ The previous implementation of bin_per_period, period by period. """
+    period_index = ((time - time[0]) / period).astype(int)
+    allperiods = np.unique(period_index)
+    tper = np.zeros(len(allperiods))
+    nvec = np.shape(invec)[0]
+    newvecs = np.zeros((nvec, len(allperiods)))
+    for i in range(len(allperiods)):
+        ok = (period_index == allperiods[i])
+        tper[i] = np.mean(time[ok])
+        newvecs[:, i] = np.mean(invec[:, ok], axis=1)
+    return tper, newvecs
+
+
+def return_rms_period_loop(period, time, data, remove_noise=False):
+    """ The previous implementation of return_rms_period, period by period
+    and TES by TES. """
+    data = np.reshape(data, (-1, len(time)))
+    nTES = len(data)
+    period_index = ((time - time[0]) / period).astype(int)
+    allperiods = np.unique(period_index)
+    tper = np.zeros(len(allperiods))
+    ampdata = np.zeros((nTES, len(allperiods)))
+    for i in range(len(allperiods)):
+        ok = (period_index == allperiods[i])
+        tper[i] = np.mean(time[ok])
+        for j in range(nTES):
+            mm, ss = ft.meancut(data[j, ok], 3)
+            ampdata[j, i] = ss
+    if remove_noise:
+        hf_noise = dl.hf_noise_estimate(time, data)
+        var_diff = np.zeros((nTES, len(tper)))
+        for k in range(nTES):
+            var_diff[k, :] = ampdata[k, :] ** 2 - hf_noise[k] ** 2
+        ampdata = np.sqrt(np.abs(var_diff)) * np.sign(var_diff)
+    return tper, ampdata
+
+
+def test_bin_per_period():
+    time, data, src, period = get_tod()
+    # a timeline not starting on a period boundary, with a gap
+    keep = (time < 1005.1) | (time > 1007.3)
+    time, data = time[keep][7:], data[:, keep][:, 7:]
+    tper, newvecs = dl.bin_per_period(period, time, data)
+    tper_, newvecs_ = bin_per_period_loop(period, time, data)
+    assert_allclose(tper, tper_, rtol=1e-14)
+    assert_allclose(newvecs, newvecs_, rtol=1e-12, atol=1e-12)
+
+
+def test_return_rms_period():
+    time, data, src, period = get_tod()
+    others = np.array([np.linspace(0, 10, len(time)), np.cos(time)])
+
+    def func(data, remove_noise):
+        tper, ampdata, err_ampdata, newothers = dl.return_rms_period(
+            period, [time, data], others=others, remove_noise=remove_noise)
+        tper_, ampdata_ = return_rms_period_loop(period, time, data,
+                                                 remove_noise=remove_noise)
+        assert_allclose(tper, tper_, rtol=1e-14)
+        assert_allclose(ampdata, ampdata_, rtol=1e-10, atol=1e-12)
+        assert_equal(err_ampdata, np.ones_like(ampdata_))
+        expected = bin_per_period_loop(period, time, others)
+        assert_allclose(newothers[0], expected[0], rtol=1e-14)
+        assert_allclose(newothers[1], expected[1], rtol=1e-12, atol=1e-12)
+
+    for remove_noise in False, True:
+        yield func, data, remove_noise
+        yield func, data[0], remove_noise
+
+
+def demodulate_JC_loop(period, time, data, src, quadrature=False,
+                       remove_noise=False):
+    """ The previous implementation of demodulate_JC, TES by TES. """
+    if quadrature:
+        src_shift = np.interp(time - period / 2, time, src, period=period)
+    size_period = int(1. / (time[1] - time[0]) * period) + 1
+    filter_period = np.ones((size_period,)) / size_period
+    demodulated = np.zeros_like(data)
+    for i in range(len(data)):
+        if quadrature:
+            demodulated[i, :] = scsig.fftconvolve(
+                (np.sqrt((data[i, :] * src) ** 2 +
+                         (data[i, :] * src_shift) ** 2)) / np.sqrt(2),
+                filter_period, mode='same')
+        else:
+            demodulated[i, :] = scsig.fftconvolve(data[i, :] * src,
+                                                  filter_period, mode='same')
+    nsamples = int(4. * period / (time[1] - time[0]))
+    timereturn = time[nsamples:-nsamples]
+    demodulated = demodulated[:, nsamples:-nsamples]
+    if remove_noise:
+        hf_noise = dl.hf_noise_estimate(time, data) / np.sqrt(2)
+        var_diff = np.zeros((len(data), len(timereturn)))
+        for k in range(len(data)):
+            var_diff[k, :] = demodulated[k, :] ** 2 - hf_noise[k] ** 2
+        demodulated = np.sqrt(np.abs(var_diff)) * np.sign(var_diff)
+    return timereturn, demodulated
+
+
+def test_running_mean():
+    np.random.seed(1)
+    data = np.random.randn(3, 200)
+
+    def func(size):
+        expected = np.array([scsig.fftconvolve(d, np.ones(size) / size,
+                                               mode='same') for d in data])
+        assert_allclose(dl.running_mean(data, size), expected, rtol=1e-10,
+                        atol=1e-12)
+        assert_allclose(dl.running_mean(data[0], size), expected[0],
+                        rtol=1e-10, atol=1e-12)
+
+    for size in 1, 2, 7, 10, 199, 200:
+        yield func, size
+
+
+def test_demodulate_JC():
+    time, data, src, period = get_tod()
+
+    def func(quadrature, remove_noise, dtype, nthreads):
+        t, demodulated, err = dl.demodulate_JC(
+            period, [time, data], [time, src], quadrature=quadrature,
+            remove_noise=remove_noise, dtype=dtype, nthreads=nthreads)
+        t_, demodulated_ = demodulate_JC_loop(
+            period, time, data, src, quadrature=quadrature,
+            remove_noise=remove_noise)
+        assert_equal(t, t_)
+        assert_equal(demodulated.dtype, dtype or data.dtype)
+        rtol = 1e-5 if dtype is np.float32 else 1e-10
+        assert_allclose(demodulated, demodulated_, rtol=rtol,
+                        atol=rtol * np.max(np.abs(demodulated_)))
+        assert_equal(err, np.ones_like(demodulated_))
+
+    for quadrature in False, True:
+        for remove_noise in False, True:
+            yield func, quadrature, remove_noise, None, None
+        for dtype, nthreads in (np.float32, None), (None, 3):
+            yield func, quadrature, False, dtype, nthreads
+
+
+def test_demodulate_JC_single():
+    time, data, src, period = get_tod()
+    t, demodulated, err = dl.demodulate_JC(period, [time, data[1]],
+                                           [time, src])
+    t_, demodulated_ = demodulate_JC_loop(period, time, data[1:2], src)
+    assert_allclose(demodulated, demodulated_[0], rtol=1e-10, atol=1e-12)
+
+
+def stream(demod, time, data, src, sizes):
+    """ Feed the demodulator by chunks of the given sizes, then flush. """
+    bounds = np.cumsum([0] + list(sizes))
+    out = [demod.update(time[i:j], data[..., i:j], src[i:j])
+           for i, j in zip(bounds[:-1], bounds[1:])]
+    out.append(demod.flush())
+    return (np.concatenate([o[0] for o in out]),
+            np.concatenate([o[1] for o in out], axis=-1))
+
+
+def test_streaming_demodulator():
+    time, data, src, period = get_tod()
+    fsampling = 100.
+    # uneven chunks, some shorter than a period or of a single sample
+    sizes = [1, 250, 13, 77, 1, 600, 58, 1000]
+    sizes.append(len(time) - sum(sizes))
+
+    def func(data, keywords):
+        demod = dl.StreamingDemodulator(period, fsampling=fsampling,
+                                        **keywords)
+        tper, amplitude = stream(demod, time, data, src, sizes)
+        tper1, amplitude1 = stream(demod, time, data, src, [len(time)])
+        assert_allclose(tper, tper1, rtol=1e-14)
+        assert_allclose(amplitude, amplitude1, rtol=1e-10, atol=1e-12)
+        if keywords.get('quadrature'):
+            return
+        # the one-shot demodulation binned per period
+        filtered_data, filtered_src = data, src
+        if demod.lowcut is not None or demod.notch is not None:
+            sos = demod._get_sos(fsampling)
+            filtered_data = scsig.sosfilt(sos, data, axis=-1)
+            filtered_src = scsig.sosfilt(sos, src)
+        tper_, amplitude_ = bin_per_period_loop(
+            period, time, np.reshape(filtered_data * filtered_src,
+                                     (-1, len(time))))
+        assert_allclose(tper, tper_, rtol=1e-14)
+        assert_allclose(amplitude, np.reshape(amplitude_, amplitude.shape),
+                        rtol=1e-10, atol=1e-12)
+
+    for keywords in ({}, {'lowcut': 0.3, 'highcut': 10.},
+                     {'lowcut': 0.3, 'highcut': 10.,
+                      'notch': [(5., 0.5, 2)]},
+                     {'lowcut': 0.3, 'highcut': 10., 'quadrature': True}):
+        yield func, data, keywords
+        yield func, data[0], keywords
+
+
+def coadd_loop(npix, pixels, data, weights=None):
+    """ Weighted mean, hits and variance per pixel, sample by sample. """
+    data = np.reshape(data, (-1, len(pixels)))
+    if weights is None:
+        weights = np.ones(len(pixels))
+    weights = np.broadcast_to(weights, data.shape)
+    sumw = np.zeros((len(data), npix))
+    sumwd = np.zeros((len(data), npix))
+    sumwd2 = np.zeros((len(data), npix))
+    hits = np.zeros(npix)
+    for i, p in enumerate(pixels):
+        if 0 <= p < npix:
+            hits[p] += 1
+            sumw[:, p] += weights[:, i]
+            sumwd[:, p] += weights[:, i] * data[:, i]
+            sumwd2[:, p] += weights[:, i] * data[:, i] ** 2
+    maps = np.zeros_like(sumw)
+    variance = np.zeros_like(sumw)
+    ok = sumw != 0
+    maps[ok] = sumwd[ok] / sumw[ok]
+    variance[ok] = np.maximum(sumwd2[ok] / sumw[ok] - maps[ok] ** 2, 0)
+    return maps, hits, variance
+
+
+def coadd_flatmap_loop(data, az, el, naz, nel, remove_eltrend):
+    """ The previous implementation of coadd_flatmap, sample by sample. """
+    data = np.reshape(data, (-1, len(az)))
+    azmin, azmax, elmin, elmax = np.min(az), np.max(az), np.min(el), \
+        np.max(el)
+    azindex = (naz * (az - azmin) / (azmax - azmin)).astype(int)
+    elindex = (nel * (el - elmin) / (elmax - elmin)).astype(int)
+    inside = (azindex >= 0) & (azindex < naz) & (elindex >= 0) & \
+        (elindex < nel)
+    data = data[:, inside]
+    azindex = azindex[inside]
+    elindex = elindex[inside]
+    mapdata = np.zeros((len(data), nel, naz))
+    mapcount = np.zeros((len(data), nel, naz))
+    for i in range(inside.sum()):
+        mapdata[:, elindex[i], azindex[i]] += data[:, i]
+        mapcount[:, elindex[i], azindex[i]] += 1
+    themap = np.zeros((len(data), nel, naz))
+    ok = mapcount != 0
+    themap[ok] = mapdata[ok] / mapcount[ok]
+    if remove_eltrend:
+        for k in range(len(data)):
+            for iel in range(nel):
+                themap[k, iel, :] -= np.median(themap[k, iel, :])
+    return themap
+
+
+def scan2hpmap_loop(ns, azdeg, eldeg, data):
+    """ The previous implementation of scan2hpmap, sample by sample. """
+    coadd = np.zeros(12 * ns ** 2)
+    count = np.zeros(12 * ns ** 2)
+    ip = hp.ang2pix(ns, np.pi / 2 - np.radians(eldeg), np.radians(azdeg))
+    for i in range(len(azdeg)):
+        coadd[ip[i]] += data[i]
+        count[ip[i]] += 1
+    ok = count != 0
+    sbmap = np.zeros(12 * ns ** 2)
+    sbmap[ok] = coadd[ok] / count[ok]
+    mm, ss = ft.meancut(sbmap[ok], 3)
+    sbmap[ok] -= mm
+    sbmap[~ok] = 0
+    return sbmap
+
+
+def get_scan(ntes=3, nsamples=2000):
+    np.random.seed(2)
+    az = np.random.uniform(-10, 10, nsamples)
+    el = np.random.uniform(40, 60, nsamples)
+    # an empty band of azimuth
+    az[(az > 2) & (az < 4)] -= 3
+    data = np.random.randn(ntes, nsamples) + np.cos(np.radians(10 * az))
+    return az, el, data
+
+
+def test_pixel_coadder():
+    np.random.seed(3)
+    npix = 50
+    nsamples = 1000
+    # some pixels are empty, some samples are outside the map
+    pixels = np.random.randint(-3, npix + 3, nsamples)
+    pixels[pixels % 7 == 0] = 1
+    data = np.random.randn(2, nsamples)
+    data[1, 10] = np.nan
+
+    def func(data, weights, nchunks):
+        coadder = dl.PixelCoadder(npix, np.size(data) // nsamples)
+        for sl in np.array_split(np.arange(nsamples), nchunks):
+            w = None if weights is None else weights[..., sl]
+            coadder.add(pixels[sl], data[..., sl], weights=w)
+        maps, hits, variance = coadder.get_maps()
+        maps_, hits_, variance_ = coadd_loop(npix, pixels, data, weights)
+        assert_equal(hits, hits_)
+        assert np.any(hits == 0)
+        assert_allclose(maps, maps_, rtol=1e-10, atol=1e-12)
+        assert_allclose(variance, variance_, rtol=1e-10, atol=1e-12)
+
+    for nchunks in 1, 3:
+        yield func, data, None, nchunks
+        yield func, data[0], None, nchunks
+        yield func, data, np.random.rand(nsamples), nchunks
+        yield func, data, np.random.rand(2, nsamples), nchunks
+
+
+def test_coadd_flatmap():
+    az, el, data = get_scan()
+    data[0, :5] = np.nan
+
+    def func(data, remove_eltrend):
+        themap, map_az, map_el = dl.coadd_flatmap(
+            data.copy(), az, el, naz=30, nel=20, silent=True,
+            remove_eltrend=remove_eltrend)
+        expected = coadd_flatmap_loop(data, az, el, 30, 20, remove_eltrend)
+        assert_allclose(themap, np.reshape(expected, themap.shape),
+                        rtol=1e-10, atol=1e-12)
+        assert_equal(map_az.shape, (30,))
+        assert_equal(map_el.shape, (20,))
+
+    for remove_eltrend in False, True:
+        yield func, data, remove_eltrend
+        yield func, data[1], remove_eltrend
+
+
+def test_scan2hpmap():
+    az, el, data = get_scan()
+    data[2, 7] = np.nan
+    ns = 16
+    sbmap = dl.scan2hpmap(ns, az, el, data)
+    assert_equal(sbmap.shape, (len(data), 12 * ns ** 2))
+    for k in range(len(data)):
+        expected = scan2hpmap_loop(ns, az, el, data[k])
+        assert np.any(expected == 0)
+        assert_allclose(sbmap[k], expected, rtol=1e-10, atol=1e-12)
+        assert_allclose(dl.scan2hpmap(ns, az, el, data[k]), expected,
+                        rtol=1e-10, atol=1e-12)
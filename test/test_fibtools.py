@@ -0,0 +1,167 @@
+from __future__ import division
+from numpy.testing import assert_allclose, assert_equal
+import numpy as np
+import scipy.stats
+import qubic.fibtools as ft
+
+
+def profile_loop(x, y, range, nbins, median=False, mode=False, clip=None,
+                 dispersion=True):
+    """ The previous implementation of fibtools.profile, bin by bin. """
+    ok = np.isfinite(x) & np.isfinite(y)
+    x = x[ok]
+    y = y[ok]
+    xx = np.linspace(range[0], range[1], nbins + 1)
+    yval = np.zeros(nbins)
+    dy = np.zeros(nbins)
+    nn = np.zeros(nbins)
+    for i in np.arange(nbins):
+        ok = (x > xx[i]) & (x < xx[i + 1])
+        newy = y[ok]
+        if clip is not None:
+            for k in np.arange(3):
+                newy, mini, maxi = scipy.stats.sigmaclip(newy, low=clip,
+                                                         high=clip)
+        nn[i] = len(newy)
+        if median:
+            yval[i] = np.median(y[ok])
+        elif mode:
+            mm, ss = ft.meancut(y[ok], 3)
+            hh = np.histogram(y[ok], bins=int(np.min([len(y[ok]) / 30, 100])),
+                              range=[mm - 5 * ss, mm + 5 * ss])
+            idmax = np.argmax(hh[0])
+            yval[i] = 0.5 * (hh[1][idmax + 1] + hh[1][idmax])
+        else:
+            yval[i] = np.mean(y[ok])
+        fact = 1 if dispersion else np.sqrt(len(y[ok]))
+        dy[i] = np.std(y[ok]) / fact
+    xc = (xx[1:] + xx[:-1]) / 2
+    yval[nn == 0] = 0
+    dy[nn == 0] = 0
+    return xc, yval, dy
+
+
+def get_data(nrows=4, nsamples=20000):
+    np.random.seed(0)
+    x = 10 * np.random.rand(nsamples)
+    y = np.empty((nrows, nsamples))
+    y[:nrows // 2] = np.random.standard_cauchy((nrows // 2, nsamples))
+    y[nrows // 2:] = 3 * np.random.randn(nrows - nrows // 2, nsamples) + 1
+    y[0, 5:9] = np.nan
+    return x, y
+
+
+def test_profile():
+    x, y = get_data()
+    range_ = [np.min(x), np.max(x)]
+
+    def func(nbins, keywords):
+        xc, yval, dx, dy, others = ft.profile(
+            x, y, range=range_, nbins=nbins, plot=False, cutbad=False,
+            **keywords)
+        assert_equal(yval.shape, (len(y), nbins))
+        for k in range(len(y)):
+            xc_, yval_, dy_ = profile_loop(x, y[k], range_, nbins, **keywords)
+            assert_allclose(xc, xc_, rtol=1e-12)
+            assert_allclose(yval[k], yval_, rtol=1e-10, atol=1e-12)
+            assert_allclose(dy[k], dy_, rtol=1e-10, atol=1e-12)
+            # the 1-D profile is that of a single row
+            _, yval1, _, dy1, _ = ft.profile(
+                x, y[k], range=range_, nbins=nbins, plot=False, cutbad=False,
+                **keywords)
+            assert_allclose(yval1, yval_, rtol=1e-10, atol=1e-12)
+            assert_allclose(dy1, dy_, rtol=1e-10, atol=1e-12)
+
+    for nbins in 10, 40:
+        for keywords in ({}, {'median': True}, {'mode': True}, {'clip': 3}):
+            yield func, nbins, keywords
+
+
+def test_fold_data():
+    np.random.seed(1)
+    ndet = 5
+    period = 1.
+    time = np.linspace(0, 100, 20000)
+    phase = np.random.rand(ndet, 1)
+    dd = np.sin(2 * np.pi * (time / period + phase)) + \
+        np.random.randn(ndet, len(time))
+
+    folded, t, folded_nonorm, dfolded, dfolded_nonorm, newdata, fnoise, \
+        noise = ft.fold_data(time, dd, period, 0.1, 10, 20, return_error=True,
+                             return_noise_harmonics=3, silent=True)
+    assert_equal(newdata.shape, dd.shape)
+
+    # the previous implementation, detector by detector
+    tfold = time % period
+    for k in range(ndet):
+        newdata_ = ft.filter_data(time, dd[k], 0.1, 10)
+        assert_allclose(newdata[k], newdata_, rtol=1e-10, atol=1e-13)
+        t_, yy, dy = profile_loop(tfold, newdata_, [0, period], 20,
+                                  dispersion=False)
+        assert_allclose(t, t_, rtol=1e-12)
+        assert_allclose(folded[k], (yy - np.mean(yy)) / np.std(yy),
+                        rtol=1e-10, atol=1e-12)
+        assert_allclose(folded_nonorm[k], yy - np.mean(yy), rtol=1e-10,
+                        atol=1e-12)
+        assert_allclose(dfolded[k], dy / np.std(yy), rtol=1e-10)
+        assert_allclose(dfolded_nonorm[k], dy, rtol=1e-10)
+        spectrum, freq = ft.power_spectrum(time, newdata_, rebin=True)
+        for i in range(len(fnoise)):
+            ok = (freq >= (i + 1) / period * (1 + 0.2 / (i + 1))) & \
+                 (freq < (i + 2) / period * (1 - 0.2 / (i + 1)))
+            assert_allclose(noise[k, i], np.sqrt(np.mean(spectrum[ok])),
+                            rtol=1e-10)
+
+
+class GaussianModel(object):
+    """ Gaussian profile over a constant, with its analytic gradient. """
+    def __call__(self, x, pars):
+        a, b, c, d = pars
+        return a * np.exp(-(x - b)**2 / (2 * c**2)) + d
+
+    def gradient(self, x, pars):
+        a, b, c, d = pars
+        g = np.exp(-(x - b)**2 / (2 * c**2))
+        return np.array([g, a * g * (x - b) / c**2,
+                         a * g * (x - b)**2 / c**3, np.ones_like(x)])
+
+
+class ScaledGaussianModel(GaussianModel):
+    """ Gaussian model whose amplitude is scaled by extra_args. """
+    def __call__(self, x, pars, extra_args=None):
+        return extra_args * GaussianModel.__call__(self, x, pars)
+
+    def gradient(self, x, pars, extra_args=None):
+        return extra_args * GaussianModel.gradient(self, x, pars)
+
+
+def get_finite_differences(func, pars, eps=1e-6):
+    pars = np.asarray(pars, dtype=float)
+    out = np.empty(len(pars))
+    for i in range(len(pars)):
+        dp = np.zeros(len(pars))
+        dp[i] = eps * max(1, abs(pars[i]))
+        out[i] = (func(*(pars + dp)) - func(*(pars - dp))) / (2 * dp[i])
+    return out
+
+
+def test_chi2_grad():
+    np.random.seed(2)
+    x = np.linspace(-5, 5, 200)
+    truth = [3., 0.5, 1.2, 0.1]
+    pars = [2.5, 0.3, 1.5, -0.2]
+    sigma = 0.1 + np.random.rand(len(x))
+    a = np.random.randn(len(x), len(x)) / len(x)
+    covariance = np.dot(a, a.T) + np.diag(sigma**2)
+
+    def func(chi2):
+        assert_allclose(chi2.grad(*pars),
+                        get_finite_differences(chi2, pars), rtol=1e-5)
+
+    y = GaussianModel()(x, truth) + sigma * np.random.randn(len(x))
+    yield func, ft.MyChi2(x, y, sigma, GaussianModel())
+    yield func, ft.MyChi2(x, y, covariance, GaussianModel())
+    yield func, ft.MyChi2(x, y, sigma, ScaledGaussianModel(), extra_args=2.)
+    yield func, ft.MyChi2(x, y, covariance, ScaledGaussianModel(),
+                          extra_args=2.)
+    yield func, ft.MyChi2_nocov(x, y, None, GaussianModel())
@@ -0,0 +1,57 @@
+from __future__ import division
+from numpy.testing import assert_allclose
+from qubic import (
+    QubicMultibandAcquisition, QubicMultibandInstrument, QubicPolyAcquisition,
+    QubicScene, get_pointing)
+from qubic.qubicdict import qubicDict
+import numpy as np
+import os
+import qubic
+
+
+def get_dict(**keywords):
+    d = qubicDict()
+    d.read_from_file(os.path.join(os.path.dirname(qubic.__file__), 'dicts',
+                                  'pipeline_demo.dict'))
+    d.update(nside=16, npointings=5, random_pointing=True,
+             repeat_pointing=False, MultiBand=True, nf_sub=4)
+    d.update(keywords)
+    return d
+
+
+def assert_close(actual, expected):
+    # the fused matrix values are summed in single precision
+    assert_allclose(actual, expected, rtol=1e-5,
+                    atol=1e-5 * np.max(np.abs(expected)))
+
+
+def test_fused_projection():
+    def func(cls, kind, weights):
+        d = get_dict(kind=kind, weights=weights)
+        q = QubicMultibandInstrument(d)
+        s = get_pointing(d)
+        scene = QubicScene(d)
+        args = (q, s, scene, d)
+        if cls is QubicMultibandAcquisition:
+            nus = [q[0].filter.nu / 1e9 - 1, np.mean([a.filter.nu / 1e9
+                                                      for a in q]),
+                   q[-1].filter.nu / 1e9 + 1]
+            args += (nus,)
+        d['fused_projection'] = False
+        acq = cls(*args)
+        H0 = acq.get_operator()
+        d['fused_projection'] = True
+        acq = cls(*args)
+        H = acq.get_operator()
+
+        np.random.seed(0)
+        x = np.random.randn(*H0.shapein)
+        y = np.random.randn(*H0.shapeout)
+        assert_close(H(x), H0(x))
+        assert_close(H.T(y), H0.T(y))
+
+    nf_sub = get_dict()['nf_sub']
+    for cls in QubicPolyAcquisition, QubicMultibandAcquisition:
+        for kind in 'I', 'IQU':
+            for weights in None, np.linspace(0.5, 2, nf_sub):
+                yield func, cls, kind, weights
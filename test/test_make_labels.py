@@ -0,0 +1,82 @@
+from __future__ import division
+from numpy.testing import assert_equal
+from uuid import uuid1
+import numpy as np
+import os
+import shutil
+import qubic.selfcal_lib as sc
+
+outpath = ''
+ndet = 144
+nn = 61
+img_size = 0.12
+
+
+def setup():
+    global outpath
+    outpath = 'test-' + str(uuid1())[:8]
+    os.makedirs(outpath)
+    # 12x12 TES sharing their edges, one of which lies exactly on a pixel
+    edges = np.linspace(-0.05, 0.05, 13)
+    edges[3] = np.linspace(-img_size / 2, img_size / 2, nn)[20]
+    with open(os.path.join(outpath, 'vertices.txt'), 'w') as f:
+        for iy in range(12):
+            for ix in range(12):
+                x0, x1 = edges[ix], edges[ix + 1]
+                y0, y1 = edges[iy], edges[iy + 1]
+                for x, y in (x1, y1), (x0, y1), (x0, y0), (x1, y0):
+                    f.write('{!r} {!r}\n'.format(float(x), float(y)))
+
+
+def teardown():
+    shutil.rmtree(outpath)
+
+
+def make_labels_loop(readv, nn, ndet, img_size):
+    """ The previous implementation of make_labels, pixel by pixel. """
+    labels = np.zeros((nn, nn))
+    xx = np.linspace(- img_size / 2., img_size / 2., nn)
+    yy = np.linspace(- img_size / 2., img_size / 2., nn)
+    XX, YY = np.meshgrid(xx, yy)
+    for i in range(nn):
+        for j in range(nn):
+            for d in range(0, ndet):
+                if readv[d, 2, 0] <= XX[i, j] <= readv[d, 3, 0] and \
+                        readv[d, 2, 1] <= YY[i, j] <= readv[d, 1, 1]:
+                    labels[i, j] = d+1
+    return labels
+
+
+def test_make_labels():
+    sc._LABELS_CACHE.clear()
+    readv, labels = sc.make_labels(outpath, nn=nn, ndet=ndet,
+                                   img_size=img_size, doplot=False)
+    vertices = np.loadtxt(os.path.join(outpath, 'vertices.txt'))
+    assert_equal(readv, vertices.reshape((ndet, 4, 2)))
+    assert_equal(labels, make_labels_loop(readv, nn, ndet, img_size))
+    assert_equal(len(np.unique(labels)), ndet + 1)
+    assert_equal(len(sc._LABELS_CACHE), 1)
+
+    # the second call hits the cache and returns copies
+    readv[...] = 0
+    labels[...] = -1
+    readv2, labels2 = sc.make_labels(outpath, nn=nn, ndet=ndet,
+                                     img_size=img_size, doplot=False)
+    assert_equal(len(sc._LABELS_CACHE), 1)
+    assert_equal(readv2, vertices.reshape((ndet, 4, 2)))
+    assert_equal(labels2, make_labels_loop(readv2, nn, ndet, img_size))
+    cached_readv, cached_labels = sc._LABELS_CACHE.popitem()[1]
+    sc._LABELS_CACHE.clear()
+    assert readv2 is not cached_readv
+    assert labels2 is not cached_labels
+
+
+def test_make_labels_cache_size():
+    sc._LABELS_CACHE.clear()
+    for n in range(sc._LABELS_CACHE_SIZE + 3):
+        sc.make_labels(outpath, nn=11 + n, ndet=ndet, img_size=img_size,
+                       doplot=False)
+    assert_equal(len(sc._LABELS_CACHE), sc._LABELS_CACHE_SIZE)
+    assert_equal([key[2] for key in sc._LABELS_CACHE],
+                 list(range(14, 14 + sc._LABELS_CACHE_SIZE)))
+    sc._LABELS_CACHE.clear()
@@ -0,0 +1,49 @@
+from __future__ import division
+from numpy.testing import assert_allclose, assert_equal
+from qubic import angular_distance_from_mask
+import healpy as hp
+import numpy as np
+
+nside = 8
+
+
+def angular_distance_brute(mask):
+    """ Smallest angular distance from each unmasked pixel to the masked
+    pixels that have an unmasked neighbour, pixel by pixel. """
+    npix = len(mask)
+    border = [p for p in np.arange(npix)[mask]
+              if np.any(~mask[hp.get_all_neighbours(nside, p)])]
+    out = np.zeros(npix)
+    if len(border) == 0:
+        out[~mask] = np.inf
+        return out
+    vec_border = np.array(hp.pix2vec(nside, border))
+    for p in np.arange(npix)[~mask]:
+        vec = np.array(hp.pix2vec(nside, p))
+        out[p] = np.degrees(np.min(hp.rotator.angdist(vec, vec_border)))
+    return out
+
+
+def test_angular_distance_from_mask():
+    npix = 12 * nside**2
+    theta, phi = hp.pix2ang(nside, np.arange(npix))
+    disc = np.degrees(hp.rotator.angdist(
+        np.array([theta, phi]), [np.radians(60), np.radians(30)])) < 25
+    np.random.seed(0)
+
+    def func(mask, nchunk):
+        actual = angular_distance_from_mask(mask, nchunk=nchunk)
+        expected = angular_distance_brute(mask)
+        assert_equal(actual[mask], 0)
+        assert_allclose(actual, expected, rtol=1e-10, atol=1e-10)
+
+    for mask in (disc, ~disc, np.random.rand(npix) < 0.1,
+                 np.ones(npix, bool)):
+        for nchunk in 2**20, 37:
+            yield func, mask, nchunk
+
+
+def test_angular_distance_from_mask_empty():
+    # no masked pixel, hence no border
+    actual = angular_distance_from_mask(np.zeros(12 * nside**2, bool))
+    assert_equal(actual, np.inf)
@@ -1,9 +1,14 @@
 from __future__ import division
 import numpy as np
+import os
+import qubic
 from pyoperators.utils.testing import assert_same
 from qubic import (
-    QubicAcquisition, QubicInstrument, QubicScene, create_random_pointings)
+    QubicAcquisition, QubicInstrument, QubicScene, create_random_pointings,
+    get_pointing)
+from qubic.instrument import ProjectionOnTheFlyOperator
 from qubic.mapmaking import tod2map_all, tod2map_each
+from qubic.qubicdict import qubicDict
 
 
 def test():
@@ -43,3 +48,72 @@ def test():
             max_nbytes = None if max_sampling is None \
                               else max_sampling * nbytes_per_sampling
             yield (func, scene, max_nbytes, ref1, ref2, ref3, ref4, ref5, ref6)
+
+
+def get_dict(**keywords):
+    d = qubicDict()
+    d.read_from_file(os.path.join(os.path.dirname(qubic.__file__), 'dicts',
+                                  'pipeline_demo.dict'))
+    d.update(nside=16, npointings=7, random_pointing=True,
+             repeat_pointing=False, MultiBand=False, nf_sub=1)
+    d.update(keywords)
+    return d
+
+
+def test_projection_onthefly():
+    def func(kind, nrows):
+        d = get_dict(kind=kind)
+        instrument = QubicInstrument(d)[:10]
+        sampling = get_pointing(d)
+        scene = QubicScene(d)
+        P = instrument.get_projection_operator(sampling, scene, verbose=False)
+        if nrows is None:
+            max_nbytes = None
+        else:
+            # nbytes of the sparse matrix rows, one row being one detector
+            # and one sample
+            max_nbytes = nrows * P.matrix.ncolmax * (
+                P.matrix.data.index.itemsize +
+                len(kind) * P.matrix.data.value.itemsize)
+        O = instrument.get_projection_onthefly_operator(
+            sampling, scene, max_nbytes=max_nbytes)
+        assert len(O.chunks) > 1 or nrows is None
+        assert O.shapein == P.shapein
+        assert O.shapeout == P.shapeout
+        np.random.seed(0)
+        x = np.random.randn(*P.shapein)
+        y = np.random.randn(*P.shapeout)
+        assert_same(O(x), P(x))
+        assert_same(O.T(y), P.T(y))
+        assert_same((O.T * O)(x), (P.T * P)(x))
+
+    for kind in 'I', 'IQU':
+        # whole matrix, all the detectors and a few samples per chunk, and a
+        # few detectors per chunk
+        for nrows in None, 20, 3:
+            yield func, kind, nrows
+
+
+def test_projection_block():
+    # user-specified blocks without max_nbytes: one block matrix at a time
+    def func(kind):
+        d = get_dict(kind=kind)
+        instrument = QubicInstrument(d)[:10]
+        sampling = get_pointing(d)
+        scene = QubicScene(d)
+        P = QubicAcquisition(instrument, sampling, scene,
+                             d).get_projection_operator(verbose=False)
+        d['block'] = (slice(0, 3), slice(3, 7))
+        acq = QubicAcquisition(instrument, sampling, scene, d)
+        assert acq.max_nbytes is None
+        O = acq.get_projection_operator(verbose=False)
+        assert not isinstance(O, ProjectionOnTheFlyOperator)
+        assert len(O.operands) == 2
+        np.random.seed(0)
+        x = np.random.randn(*P.shapein)
+        y = np.random.randn(*P.shapeout)
+        assert_same(O(x), P(x))
+        assert_same(O.T(y), P.T(y))
+
+    for kind in 'I', 'IQU':
+        yield func, kind
@@ -0,0 +1,125 @@
+from __future__ import division
+from numpy.testing import assert_allclose, assert_equal
+from pyoperators import DenseOperator, DiagonalOperator, pcg
+from qubic.acquisition import _pcg
+from uuid import uuid1
+import numpy as np
+import os
+import shutil
+
+outpath = ''
+
+np.random.seed(0)
+n = 50
+a = np.random.randn(n, n)
+a = np.dot(a.T, a) + np.eye(n)
+A = DenseOperator(a)
+M = DiagonalOperator(1 / np.diag(a))
+b = np.random.randn(n)
+tol = 1e-10
+expected = np.linalg.solve(a, b)
+
+
+def setup():
+    global outpath
+    outpath = 'test-' + str(uuid1())[:8]
+    os.mkdir(outpath)
+
+
+def teardown():
+    shutil.rmtree(outpath)
+
+
+def get_checkpoint():
+    return os.path.join(outpath, 'pcg-' + str(uuid1()) + '.npz')
+
+
+def test_checkpoint_uninterrupted():
+    ref = pcg(A, b, M=M, tol=tol, maxiter=1000)
+    actual = _pcg(A, b, M=M, tol=tol, maxiter=1000,
+                  checkpoint=get_checkpoint())
+    assert_allclose(actual['x'], ref['x'], rtol=1e-8)
+    assert_allclose(actual['x'], expected, rtol=1e-8)
+    assert actual['error'] <= tol
+
+
+def test_checkpoint_resume():
+    checkpoint = get_checkpoint()
+    ref = _pcg(A, b, M=M, tol=tol, maxiter=1000, checkpoint=checkpoint)
+    os.remove(checkpoint)
+
+    # stop after 5 iterations, then resume
+    partial = _pcg(A, b, M=M, tol=tol, maxiter=5, checkpoint=checkpoint)
+    assert_equal(partial['nit'], 5)
+    actual = _pcg(A, b, M=M, tol=tol, maxiter=1000, checkpoint=checkpoint)
+    assert_equal(actual['nit'], ref['nit'])
+    assert_equal(actual['x'], ref['x'])
+
+    # preemption between two checkpoints: the iterations done after the
+    # last checkpoint are done again
+    class Preempted(Exception):
+        pass
+
+    def callback(state):
+        if state.niterations == 7:
+            raise Preempted()
+    checkpoint = get_checkpoint()
+    try:
+        _pcg(A, b, M=M, tol=tol, maxiter=1000, callback=callback,
+             checkpoint=checkpoint, checkpoint_every=5)
+    except Preempted:
+        pass
+    with np.load(checkpoint) as f:
+        assert_equal(f['niterations'], 5)
+    actual = _pcg(A, b, M=M, tol=tol, maxiter=1000, checkpoint=checkpoint,
+                  checkpoint_every=5)
+    assert_equal(actual['nit'], ref['nit'])
+    assert_equal(actual['x'], ref['x'])
+
+
+def test_warm_start():
+    def func(checkpoint):
+        ref = _pcg(A, b, M=M, tol=tol, maxiter=1000, checkpoint=checkpoint)
+        if checkpoint is not None:
+            os.remove(checkpoint)
+        x0 = expected + 1e-6 * np.random.randn(n)
+        actual = _pcg(A, b, x0=x0, M=M, tol=tol, maxiter=1000,
+                      checkpoint=checkpoint)
+        assert_allclose(actual['x'], ref['x'], rtol=1e-8)
+        assert actual['nit'] < ref['nit']
+        if checkpoint is not None:
+            os.remove(checkpoint)
+        actual = _pcg(A, b, x0=ref['x'], M=M, tol=tol, maxiter=1000,
+                      checkpoint=checkpoint)
+        assert_allclose(actual['x'], ref['x'], rtol=1e-8)
+        if checkpoint is not None:
+            assert_equal(actual['nit'], 0)
+    for checkpoint in None, get_checkpoint():
+        yield func, checkpoint
+
+
+def test_checkpoint_other_system():
+    # a checkpoint of another right-hand side or tolerance is not resumed
+    checkpoint = get_checkpoint()
+    ref = _pcg(A, b, M=M, tol=tol, maxiter=1000, checkpoint=checkpoint)
+    b2 = np.random.randn(n)
+    actual = _pcg(A, b2, M=M, tol=tol, maxiter=1000, checkpoint=checkpoint)
+    assert actual['nit'] > 0
+    assert actual['error'] <= tol
+    assert_allclose(actual['x'], np.linalg.solve(a, b2), rtol=1e-8)
+
+    # the finished checkpoint of the same system is returned as is
+    again = _pcg(A, b2, M=M, tol=tol, maxiter=1000, checkpoint=checkpoint)
+    assert_equal(again['nit'], actual['nit'])
+    assert_equal(again['x'], actual['x'])
+
+    actual = _pcg(A, b2, M=M, tol=tol / 10, maxiter=1000,
+                  checkpoint=checkpoint)
+    assert actual['error'] <= tol / 10
+    assert_allclose(actual['x'], np.linalg.solve(a, b2), rtol=1e-9)
+
+    # the starting point is used when the checkpoint is discarded
+    actual = _pcg(A, b, x0=ref['x'], M=M, tol=tol, maxiter=1000,
+                  checkpoint=checkpoint)
+    assert_equal(actual['nit'], 0)
+    assert_equal(actual['x'], ref['x'])
@@ -0,0 +1,72 @@
+from __future__ import division
+from numpy.testing import assert_equal
+from qubic import QubicInstrument
+from qubic.qubicdict import qubicDict
+import numpy as np
+import os
+import qubic
+import qubic.instrument
+
+d = qubicDict()
+d.read_from_file(os.path.join(os.path.dirname(qubic.__file__), 'dicts',
+                              'pipeline_demo.dict'))
+d.update(MultiBand=False, nf_sub=1)
+q = QubicInstrument(d)[:10]
+
+
+def get_args(nu=150e9):
+    return (q.synthbeam.kmax, q.synthbeam.fraction, q.horn.spacing,
+            q.horn.angle, nu, q.detector.center, q.primary_beam)
+
+
+def setup():
+    qubic.instrument._PEAK_ANGLES_CACHE.clear()
+
+
+def teardown():
+    qubic.instrument._PEAK_ANGLES_CACHE.clear()
+
+
+def test_cached_uncached():
+    cache = qubic.instrument._PEAK_ANGLES_CACHE
+    cache.clear()
+    expected = QubicInstrument._peak_angles_search(*get_args())
+    actual1 = QubicInstrument._peak_angles_fraction(*get_args())
+    assert_equal(len(cache), 1)
+    actual2 = QubicInstrument._peak_angles_fraction(*get_args())
+    assert_equal(len(cache), 1)
+    for e, a1, a2 in zip(expected, actual1, actual2):
+        assert_equal(a1, e)
+        assert a2 is a1
+        assert not a1.flags.writeable
+
+    # an equal but distinct position array hits the same entry
+    args = list(get_args())
+    args[5] = args[5].copy()
+    actual3 = QubicInstrument._peak_angles_fraction(*args)
+    assert actual3[0] is actual1[0]
+    assert_equal(len(cache), 1)
+
+
+def test_lru_size():
+    cache = qubic.instrument._PEAK_ANGLES_CACHE
+    size = qubic.instrument._PEAK_ANGLES_CACHE_SIZE
+    assert_equal(size, 64)
+    cache.clear()
+    nus = 150e9 + 1e6 * np.arange(size + 6)
+    QubicInstrument._peak_angles_fraction(*get_args(nus[0]))
+    for nu in nus[1:]:
+        QubicInstrument._peak_angles_fraction(*get_args(nu))
+        # the first entry is used again, so that it is never evicted
+        QubicInstrument._peak_angles_fraction(*get_args(nus[0]))
+        assert len(cache) <= size
+    assert_equal(len(cache), size)
+    keys = [key[4] for key in cache]
+    assert nus[0] in keys
+    assert_equal(sorted(keys), sorted(nus[:1].tolist() +
+                                      nus[-size+1:].tolist()))
+    for nu in nus[:1].tolist() + nus[-size+1:].tolist():
+        expected = QubicInstrument._peak_angles_search(*get_args(nu))
+        actual = QubicInstrument._peak_angles_fraction(*get_args(nu))
+        for e, a in zip(expected, actual):
+            assert_equal(a, e)
@@ -0,0 +1,53 @@
+from __future__ import division
+from numpy.testing import assert_allclose, assert_raises
+from qubic import QubicAcquisition, QubicInstrument, QubicScene, get_pointing
+from qubic.qubicdict import qubicDict
+import numpy as np
+import os
+import qubic
+
+
+def get_dict(**keywords):
+    d = qubicDict()
+    d.read_from_file(os.path.join(os.path.dirname(qubic.__file__), 'dicts',
+                                  'pipeline_demo.dict'))
+    d.update(nside=16, npointings=7, random_pointing=True,
+             repeat_pointing=False, MultiBand=False, nf_sub=1)
+    d.update(keywords)
+    return d
+
+
+def get_acquisition(d):
+    instrument = QubicInstrument(d)[:10]
+    return QubicAcquisition(instrument, get_pointing(d), QubicScene(d), d)
+
+
+def test_precomposed():
+    def func(kind, polarizer, block):
+        d = get_dict(kind=kind, polarizer=polarizer, block=block)
+        H0 = get_acquisition(d).get_operator()
+        d['precomposed_operator'] = True
+        acq = get_acquisition(d)
+        H = acq.get_operator()
+        np.random.seed(0)
+        x = np.random.randn(*H0.shapein)
+        y = np.random.randn(*H0.shapeout)
+        # the precomposed factors are stored in single precision
+        expected = H0(x)
+        assert_allclose(H(x), expected, rtol=1e-5,
+                        atol=1e-5 * np.max(np.abs(expected)))
+        expected = H0.T(y)
+        assert_allclose(H.T(y), expected, rtol=1e-5,
+                        atol=1e-5 * np.max(np.abs(expected)))
+
+    # the HWP only acts on the polarized scenes, the intensity scenes being
+    # tested with and without the polarizer
+    for kind, polarizer in ('I', True), ('I', False), ('IQU', True):
+        for block in None, (slice(0, 3), slice(3, 7)):
+            yield func, kind, polarizer, block
+
+
+def test_precomposed_max_nbytes():
+    d = get_dict(block=(slice(0, 3), slice(3, 7)), max_nbytes=1,
+                 precomposed_operator=True)
+    assert_raises(ValueError, get_acquisition(d).get_operator)
@@ -0,0 +1,104 @@
+from __future__ import division
+from glob import glob
+from numpy.testing import assert_equal
+from pyoperators.utils.testing import assert_same
+from qubic import QubicInstrument, QubicScene, get_pointing
+from qubic.qubicdict import qubicDict
+from uuid import uuid1
+import numpy as np
+import os
+import qubic
+import shutil
+
+outpath = ''
+
+
+def setup():
+    global outpath
+    outpath = 'test-' + str(uuid1())[:8]
+    os.mkdir(outpath)
+
+
+def teardown():
+    shutil.rmtree(outpath)
+
+
+def get_dict(**keywords):
+    d = qubicDict()
+    d.read_from_file(os.path.join(os.path.dirname(qubic.__file__), 'dicts',
+                                  'pipeline_demo.dict'))
+    d.update(nside=16, npointings=7, random_pointing=True,
+             repeat_pointing=False, MultiBand=False, nf_sub=1)
+    d.update(keywords)
+    return d
+
+
+def get_projection(cache_dir, ndetectors=10, **keywords):
+    d = get_dict(projection_cache=cache_dir, **keywords)
+    instrument = QubicInstrument(d)[:ndetectors]
+    return instrument.get_projection_operator(
+        get_pointing(d), QubicScene(d), verbose=False)
+
+
+def is_memmap(array):
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return False
+
+
+def test_projection_cache_roundtrip():
+    def func(kind):
+        cache_dir = os.path.join(outpath, 'roundtrip-' + kind)
+        ref = get_projection(None, kind=kind)
+        P1 = get_projection(cache_dir, kind=kind)
+        filenames = glob(os.path.join(cache_dir, 'projection_*.npy'))
+        assert_equal(len(filenames), 1)
+        assert not is_memmap(P1.matrix.data)
+        mtime = os.path.getmtime(filenames[0])
+
+        P2 = get_projection(cache_dir, kind=kind)
+        assert is_memmap(P2.matrix.data)
+        assert_equal(glob(os.path.join(cache_dir, 'projection_*.npy')),
+                     filenames)
+        assert_equal(os.path.getmtime(filenames[0]), mtime)
+        assert_equal(P2.matrix.data, P1.matrix.data)
+
+        np.random.seed(0)
+        x = np.random.randn(*ref.shapein)
+        y = np.random.randn(*ref.shapeout)
+        for P in P1, P2:
+            assert_equal(P(x), ref(x))
+            assert_equal(P.T(y), ref.T(y))
+
+        # the memory map is copy-on-write: the cached matrix is not altered
+        P2.matrix.data.value[...] = 0
+        P3 = get_projection(cache_dir, kind=kind)
+        assert_equal(P3(x), ref(x))
+    for kind in 'I', 'IQU':
+        yield func, kind
+
+
+def test_projection_cache_invalidation():
+    cache_dir = os.path.join(outpath, 'invalidation')
+    get_projection(cache_dir)
+    changes = [{'ndetectors': 5},
+               {'seed': 2},
+               {'nside': 8},
+               {'kind': 'I'},
+               {'filter_nu': 140e9},
+               {'synthbeam_kmax': 2},
+               {'synthbeam_fraction': 0.9}]
+
+    def func(keywords):
+        nfiles = len(glob(os.path.join(cache_dir, 'projection_*.npy')))
+        P = get_projection(cache_dir, **keywords)
+        assert_equal(len(glob(os.path.join(cache_dir, 'projection_*.npy'))),
+                     nfiles + 1)
+        assert not is_memmap(P.matrix.data)
+        ref = get_projection(None, **keywords)
+        assert_same(P.matrix.data.index, ref.matrix.data.index)
+        assert_same(P.matrix.data.value, ref.matrix.data.value)
+    for keywords in changes:
+        yield func, keywords
@@ -0,0 +1,48 @@
+from __future__ import division
+from numpy.testing import assert_allclose, assert_equal
+from qubic.ripples import ConvolutionRippledGaussianOperator
+import healpy as hp
+import numpy as np
+
+nside = 16
+
+
+def convolve_loop(fl, input):
+    """ The previous implementation of the convolution, map by map. """
+    result = np.empty_like(input)
+    output = result
+    if input.ndim == 1:
+        input = input[:, None]
+        output = output[:, None]
+    for i, o in zip(input.T, output.T):
+        ialm = hp.map2alm(i)
+        alm_smoothed = hp.almxfl(ialm, fl)
+        o[...] = hp.alm2map(alm_smoothed, hp.npix2nside(len(i)))
+    return result
+
+
+def test_window():
+    for freq in 140e9, 150e9, 160e9:
+        ops = [ConvolutionRippledGaussianOperator(freq, nripples=n)
+               for n in range(3)]
+        # the window does not depend on the number of ripples
+        assert all(op.fl is ops[0].fl for op in ops)
+        assert not ops[0].fl.flags.writeable
+
+
+def test_convolution():
+    np.random.seed(0)
+    npix = 12 * nside**2
+
+    def func(freq, input):
+        op = ConvolutionRippledGaussianOperator(freq)
+        output = np.empty_like(input)
+        op.direct(input, output)
+        expected = convolve_loop(op.fl, input)
+        assert_equal(output.shape, input.shape)
+        assert_allclose(output, expected, rtol=1e-10,
+                        atol=1e-10 * np.max(np.abs(expected)))
+
+    for freq in 140e9, 150e9, 160e9:
+        yield func, freq, np.random.randn(npix)
+        yield func, freq, np.random.randn(npix, 3)
@@ -0,0 +1,175 @@
+from __future__ import division
+from numpy.testing import assert_allclose, assert_equal
+from pysimulators import FitsArray
+from uuid import uuid1
+import numpy as np
+import os
+import pickle
+import shutil
+import qubic.sb_fitting as sbfit
+
+outpath = ''
+fitted = []
+fit_sb_orig = sbfit.fit_sb
+
+
+def fit_sb_fake(flatmap, az, el, model, doplot=False, return_fitted=False,
+                **keywords):
+    """ Fast fit_sb returning parameters which depend on the flat map. """
+    fitted.append(int(flatmap[0, 0]))
+    fitpars = np.array([np.mean(flatmap), np.std(flatmap), model['scale']])
+    fit = [None, fitpars, 0.1 * fitpars, np.diag(fitpars**2),
+           np.sum(flatmap**2), np.size(flatmap) - len(fitpars)]
+    newxxyy = np.zeros((4, 9))
+    return fit, newxxyy, np.zeros_like(flatmap)
+
+
+def setup():
+    global outpath
+    outpath = 'test-' + str(uuid1())[:8]
+    os.makedirs(os.path.join(outpath, 'Flat'))
+    FitsArray(np.linspace(-10, 10, 11)).save(
+        os.path.join(outpath, 'Flat', 'azimuth.fits'))
+    FitsArray(np.linspace(40, 60, 9)).save(
+        os.path.join(outpath, 'Flat', 'elevation.fits'))
+    np.random.seed(0)
+    for TESNum in range(1, 8):
+        flatmap = np.random.randn(9, 11)
+        flatmap[0, 0] = TESNum
+        FitsArray(flatmap).save(os.path.join(
+            outpath, 'Flat', 'imgflat_TESNum_{}.fits'.format(TESNum)))
+    sbfit.fit_sb = fit_sb_fake
+
+
+def teardown():
+    sbfit.fit_sb = fit_sb_orig
+    shutil.rmtree(outpath)
+
+
+def get_expected(TESNum):
+    flatmap = np.array(FitsArray(os.path.join(
+        outpath, 'Flat', 'imgflat_TESNum_{}.fits'.format(TESNum))))
+    return np.array([np.mean(flatmap), np.std(flatmap), 2.])
+
+
+def check_results(results, tes_list):
+    assert_equal(sorted(results), sorted(tes_list))
+    for TESNum in tes_list:
+        assert_equal(results[TESNum]['TESNum'], TESNum)
+        assert_equal(results[TESNum]['fitpars'], get_expected(TESNum))
+
+
+def test_fit_sb_all_resume():
+    filename = os.path.join(outpath, 'fit_sb_all.pk')
+    model = {'scale': 2.}
+    del fitted[:]
+    results = sbfit.fit_sb_all(outpath, [1, 2, 3], model, nprocs=1,
+                               verbose=False)
+    assert_equal(fitted, [1, 2, 3])
+    check_results(results, [1, 2, 3])
+    check_results(sbfit.load_fit_sb_all(filename), [1, 2, 3])
+
+    # the TES already in the file are skipped
+    del fitted[:]
+    results = sbfit.fit_sb_all(outpath, [2, 4, 1, 5], model, nprocs=1,
+                               verbose=False)
+    assert_equal(fitted, [4, 5])
+    check_results(results, [1, 2, 3, 4, 5])
+    check_results(sbfit.load_fit_sb_all(filename), [1, 2, 3, 4, 5])
+    del fitted[:]
+    sbfit.fit_sb_all(outpath, [1, 2, 3, 4, 5], model, nprocs=1,
+                     verbose=False)
+    assert_equal(fitted, [])
+
+    # a record truncated by an interruption is dropped and fitted again
+    size = os.path.getsize(filename)
+    with open(filename, 'ab') as f:
+        pickle.dump({'TESNum': 6, 'fitpars': np.zeros(3)}, f, protocol=2)
+    with open(filename, 'r+b') as f:
+        f.truncate(size + (os.path.getsize(filename) - size) // 2)
+    check_results(sbfit.load_fit_sb_all(filename), [1, 2, 3, 4, 5])
+    assert_equal(os.path.getsize(filename), size)
+    del fitted[:]
+    results = sbfit.fit_sb_all(outpath, [5, 6, 7], model, nprocs=1,
+                               verbose=False)
+    assert_equal(fitted, [6, 7])
+    check_results(results, [1, 2, 3, 4, 5, 6, 7])
+    check_results(sbfit.load_fit_sb_all(filename), [1, 2, 3, 4, 5, 6, 7])
+
+
+def test_fit_sb_all_failure():
+    # the failed fits are not recorded and are attempted again
+    filename = os.path.join(outpath, 'fit_sb_all_failure.pk')
+    model = {'scale': 2.}
+    del fitted[:]
+    results = sbfit.fit_sb_all(outpath, [1, 8, 2], model, nprocs=1,
+                               filename=filename, verbose=False)
+    assert_equal(fitted, [1, 2])
+    check_results(results, [1, 2])
+    check_results(sbfit.load_fit_sb_all(filename), [1, 2])
+    # the shared grids and model are released after the serial fits
+    assert_equal(sbfit._FIT_SB_ALL, {})
+
+
+def get_finite_differences(func, pars, eps=1e-6):
+    """ Central finite differences of func with respect to each parameter,
+    stacked along the first axis. """
+    pars = np.asarray(pars, dtype=float)
+    out = []
+    for i in range(len(pars)):
+        dp = np.zeros(len(pars))
+        dp[i] = eps * max(1, abs(pars[i]))
+        out.append((func(pars + dp) - func(pars - dp)) / (2 * dp[i]))
+    return np.array(out)
+
+
+def get_geometry_pars():
+    # center, interpeak distance, angle and distortions
+    return np.array([0.3, 50.2, 8.1, 43., 0.04, 2.2, 0.03, 1.8])
+
+
+def test_peaks_positions_jacobian():
+    xx, yy = np.meshgrid(np.arange(3) - 1, np.arange(3) - 1)
+    xxyy = np.array([np.ravel(xx), np.ravel(yy)], dtype=float)
+
+    def func(masked_distortion):
+        pars = get_geometry_pars()
+        newxy, dnewxy = sbfit._get_peaks_positions(
+            xxyy, pars, masked_distortion=masked_distortion)
+        expected = get_finite_differences(
+            lambda p: sbfit._get_peaks_positions(
+                xxyy, p, masked_distortion=masked_distortion)[0], pars)
+        assert_allclose(np.transpose(dnewxy, (2, 0, 1)), expected, rtol=1e-6,
+                        atol=1e-8)
+    for masked_distortion in False, True:
+        yield func, masked_distortion
+
+
+def test_model_gradient():
+    az = np.linspace(-12, 12, 25)
+    el = np.linspace(38, 62, 25)
+    x = np.meshgrid(az * np.cos(np.radians(50)), np.flip(el))
+
+    def func(model):
+        np.random.seed(0)
+        pars = np.array(model.startpars, dtype=float)
+        pars[0:8] = get_geometry_pars()
+        if model.npars > 13:
+            nper = (model.npars - 9) // model.npeaks
+            pars[9::nper] *= 1 + 0.2 * np.random.rand(model.npeaks)
+            pars[10::nper] = 0.1 * np.random.randn(model.npeaks)
+            if nper == 4:
+                pars[11::nper] = 0.2 * np.random.randn(model.npeaks)
+                pars[12::nper] = 0.2 * np.random.randn(model.npeaks)
+        else:
+            pars[10:12] = [0.5, 50.5]
+        actual = model.gradient(x, pars)
+        expected = get_finite_differences(lambda p: model(x, p), pars)
+        assert_equal(actual.shape, (model.npars, np.size(x[0])))
+        assert_allclose(actual, expected, rtol=1e-5,
+                        atol=1e-6 * np.max(np.abs(expected)))
+
+    for model in (sbfit.SimpleSbModel(),
+                  sbfit.SbModelIndepPeaksAmpFWHM(),
+                  sbfit.SbModelIndepPeaks()):
+        yield func, model
@@ -0,0 +1,102 @@
+from __future__ import division
+from numpy.testing import assert_allclose, assert_equal
+from qubic import QubicInstrument
+from qubic.qubicdict import qubicDict
+from qubic.selfcal_lib import HornFields, SelfCalibration, get_power_on_array
+import numpy as np
+import os
+import qubic
+
+d = qubicDict()
+d.read_from_file(os.path.join(os.path.dirname(qubic.__file__), 'dicts',
+                              'pipeline_demo.dict'))
+d.update(config='TD', MultiBand=False, nf_sub=1)
+q = QubicInstrument(d)
+theta = np.array([0., 0.005, 0.01])
+phi = np.array([0., 0.5, 1.])
+reso = 12
+
+
+def get_configurations(i, j, dead_switches):
+    """ Open horns of S, C-i, C-j, S-ij, Ci, Cj, Sij: the dead switches are
+    closed when all the horns are open, not when only i and j are. """
+    nhorns = len(q.horn)
+    alive = np.ones(nhorns, bool)
+    if dead_switches is not None:
+        alive[np.array(dead_switches) - 1] = False
+    only = np.zeros(nhorns, bool)
+    configs = [alive.copy() for _ in range(4)] + \
+        [only.copy() for _ in range(3)]
+    configs[1][i - 1] = False
+    configs[2][j - 1] = False
+    configs[3][[i - 1, j - 1]] = False
+    configs[4][i - 1] = True
+    configs[5][j - 1] = True
+    configs[6][[i - 1, j - 1]] = True
+    return configs
+
+
+def get_expected(configs):
+    open_horns = np.array(q.horn.open)
+    expected = []
+    for config in configs:
+        q.horn.open = config
+        expected.append(get_power_on_array(q, theta, phi, reso=reso))
+    q.horn.open = open_horns
+    return expected
+
+
+def assert_close(actual, expected):
+    assert_allclose(actual, expected, rtol=1e-10,
+                    atol=1e-10 * np.max(np.abs(expected)))
+
+
+def test_power_combinations():
+    def func(baseline, dead_switches):
+        expected = get_expected(get_configurations(baseline[0], baseline[1],
+                                                   dead_switches))
+        s = SelfCalibration(baseline, dict(d), dead_switches=dead_switches)
+        actual = s.get_power_combinations(q, theta, phi, reso=reso,
+                                          doplot=False)
+        assert_equal(len(actual), 7)
+        for a, e in zip(actual, expected):
+            assert_equal(a.shape, (reso, reso, len(theta)))
+            assert_close(a, e)
+
+    for baseline in [17, 33], [2, 40]:
+        for dead_switches in None, [5, 17]:
+            yield func, baseline, dead_switches
+
+
+def test_get_power():
+    fields = HornFields(q, theta, phi, reso=reso)
+    configs = get_configurations(3, 60, [8])
+    expected = get_expected(configs)
+    # one configuration, with the (reso, reso) image rotated to the ONAFP
+    # frame for each pointing
+    for config, e in zip(configs, expected):
+        assert_close(fields.get_power(config), e)
+    # several configurations at once
+    actual = fields.get_power(np.array(configs))
+    assert_equal(actual.shape, (len(configs), reso, reso, len(theta)))
+    for a, e in zip(actual, expected):
+        assert_close(a, e)
+
+
+def test_baselines_power():
+    fields = HornFields(q, theta, phi, reso=reso)
+    baselines = [(1, 2), (5, 17), (17, 40), (33, 64)]
+
+    def func(dead_switches):
+        actual = fields.get_baselines_power(baselines,
+                                            dead_switches=dead_switches)
+        for k, (i, j) in enumerate(baselines):
+            expected = get_expected(get_configurations(i, j, dead_switches))
+            assert_close(actual[0], expected[0])
+            for a, e in zip(actual[1:], expected[1:]):
+                assert_equal(a.shape, (len(baselines), reso, reso,
+                                       len(theta)))
+                assert_close(a[k], e)
+
+    for dead_switches in None, [5, 17]:
+        yield func, dead_switches
@@ -0,0 +1,96 @@
+from __future__ import division
+from numpy.testing import assert_allclose
+from pyoperators import DiagonalOperator
+from qubic import (
+    QubicAcquisition, QubicInstrument, QubicMultibandAcquisition,
+    QubicMultibandInstrument, QubicPolyAcquisition, QubicScene, get_pointing)
+from qubic.acquisition import _stacked_matvec, _stacked_rmatvec
+from qubic.qubicdict import qubicDict
+import numpy as np
+import os
+import qubic
+
+
+def get_dict(**keywords):
+    d = qubicDict()
+    d.read_from_file(os.path.join(os.path.dirname(qubic.__file__), 'dicts',
+                                  'pipeline_demo.dict'))
+    d.update(nside=8, npointings=40, random_pointing=True,
+             repeat_pointing=False, MultiBand=False, nf_sub=1, tol=1e-10,
+             maxiter=1000, verbose=False)
+    d.update(keywords)
+    return d
+
+
+def get_acquisition(cls, d):
+    scene = QubicScene(d)
+    sampling = get_pointing(d)
+    if cls is QubicAcquisition:
+        acq = cls(QubicInstrument(d)[:20], sampling, scene, d)
+    else:
+        q = QubicMultibandInstrument(d)
+        args = ()
+        if cls is QubicMultibandAcquisition:
+            nus = [q[i].filter.nu / 1e9 for i in range(len(q))]
+            args = ([nus[0] - 1, np.mean(nus), nus[-1] + 1],)
+        acq = cls(q, sampling, scene, d, *args)
+    # white noise of detector dependent level
+    ndetectors = len(acq.instrument if cls is QubicAcquisition else
+                     acq[0].instrument)
+    invntt = DiagonalOperator(np.linspace(1, 2, ndetectors),
+                              broadcast='rightward')
+    acq.get_invntt_operator = lambda: invntt
+    return acq
+
+
+def test_stacked_matvec():
+    def func(kind):
+        d = get_dict(kind=kind)
+        acq = get_acquisition(QubicAcquisition, d)
+        P = acq.get_projection_operator()
+        npixel = P.shapein[0]
+        nstokes = 1 if kind == 'I' else len(kind)
+        k = 3
+        np.random.seed(0)
+        x = np.random.randn(npixel, nstokes, k)
+        y = np.random.randn(np.prod(P.shapeout[:2]), nstokes, k)
+        actual = _stacked_matvec(P.matrix, x, nrows_chunk=7)
+        actual_t = _stacked_rmatvec(P.matrix, y, npixel, nrows_chunk=7)
+        for i in range(k):
+            expected = P(x[..., i].reshape(P.shapein))
+            assert_allclose(actual[..., i].reshape(P.shapeout), expected,
+                            rtol=1e-12, atol=1e-12 * np.max(np.abs(expected)))
+            expected = P.T(y[..., i].reshape(P.shapeout))
+            assert_allclose(actual_t[..., i].reshape(P.shapein), expected,
+                            rtol=1e-12, atol=1e-12 * np.max(np.abs(expected)))
+    for kind in 'I', 'QU', 'IQU':
+        yield func, kind
+
+
+def test_tod2map_many():
+    def func(cls, kind, preconditioner):
+        keywords = {'kind': kind, 'preconditioner': preconditioner}
+        if cls is not QubicAcquisition:
+            keywords.update(MultiBand=True, nf_sub=4)
+        d = get_dict(**keywords)
+        acq = get_acquisition(cls, d)
+        H = acq.get_operator()
+        np.random.seed(0)
+        k = 3
+        tods = np.array([H(np.random.randn(*H.shapein)) +
+                         1e-3 * np.random.randn(*H.shapeout)
+                         for i in range(k)])
+        maps, nit, error = acq.tod2map_many(tods, d)
+        assert maps.shape == (k,) + H.shapein
+        assert np.all(error <= d['tol'])
+        for tod, map_ in zip(tods, maps):
+            expected = acq.tod2map(tod, d)[0]
+            # the subacquisition matrices are merged in single precision
+            assert_allclose(map_, expected, rtol=1e-4,
+                            atol=1e-4 * np.max(np.abs(expected)))
+
+    for cls in (QubicAcquisition, QubicPolyAcquisition,
+                QubicMultibandAcquisition):
+        for kind in 'I', 'IQU':
+            for preconditioner in 'diagonal', 'block_jacobi':
+                yield func, cls, kind, preconditioner
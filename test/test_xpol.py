@@ -1,9 +1,25 @@
 from __future__ import division
 
 import numpy as np
+import os
+import shutil
+from numpy.testing import assert_equal
 from pyoperators.utils.testing import assert_same
 from pysimulators import FitsArray
 from qubic import Xpol
+from uuid import uuid1
+
+outpath = ''
+
+
+def setup():
+    global outpath
+    outpath = 'test-' + str(uuid1())[:8]
+    os.mkdir(outpath)
+
+
+def teardown():
+    shutil.rmtree(outpath)
 
 
 def test_xpol():
@@ -19,3 +35,95 @@ def test_xpol():
     for lmax in [0, 1, 2, 10]:
         for n in [lmax-1, lmax, lmax+1]:
             yield func, lmax, n
+
+
+def test_spectra_many():
+    nside = 8
+    np.random.seed(0)
+    maps = np.random.randn(3, 12 * nside**2, 3)
+
+    class XpolDummy(Xpol):
+        def __init__(self):
+            self.mask = np.random.rand(12 * nside**2) > 0.3
+            self.lmin = 2
+            self.lmax = 2 * nside
+            self.delta_ell = 3
+            self.ell_binned, self._p, self._q = self._bin_ell()
+            n = 6 * len(self.ell_binned)
+            self.mll_binned_inv = np.random.randn(n, n)
+    xpol = XpolDummy()
+    biased, unbiased = xpol.get_spectra_many(maps)
+
+    i, j = np.triu_indices(len(maps))
+    assert biased.shape[0] == len(maps) * (len(maps) + 1) // 2
+    assert unbiased.shape[0] == len(maps) * (len(maps) + 1) // 2
+
+    def func(k):
+        b, u = xpol.get_spectra(maps[i[k]], maps[j[k]])
+        assert_same(biased[k], b)
+        assert_same(unbiased[k], u)
+    for k in range(len(i)):
+        yield func, k
+
+
+class XpolCounter(Xpol):
+    """ Xpol counting the computations of the mode-coupling matrix. """
+    ncalls = 0
+
+    def _get_Mll(self, binning=True):
+        XpolCounter.ncalls += 1
+        return Xpol._get_Mll(self, binning=binning)
+
+
+def get_mask(nside=8, seed=0):
+    np.random.seed(seed)
+    return np.random.rand(12 * nside**2) > 0.3
+
+
+def test_cache():
+    cache_dir = os.path.join(outpath, 'cache')
+    mask = get_mask()
+    XpolCounter.ncalls = 0
+
+    # the matrices are computed lazily, and then stored
+    xpol = XpolCounter(mask, 2, 16, 3, cache_dir=cache_dir)
+    assert not os.path.exists(cache_dir)
+    expected = xpol.mll_binned_inv
+    assert_equal(XpolCounter.ncalls, 1)
+    assert_equal(len(os.listdir(cache_dir)), 1)
+    assert xpol.mll_binned_inv is expected
+    assert_equal(XpolCounter.ncalls, 1)
+    assert_same(expected, np.linalg.inv(Xpol(mask, 2, 16, 3)._get_Mll()))
+
+    # cache hit
+    xpol = XpolCounter(mask, 2, 16, 3, cache_dir=cache_dir)
+    assert_equal(xpol.mll_binned_inv, expected)
+    assert_equal(XpolCounter.ncalls, 1)
+    cache = xpol._load_cache()
+    assert isinstance(cache, dict)
+    assert_equal(cache['mll_binned_inv'], expected)
+
+    # cache misses
+    for mask_, lmin, lmax, delta_ell in [(get_mask(seed=1), 2, 16, 3),
+                                         (mask, 3, 16, 3),
+                                         (mask, 2, 15, 3),
+                                         (mask, 2, 16, 4)]:
+        ncalls = XpolCounter.ncalls
+        nfiles = len(os.listdir(cache_dir))
+        xpol = XpolCounter(mask_, lmin, lmax, delta_ell, cache_dir=cache_dir)
+        assert xpol._load_cache() is None
+        xpol.mll_binned_inv
+        assert_equal(XpolCounter.ncalls, ncalls + 1)
+        assert_equal(len(os.listdir(cache_dir)), nfiles + 1)
+
+
+def test_mll_binned_inv_setter():
+    cache_dir = os.path.join(outpath, 'cache-setter')
+    XpolCounter.ncalls = 0
+    xpol = XpolCounter(get_mask(), 2, 16, 3, cache_dir=cache_dir)
+    n = 6 * len(xpol.ell_binned)
+    value = np.random.randn(n, n)
+    xpol.mll_binned_inv = value
+    assert xpol.mll_binned_inv is value
+    assert_equal(XpolCounter.ncalls, 0)
+    assert not os.path.exists(cache_dir)